@@ -0,0 +1,16 @@
+"""
+Performance benchmarks for the forward model.
+
+The benchmarks follow the conventions of airspeed velocity (asv): each
+class has a *setup* method, optional *params* and *param_names*, and
+*time_* methods which are timed.  Run the suite against the commits on
+the current branch with::
+
+    asv run
+
+or, without asv, against the current source tree with::
+
+    python -m benchmarks.run --output=results.json
+
+See :mod:`benchmarks.run` for comparing two sets of results.
+"""
@@ -0,0 +1,69 @@
+"""
+Benchmarks for the compiled kernels.
+"""
+import numpy as np
+
+from refl1d.reflectivity import reflectivity_amplitude, magnetic_amplitude
+from refl1d.reflectivity import convolve, convolve_sampled
+
+
+def _stack(layers, seed=1):
+    rng = np.random.RandomState(seed)
+    depth = rng.uniform(5, 50, size=layers)
+    depth[0] = depth[-1] = 0
+    rho = rng.uniform(-1, 7, size=layers)
+    irho = rng.uniform(0, 0.1, size=layers)
+    sigma = rng.uniform(1, 5, size=layers-1)
+    return depth, sigma, rho, irho
+
+
+class Reflectivity(object):
+    params = ([10, 100, 1000], [100, 1000, 10000])
+    param_names = ['layers', 'points']
+
+    def setup(self, layers, points):
+        self.depth, self.sigma, self.rho, self.irho = _stack(layers)
+        self.kz = np.linspace(0.001, 0.15, points)
+        self.r = np.empty(points, 'D')
+
+    def time_reflectivity_amplitude(self, layers, points):
+        reflectivity_amplitude(kz=self.kz, depth=self.depth, rho=self.rho,
+                               irho=self.irho, sigma=self.sigma, out=self.r)
+
+
+class MagneticReflectivity(object):
+    params = ([10, 100, 1000], [100, 1000, 10000])
+    param_names = ['layers', 'points']
+
+    def setup(self, layers, points):
+        self.depth, self.sigma, self.rho, self.irho = _stack(layers)
+        rng = np.random.RandomState(2)
+        self.rhoM = rng.uniform(0, 2, size=layers)
+        self.thetaM = rng.uniform(0, 360, size=layers)
+        self.kz = np.linspace(0.001, 0.15, points)
+
+    def time_magnetic_amplitude(self, layers, points):
+        magnetic_amplitude(kz=self.kz, depth=self.depth, rho=self.rho,
+                           irho=self.irho, rhoM=self.rhoM,
+                           thetaM=self.thetaM, sigma=self.sigma)
+
+
+class Convolve(object):
+    params = ([1000, 10000, 100000], [100, 1000])
+    param_names = ['theory', 'points']
+
+    def setup(self, theory, points):
+        self.xi = np.linspace(0.001, 0.3, theory)
+        self.yi = 1/(1 + (self.xi/0.02)**4) * (1 + 0.5*np.cos(600*self.xi))
+        self.x = np.linspace(0.005, 0.29, points)
+        self.dx = 0.01*self.x + 0.0005
+        self.xp = np.linspace(-0.5, 0.5, 21)
+        self.yp = np.exp(-self.xp**2/0.02)
+        self.out = np.empty(points)
+
+    def time_convolve(self, theory, points):
+        convolve(self.xi, self.yi, self.x, self.dx, out=self.out)
+
+    def time_convolve_sampled(self, theory, points):
+        convolve_sampled(self.xi, self.yi, self.xp, self.yp, self.x, self.dx,
+                         out=self.out)
@@ -0,0 +1,77 @@
+"""
+Benchmarks for the complete forward model of the example fits.
+"""
+import os
+import warnings
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+EXAMPLEDIR = os.path.join(ROOT, 'doc', 'examples')
+
+examples = [
+    "distribution/dist-example.py",
+    "ex1/nifilm.py",
+    "ex1/nifilm-data.py",
+    "ex1/nifilm-tof.py",
+    "freemag/pmf.py",
+    "ill_posed/anticor.py",
+    "ill_posed/tethered.py",
+    "mixed/mixed.py",
+    "mixed/mixed_magnetic.py",
+    "polymer/tethered.py",
+    "polymer/freeform.py",
+    "profile/model.py",
+    "spinvalve/n101G.py",
+    "superlattice/freeform.py",
+    "superlattice/NiTi.py",
+    "superlattice/PEMU.py",
+    "thick/nifilm.py",
+    "TOF/du53.py",
+    "xray/model.py",
+    "xray/staj.py",
+    ]
+
+
+def load_example(path):
+    """
+    Load the fit problem in doc/examples/*path*.
+
+    Examples are loaded from their own directory so that they can find
+    their data files.
+    """
+    from bumps.fitproblem import load_problem
+    cwd = os.getcwd()
+    os.chdir(os.path.join(EXAMPLEDIR, os.path.dirname(path)))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return load_problem(os.path.basename(path))
+    finally:
+        os.chdir(cwd)
+
+
+class ExampleNllf(object):
+    """
+    Full model evaluation: render, reflectivity, resolution and nllf.
+    """
+    params = examples
+    param_names = ['example']
+    timeout = 120
+
+    def setup(self, example):
+        try:
+            self.problem = load_example(example)
+        except Exception as exc:
+            # asv skips benchmarks which raise NotImplementedError in setup
+            raise NotImplementedError("could not load %s: %s"%(example, exc))
+        self.p = self.problem.getp()
+        self.bounds = self.problem.bounds()
+        self.rng = np.random.RandomState(1)
+
+    def time_nllf(self, example):
+        # Move to a new point near the start, as in a fit.  Setting the same
+        # values again would let the render and SCF caches skip the work.
+        p = self.p*(1 + 1e-6*self.rng.randn(len(self.p)))
+        self.problem.setp(np.clip(p, *self.bounds))
+        self.problem.nllf()
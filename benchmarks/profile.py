@@ -0,0 +1,68 @@
+"""
+Benchmarks for rendering the sample profile into slabs.
+"""
+import numpy as np
+
+from refl1d.profile import Microslabs, build_profile
+
+
+class BuildProfile(object):
+    params = ([10, 100, 1000], [1000, 10000])
+    param_names = ['layers', 'points']
+
+    def setup(self, layers, points):
+        rng = np.random.RandomState(1)
+        # the first and last thicknesses are ignored by build_profile
+        self.thickness = rng.uniform(5, 50, size=layers)
+        self.roughness = rng.uniform(1, 5, size=layers-1)
+        self.value = rng.uniform(-1, 7, size=layers)
+        total = np.sum(self.thickness[1:-1])
+        self.z = np.linspace(-20, total+20, points)
+
+    def time_build_profile(self, layers, points):
+        build_profile(self.z, self.thickness, self.roughness, self.value)
+
+
+class Finalize(object):
+    """
+    Merge microslabs using :meth:`refl1d.profile.Microslabs.finalize`.
+
+    The nonmagnetic profile here is contracted by
+    :func:`refl1d.reflmodule._contract_by_area_multi`; magnetic profiles
+    use :func:`refl1d.reflmodule._contract_mag_multi` instead.
+    """
+    params = ([100, 1000, 10000], [0, 1])
+    param_names = ['slabs', 'dA']
+
+    def setup(self, slabs, dA):
+        z = np.linspace(0, 1000, slabs)
+        self.w = np.full(slabs, z[1]-z[0])
+        self.sigma = np.zeros(slabs)
+        self.rho = 4 + 2*np.sin(z/50)
+        self.irho = 0.01*np.ones(slabs)
+        self.slabs = Microslabs(1, dz=z[1]-z[0])
+
+    def time_finalize(self, slabs, dA):
+        self.slabs.clear()
+        self.slabs.extend(w=self.w, sigma=self.sigma,
+                          rho=self.rho[None, :], irho=self.irho[None, :])
+        self.slabs.finalize(step_interfaces=False, dA=dA, roughness_limit=0)
+
+
+class SCFSolve(object):
+    """
+    Numerical self-consistent field profile for an end-tethered polymer.
+    """
+    params = ([100, 500], [0.1, 0.3])
+    param_names = ['segments', 'sigma']
+    timeout = 120
+
+    def setup(self, segments, sigma):
+        try:
+            import scipy.optimize
+        except ImportError:
+            raise NotImplementedError("needs scipy")
+
+    def time_SCFsolve(self, segments, sigma):
+        from refl1d.polymer import SCFsolve
+        SCFsolve(chi=0.3, chi_s=0.1, pdi=1.2, sigma=sigma, segments=segments)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Run the benchmarks without asv.
+
+Usage::
+
+    python -m benchmarks.run [options] [pattern ...]
+
+Only benchmarks whose name contains one of the *patterns* are run, with
+names such as "kernels.Reflectivity.time_reflectivity_amplitude".  Use
+--help for the list of options.
+
+Each timing is the best and median time per call in seconds over the
+repeats, with the number of calls per repeat chosen so that each repeat
+takes at least 0.1 s.
+"""
+from __future__ import print_function
+
+import sys
+import os
+import json
+import argparse
+import time
+import timeit
+import platform
+import itertools
+import importlib
+import subprocess
+
+MODULES = ['kernels', 'profile', 'models']
+
+
+def benchmarks(patterns=()):
+    """
+    Yield (name, class, method) for each benchmark matching *patterns*.
+    """
+    for module_name in MODULES:
+        module = importlib.import_module('benchmarks.'+module_name)
+        for class_name, cls in sorted(vars(module).items()):
+            if not isinstance(cls, type) or cls.__module__ != module.__name__:
+                continue
+            for method in sorted(dir(cls)):
+                if not method.startswith('time_'):
+                    continue
+                name = ".".join((module_name, class_name, method))
+                if not patterns or any(p in name for p in patterns):
+                    yield name, cls, method
+
+
+def parameter_sets(cls):
+    """
+    Return a list of parameter tuples for the benchmark class.
+    """
+    params = getattr(cls, 'params', None)
+    if params is None:
+        return [()]
+    if not params or not isinstance(params[0], (list, tuple)):
+        params = [params]
+    return list(itertools.product(*params))
+
+
+def time_benchmark(cls, method, args, repeat):
+    """
+    Return (best, median, number) for one parameter set, or None if skipped.
+    """
+    bench = cls()
+    if hasattr(bench, 'setup'):
+        try:
+            bench.setup(*args)
+        except NotImplementedError:
+            return None
+    fn = getattr(bench, method)
+    timer = timeit.Timer(lambda: fn(*args))
+    number = 1
+    while True:
+        if timer.timeit(number) >= 0.1 or number >= 1000000:
+            break
+        number *= 10
+    times = sorted(t/number for t in timer.repeat(repeat, number))
+    if hasattr(bench, 'teardown'):
+        bench.teardown(*args)
+    return times[0], times[len(times)//2], number
+
+
+def run(patterns=(), repeat=5):
+    """
+    Run the benchmarks, printing the timings as they complete.
+    """
+    results = {}
+    for name, cls, method in benchmarks(patterns):
+        names = getattr(cls, 'param_names', [])
+        entries = results[name] = []
+        for args in parameter_sets(cls):
+            label = name + ("(%s)"%", ".join(str(v) for v in args)
+                            if args else "")
+            timing = time_benchmark(cls, method, args, repeat)
+            if timing is None:
+                print("%-70s skipped"%label)
+                entries.append({'params': list(args), 'skipped': True})
+            else:
+                print("%-70s %10.3g s"%(label, timing[0]))
+                entries.append({'params': list(args),
+                                'param_names': list(names),
+                                'best': timing[0], 'median': timing[1],
+                                'number': timing[2]})
+            sys.stdout.flush()
+    return results
+
+
+def environment():
+    """
+    Return a description of the machine and the versions being timed.
+    """
+    import numpy
+    env = {
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'machine': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        }
+    try:
+        import refl1d
+        env['refl1d'] = refl1d.__version__
+    except (ImportError, AttributeError):
+        pass
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+
+def compare(old, new, threshold):
+    """
+    Print the ratio of new to old times, returning the regressions.
+    """
+    regressions = []
+    for name, entries in sorted(new.items()):
+        previous = dict((tuple(e['params']), e)
+                        for e in old.get(name, []) if 'best' in e)
+        for entry in entries:
+            base = previous.get(tuple(entry['params']), None)
+            if base is None or 'best' not in entry:
+                continue
+            ratio = entry['best']/base['best']
+            label = "%s(%s)"%(name, ", ".join(str(v) for v in entry['params']))
+            flag = " *" if ratio > threshold else ""
+            print("%-70s %6.2f%s"%(label, ratio, flag))
+            if ratio > threshold:
+                regressions.append(label)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Run the benchmarks without asv.")
+    parser.add_argument('patterns', nargs='*', metavar='pattern',
+                        help="run benchmarks whose name contains pattern")
+    parser.add_argument('--output', metavar='file.json',
+                        help="save the timings to file.json")
+    parser.add_argument('--compare', metavar='file.json',
+                        help="compare the timings to a previous run, and "
+                        "exit with status 1 if any benchmark is slower by "
+                        "more than the threshold")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="ratio of new to old time above which a "
+                        "benchmark is a regression (default 1.2)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of timing repeats for each benchmark "
+                        "(default 5)")
+    opts = parser.parse_args(argv)
+
+    results = run(opts.patterns, repeat=opts.repeat)
+    if opts.output:
+        with open(opts.output, 'w') as fid:
+            json.dump({'environment': environment(), 'results': results},
+                      fid, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as fid:
+            old = json.load(fid)['results']
+        print("\nRatio of new to old time (* is a regression)")
+        regressions = compare(old, results, opts.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
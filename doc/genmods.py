@@ -52,6 +52,7 @@ MODULES = [
     ('model', 'Reflectivity Models'),
     ('mono', 'Freeform - Monotonic Spline'),
     ('names', 'Public API'),
+    ('parallel', 'Parallel evaluation of experiments'),
     ('ncnrdata', 'NCNR Data'),
     #('plottable', 'Style-based plot definitions'),
     ('polymer', 'Polymer models'),
@@ -0,0 +1,204 @@
+# This program is in the public domain
+"""
+Load many reduced data files at once
+
+Model scripts for a measurement campaign may load dozens of data files,
+one :func:`refl1d.ncnrdata.load` or :func:`refl1d.snsdata.load` call at
+a time.  :func:`load_files` expands a set of file names and glob patterns,
+parses the files concurrently in a pool of threads or processes, and
+returns the probes keyed by file name::
+
+    probes = load_files(["data/*.refl", "data/*.refl[A-D]"],
+                        instrument=NCNR.NG1(slits_at_Tlo=1))
+    print(probes.report())
+    probe = probes["data/spin_valve01.refl"]
+
+Polarized data sets, where the cross sections are stored in files ending
+in A, B, C and D as described in :func:`refl1d.ncnrdata.find_xsec`, are
+combined into a single :class:`refl1d.probe.PolarizedNeutronProbe`
+keyed by the file name without the cross section letter.
+
+Files are loaded with *instrument.load* if an instrument is given, with
+:func:`refl1d.snsdata.load` for REF_L files from the SNS liquids
+reflectometer, and with :func:`refl1d.ncnrdata.load` otherwise.
+"""
+from __future__ import division
+
+import os
+import re
+import glob
+import time
+import traceback
+import multiprocessing
+import multiprocessing.pool
+
+from . import ncnrdata, snsdata
+from .probe import PolarizedNeutronProbe
+
+__all__ = ['load_files', 'ProbeCollection']
+
+# File names such as run.reflA, with the cross section as the last letter
+# of the extension.
+_XSEC_PATTERN = re.compile(r'^(.*\.[^./\\]+)[abcdABCD]$')
+
+
+class ProbeCollection(dict):
+    """
+    Probes returned by :func:`load_files`, keyed by file name.
+
+    *timing* is a dictionary with the time in seconds taken to load each
+    file.  For polarized data the cross section files are listed
+    separately.  *elapsed* is the wall clock time for the whole load.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.timing = {}
+        self.elapsed = 0.
+
+    def report(self):
+        """
+        Return a table of load times, slowest first.
+        """
+        width = max([len(k) for k in self.timing] + [4])
+        lines = ["%-*s %10s" % (width, "file", "time (s)")]
+        for name, t in sorted(self.timing.items(), key=lambda kv: -kv[1]):
+            lines.append("%-*s %10.4f" % (width, name, t))
+        lines.append("%-*s %10.4f" % (width, "total", sum(self.timing.values())))
+        lines.append("%-*s %10.4f" % (width, "elapsed", self.elapsed))
+        return "\n".join(lines)
+
+
+def load_files(files, instrument=None, threads=None, processes=None,
+               options=None, Aguide=270, H=0, shared_beam=True, **kw):
+    """
+    Load a set of data files concurrently, returning a
+    :class:`ProbeCollection`.
+
+    *files* is a file name or glob pattern, or a list of them.  Files
+    matched by more than one pattern are loaded once.
+
+    *instrument* is the instrument used to load each file, or None to
+    choose the loader from the file name.
+
+    *threads* is the number of threads to use, or None for one per CPU.
+    If *processes* is given, the files are parsed in that many worker
+    processes instead, which avoids contention for the global interpreter
+    lock but requires the instrument and the probes to be pickled.
+
+    *options* is a dictionary of extra keyword arguments for individual
+    files, such as the angle for each time-of-flight run, keyed by the
+    same name used for the probe in the returned collection.  Keyword
+    arguments in *kw* are passed to all files.
+
+    *Aguide*, *H* and *shared_beam* are used for polarized data sets as
+    in :func:`refl1d.ncnrdata.load_magnetic`.
+
+    Raises IOError if a pattern does not match any files, or if any of
+    the files could not be loaded.
+    """
+    options = options if options is not None else {}
+    groups = _group_files(_expand(files))
+
+    tasks = []
+    for key, members in groups:
+        args = kw.copy()
+        args.update(options.get(key, {}))
+        for name in members:
+            if name is not None:
+                tasks.append((name, instrument, args))
+
+    start = time.time()
+    if processes is not None:
+        n = max(1, min(processes, len(tasks)))
+        pool = multiprocessing.Pool(n)
+    else:
+        n = threads if threads else multiprocessing.cpu_count()
+        n = max(1, min(n, len(tasks)))
+        pool = multiprocessing.pool.ThreadPool(n)
+    try:
+        results = pool.map(_load_one, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = [msg for _, _, msg in results if msg is not None]
+    if errors:
+        raise IOError("could not load data files:\n" + "\n".join(errors))
+
+    loaded = dict((name, probe) for (name, _, _), (probe, _, _)
+                  in zip(tasks, results))
+    collection = ProbeCollection()
+    for (name, _, _), (_, seconds, _) in zip(tasks, results):
+        collection.timing[name] = seconds
+    for key, members in groups:
+        if len(members) == 1:
+            collection[key] = loaded[members[0]]
+        else:
+            xs = [loaded[name] if name is not None else None
+                  for name in members]
+            probe = PolarizedNeutronProbe(xs, Aguide=Aguide, H=H)
+            if shared_beam:
+                probe.shared_beam()
+            collection[key] = probe
+    collection.elapsed = time.time() - start
+    return collection
+
+
+def _expand(files):
+    """
+    Return the file names matching *files*, in order, without duplicates.
+    """
+    if isinstance(files, str):
+        files = [files]
+    names, seen = [], set()
+    for pattern in files:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) \
+            else [pattern] if os.path.exists(pattern) else []
+        if not matches:
+            raise IOError("No data files match %r" % pattern)
+        for name in matches:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+    return names
+
+
+def _group_files(names):
+    """
+    Return [(key, members), ...] grouping the polarization cross sections.
+
+    Unpolarized files have a single member.  Polarized data sets have the
+    A, B, C and D cross section files as members, with None for the
+    cross sections which were not loaded.
+    """
+    groups, index = [], {}
+    for name in names:
+        match = _XSEC_PATTERN.match(name)
+        if match is None:
+            groups.append((name, [name]))
+            continue
+        base = match.group(1)
+        if base not in index:
+            index[base] = len(groups)
+            groups.append((base, [None]*4))
+        groups[index[base]][1]["ABCD".index(name[-1].upper())] = name
+    return groups
+
+
+def _load_one(task):
+    """
+    Load one file, returning (probe, seconds, error).
+    """
+    name, instrument, kw = task
+    start = time.time()
+    try:
+        if instrument is not None:
+            probe = instrument.load(name, **kw)
+        elif os.path.basename(name).startswith('REF_L'):
+            probe = snsdata.load(name, **kw)
+        else:
+            probe = ncnrdata.load(name, **kw)
+    except Exception:
+        return None, time.time() - start, \
+            "%s:\n%s" % (name, traceback.format_exc())
+    return probe, time.time() - start, None
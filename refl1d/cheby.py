@@ -95,6 +95,7 @@ class FreeformCheby(Layer):
     sld (rho) and imaginary sld (irho) can be modeled with a separate
     polynomial orders.
     """
+    cache_render = True
     def __init__(self, thickness=0, interface=0, rho=[], irho=[],
                  name="Cheby", method="interp"):
         if interface != 0:
@@ -157,6 +158,7 @@ class ChebyVF(Layer):
 
            sld(z) = material.sld * profile(z) + solvent.sld * (1 - profile(z))
     """
+    cache_render = True
     def __init__(self, thickness=0, interface=0,
                  material=None, solvent=None, vf=None,
                  name="ChebyVF", method="interp"):
@@ -0,0 +1,258 @@
+# This program is in the public domain
+"""
+Binary cache for parsed data files
+
+Model scripts parse their data files each time they are run, and fits
+which run the script in many worker processes parse the files in each
+worker.  :func:`cached_parse` saves the result of the parser to a binary
+sidecar file so that later runs can map the arrays directly from disk
+instead of parsing the text again.
+
+The sidecar is keyed on the path of the data file, its modification time
+and its size, on the parser and its arguments, and on the versions of
+refl1d and of the package providing the parser, so editing the data
+file, changing how it is parsed or upgrading the parser causes it to be
+parsed again.  Sidecars
+are stored in ~/.refl1d/datacache, or in the directory named by the
+REFL1D_DATA_CACHE environment variable.  Set REFL1D_DATA_CACHE to an
+empty string to turn off caching.
+
+The parsed value can be any combination of dicts with string keys, lists,
+tuples, strings, numbers, None and numpy arrays, which covers the header
+and data returned by :func:`bumps.data.parse_file` and
+:func:`bumps.data.parse_multi`.  Arrays are returned as copy-on-write
+memory maps of the sidecar, so they can be modified without affecting
+the cache.  Values which cannot be stored are returned uncached.
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import tempfile
+
+import numpy as np
+
+from . import __version__
+
+__all__ = ['cached_parse', 'cache_dir']
+
+_MAGIC = b'REFL1D-DATACACHE-1\n'
+_ALIGN = 64
+
+
+def cache_dir():
+    """
+    Return the directory for the sidecar files, or None if caching is off.
+    """
+    path = os.environ.get('REFL1D_DATA_CACHE', None)
+    if path is None:
+        path = os.path.join('~', '.refl1d', 'datacache')
+    return os.path.expanduser(path) if path else None
+
+
+def cached_parse(parser, filename, *args, **kw):
+    """
+    Return *parser(filename, \*args, \*\*kw)*, using the sidecar cache.
+
+    The cache is only used when *filename* names a file on disk.
+    """
+    folder = cache_dir()
+    if folder is None or not isinstance(filename, str) \
+            or not os.path.isfile(filename):
+        return parser(filename, *args, **kw)
+
+    path = os.path.abspath(filename)
+    source = ".".join((getattr(parser, '__module__', ''),
+                       getattr(parser, '__name__', repr(parser))))
+    signature = [path, source, repr(args), repr(sorted(kw.items()))]
+    digest = hashlib.sha1(json.dumps(signature).encode('utf-8')).hexdigest()
+    sidecar = os.path.join(folder, digest + '.bin')
+    info = os.stat(filename)
+    key = signature + [repr(info.st_mtime), info.st_size,
+                       __version__, _package_version(parser)]
+
+    try:
+        return _read(sidecar, key)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    value = parser(filename, *args, **kw)
+    try:
+        _write(sidecar, key, value)
+    except (IOError, OSError, ValueError, TypeError):
+        pass
+    return value
+
+
+def _package_version(parser):
+    """
+    Return the version of the package defining *parser*, if it has one.
+    """
+    package = getattr(parser, '__module__', None) or ''
+    module = sys.modules.get(package.split('.')[0], None)
+    return str(getattr(module, '__version__', ''))
+
+
+def _write(sidecar, key, value):
+    """
+    Save *value* to *sidecar*, replacing it atomically.
+    """
+    arrays = []
+    index = json.dumps({'key': key, 'value': _encode(value, arrays)})
+    index = index.encode('utf-8')
+
+    folder = os.path.dirname(sidecar)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fid:
+            fid.write(_MAGIC)
+            fid.write(struct.pack('<Q', len(index)))
+            fid.write(index)
+            start = _aligned(fid.tell())
+            for offset, array in arrays:
+                fid.seek(start + offset)
+                fid.write(array.tobytes())
+        getattr(os, 'replace', os.rename)(tmp, sidecar)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def _read(sidecar, key):
+    """
+    Return the value saved in *sidecar*, or raise KeyError if it is stale.
+    """
+    with open(sidecar, 'rb') as fid:
+        if fid.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("not a data cache file")
+        size, = struct.unpack('<Q', fid.read(8))
+        index = json.loads(fid.read(size).decode('utf-8'))
+        start = _aligned(fid.tell())
+    if index['key'] != key:
+        raise KeyError(sidecar)
+    return _decode(index['value'], sidecar, start)
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1)//_ALIGN*_ALIGN
+
+
+def _encode(value, arrays):
+    """
+    Convert *value* to JSON, appending (offset, array) for each array.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, (np.ndarray, np.generic)):
+        array = np.ascontiguousarray(value)
+        if array.dtype.hasobject:
+            raise TypeError("cannot cache object arrays")
+        offset = (_aligned(arrays[-1][0] + arrays[-1][1].nbytes)
+                  if arrays else 0)
+        arrays.append((offset, array))
+        return {'__ndarray__': [array.dtype.str, list(array.shape), offset,
+                                isinstance(value, np.generic)]}
+    elif isinstance(value, tuple):
+        return {'__tuple__': [_encode(v, arrays) for v in value]}
+    elif isinstance(value, list):
+        return [_encode(v, arrays) for v in value]
+    elif isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise TypeError("cannot cache dict with non-string keys")
+        return dict((k, _encode(v, arrays)) for k, v in value.items())
+    raise TypeError("cannot cache %s" % type(value).__name__)
+
+
+def _decode(value, sidecar, start):
+    if isinstance(value, list):
+        return [_decode(v, sidecar, start) for v in value]
+    elif not isinstance(value, dict):
+        return value
+    elif '__ndarray__' in value:
+        dtype, shape, offset, scalar = value['__ndarray__']
+        dtype, shape = np.dtype(dtype), tuple(shape)
+        if scalar:
+            with open(sidecar, 'rb') as fid:
+                fid.seek(start + offset)
+                return np.frombuffer(fid.read(dtype.itemsize), dtype)[0]
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype)
+        return np.asarray(np.memmap(sidecar, dtype=dtype, mode='c',
+                                    offset=start + offset, shape=shape))
+    elif '__tuple__' in value:
+        return tuple(_decode(v, sidecar, start) for v in value['__tuple__'])
+    return dict((k, _decode(v, sidecar, start)) for k, v in value.items())
+
+
+def test():
+    import shutil
+    from bumps.data import parse_file, parse_multi
+
+    root = tempfile.mkdtemp()
+    saved = os.environ.get('REFL1D_DATA_CACHE', None)
+    os.environ['REFL1D_DATA_CACHE'] = os.path.join(root, 'cache')
+    try:
+        filename = os.path.join(root, 'data.refl')
+        with open(filename, 'w') as fid:
+            fid.write("# title: sample\n# columns: Q R dR\n")
+            fid.write("0.01 0.9 0.01\n0.02 0.5 0.01\n0.03 0.1 0.01\n")
+
+        # first call parses and saves, second call reads the sidecar
+        header, data = cached_parse(parse_file, filename)
+        assert len(os.listdir(cache_dir())) == 1
+        cached_header, cached_data = cached_parse(parse_file, filename)
+        assert cached_header == header
+        assert (cached_data == data).all() and cached_data.dtype == data.dtype
+        assert isinstance(cached_data.base, np.memmap)
+
+        # parser arguments are part of the key
+        parts = cached_parse(parse_multi, filename, keysep=":")
+        assert parts[0][0]['title'] == 'sample'
+        assert len(os.listdir(cache_dir())) == 2
+
+        # modifying the returned arrays does not change the cache
+        cached_data[0, 0] = -1
+        assert cached_parse(parse_file, filename)[1][0, 0] == data[0, 0]
+
+        # changing the file invalidates the cache
+        with open(filename, 'a') as fid:
+            fid.write("0.04 0.05 0.01\n")
+        assert cached_parse(parse_file, filename)[1].shape == (3, 4)
+
+        # as does a new version of refl1d
+        global __version__
+        version = __version__
+        try:
+            __version__ = version + '.test'
+            assert not isinstance(cached_parse(parse_file, filename)[1].base,
+                                  np.memmap)
+            assert isinstance(cached_parse(parse_file, filename)[1].base,
+                              np.memmap)
+        finally:
+            __version__ = version
+        assert len(os.listdir(cache_dir())) == 2
+
+        # nested values round trip
+        value = {'a': (1, 2.5, None, [np.arange(3), 'x']),
+                 'b': np.float32(2), 'c': np.empty((0, 2))}
+        copy = cached_parse(lambda f: value, filename)
+        copy = cached_parse(lambda f: value, filename)
+        assert copy['a'][:3] == value['a'][:3] and copy['a'][3][1] == 'x'
+        assert (copy['a'][3][0] == value['a'][3][0]).all()
+        assert copy['b'] == 2 and copy['b'].dtype == np.float32
+        assert copy['c'].shape == (0, 2)
+    finally:
+        if saved is None:
+            del os.environ['REFL1D_DATA_CACHE']
+        else:
+            os.environ['REFL1D_DATA_CACHE'] = saved
+        shutil.rmtree(root)
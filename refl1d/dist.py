@@ -9,11 +9,18 @@ the parameter.
 
 DistristributionExperiment allows the model to be computed for a single
 varying parameter.  Multi-parameter dispersion models are not available.
+
+For a gaussian distribution of the parameter, :class:`GaussHermite` uses
+Gauss-Hermite quadrature, which needs far fewer parameter values than
+binning the distribution with :class:`Weights` for the same accuracy.
+:meth:`DistributionExperiment.adapt_points` chooses the number of
+quadrature points needed for a given accuracy.
 """
 
 import numpy
 from bumps.parameter import Parameter
 from refl1d.experiment import ExperimentBase
+from refl1d.reflectivity import reflectivity_amplitude_batch as reflamp_batch
 
 class Weights(object):
     """
@@ -84,6 +91,30 @@ class Weights(object):
             idx = weights > 0
             return iter(zip(centers[idx], weights[idx]))
 
+class GaussHermite(object):
+    """
+    Gaussian distribution for use in DistributionExperiment.
+
+    The parameter takes on *n* values chosen by Gauss-Hermite quadrature
+    for a gaussian with center *loc* and 1-sigma width *scale*.  The
+    weighted sum is exact for theory functions which are polynomials of
+    degree up to 2n-1 in the parameter, so a smooth theory usually needs
+    only a handful of points.  *loc* and *scale* can be fitted.
+
+    Use :meth:`DistributionExperiment.adapt_points` to choose *n*.
+    """
+    def __init__(self, loc=None, scale=None, n=7):
+        self.loc = Parameter.default(loc)
+        self.scale = Parameter.default(scale)
+        self.n = n
+    def parameters(self):
+        return {'loc':self.loc,'scale':self.scale}
+    def __iter__(self):
+        nodes, weights = numpy.polynomial.hermite.hermgauss(self.n)
+        x = self.loc.value + numpy.sqrt(2)*self.scale.value*nodes
+        weights = weights/numpy.sum(weights)
+        return iter(zip(x, weights))
+
 class DistributionExperiment(ExperimentBase):
     """
     Compute reflectivity from a non-uniform sample.
@@ -96,7 +127,15 @@ class DistributionExperiment(ExperimentBase):
     If *coherent* is true, then the reflectivity of the mixture is computed
     from the coherent sum rather than the incoherent sum.
 
-    See :class:`Weights` for a description of how to set up the distribution.
+    See :class:`Weights` for a description of how to set up the distribution,
+    or use :class:`GaussHermite` for a gaussian distribution.
+
+    The sample is rendered for each value of *P*, re-rendering only the
+    layers which depend on *P*, and the reflectivity for all values is
+    computed in a single call to the batched reflectivity kernel.
+    Magnetic and polarized models, and parameters which change the
+    calculation points, such as *theta_offset*, are evaluated one value
+    at a time.
     """
     def __init__(self, experiment=None, P=None, distribution=None,
                  coherent=False):
@@ -116,22 +155,93 @@ class DistributionExperiment(ExperimentBase):
     def reflectivity(self, resolution=True):
         key = "reflectivity",resolution
         if key not in self._cache:
-            calc_R = 0
-            for x,w in self.distribution:
-                if w>0:
-                    self.P.value = x
-                    self.experiment.update()
-                    Qx, Rx = self.experiment._reflamp()
-                    if self.coherent:
-                        calc_R += w*Rx
-                    else:
-                        calc_R += w*abs(Rx)**2
-            if self.coherent:
-                calc_R = abs(calc_R)**2
+            Qx, calc_R = self._calc_R()
             Q,R = self.probe.apply_beam(Qx, calc_R, resolution=resolution)
             self._cache[key] = Q,R
         return self._cache[key]
 
+    def adapt_points(self, tol=1e-3, max_points=50):
+        """
+        Choose the number of points in the distribution.
+
+        The number of points is increased until the theory changes by
+        less than *tol* relative to the theory, up to *max_points*.  This
+        works with distributions such as :class:`GaussHermite` which
+        have a number of points *n*.  Since the number of points needed
+        depends on the width of the distribution, call this with the
+        distribution parameters set to their widest values in the fit.
+
+        Returns the number of points.
+        """
+        if not hasattr(self.distribution, 'n'):
+            raise TypeError("distribution does not have a number of points n")
+        dist = self.distribution
+        dist.n = n = max(dist.n//2, 1)
+        self.update()
+        _, last = self.reflectivity()
+        while n < max_points:
+            dist.n = n = min(max(n+2, int(1.5*n)), max_points)
+            self.update()
+            _, R = self.reflectivity()
+            if (abs(R-last) <= tol*abs(R)).all():
+                break
+            last = R
+        return n
+
+    def _calc_R(self):
+        """
+        Return the calculation points and the reflectivity of the mixture
+        before applying the beam.
+        """
+        points = [(x,w) for x,w in self.distribution if w>0]
+        experiment = self.experiment
+        saved = self.P.value
+        try:
+            if experiment.sample.ismagnetic or self.probe.polarized:
+                return self._calc_R_serial(points)
+
+            # Render the slabs for each value of the parameter
+            calc_q, slabs = None, []
+            for x,_ in points:
+                self.P.value = x
+                experiment.update()
+                q = self.probe.calc_Q
+                if calc_q is None:
+                    calc_q = q
+                elif len(q) != len(calc_q) or (q != calc_q).any():
+                    return self._calc_R_serial(points)
+                S = experiment._render_slabs()
+                slabs.append((S.w.copy(), S.sigma.copy(),
+                              S.rho[0].copy(), S.irho[0].copy()))
+
+            # Compute the reflectivity for all values at once
+            d, sigma, rho, irho = zip(*slabs)
+            calc_r = reflamp_batch(-calc_q/2, depth=d, rho=rho, irho=irho,
+                                   sigma=sigma)
+            weights = numpy.array([w for _,w in points])
+            if self.coherent:
+                calc_R = abs(numpy.dot(weights, calc_r))**2
+            else:
+                calc_R = numpy.dot(weights, abs(calc_r)**2)
+            return calc_q, calc_R
+        finally:
+            self.P.value = saved
+            experiment.update()
+
+    def _calc_R_serial(self, points):
+        calc_R = 0
+        for x,w in points:
+            self.P.value = x
+            self.experiment.update()
+            Qx, Rx = self.experiment._reflamp()
+            if self.coherent:
+                calc_R += w*Rx
+            else:
+                calc_R += w*abs(Rx)**2
+        if self.coherent:
+            calc_R = abs(calc_R)**2
+        return Qx, calc_R
+
     def _max_P(self):
         x,w = zip(*self.distribution)
         idx = numpy.argmax(w)
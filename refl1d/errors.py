@@ -10,6 +10,8 @@ Use *run_errors* in a model file to reload the results of a batch DREAM fit.
 __all__ = ['reload_errors', 'run_errors',
            'calc_errors', 'align_profiles',
            'show_errors', 'show_profiles', 'show_residuals',
+           'calc_error_bands', 'show_error_bands', 'ErrorBands',
+           'StreamingQuantiles',
            ]
 
 import numpy as np
@@ -140,18 +142,7 @@ def calc_errors(problem, points):
         Array of (theory-data)/uncertainty for each data point in
         the measurement.  There will be one array returned per error sample.
     """
-    # Grab the individual samples
-    if hasattr(problem, 'models'):
-        models = [m.fitness for m in problem.models]
-    else:
-        models = [problem.fitness]
-
-    experiments = []
-    for m in models:
-        if hasattr(m,'parts'):
-            experiments.extend(m.parts)
-        else:
-            experiments.append(m)
+    experiments = _experiments(problem)
     #probes = []
     #for m in experiments:
     #    if hasattr(m.probe,'probes'):
@@ -196,6 +187,348 @@ def calc_errors(problem, points):
     residuals = dict((k,np.asarray(v).T) for k,v in residuals.items())
     return profiles, slabs, Q, residuals
 
+def _experiments(problem):
+    """
+    Return the individual experiments making up the fit problem.
+    """
+    # Grab the individual samples
+    if hasattr(problem, 'models'):
+        models = [m.fitness for m in problem.models]
+    else:
+        models = [problem.fitness]
+
+    experiments = []
+    for m in models:
+        if hasattr(m,'parts'):
+            experiments.extend(m.parts)
+        else:
+            experiments.append(m)
+    return experiments
+
+def calc_error_bands(problem, points, align='auto', contours=_CONTOURS,
+                     npoints=400, processes=None, save=None):
+    """
+    Compute the profile and residual uncertainty bands for a set of points.
+
+    This is a streaming version of :func:`calc_errors` for large samples.
+    Rather than keeping every profile and residual vector, each sample is
+    aligned to the best profile as in :func:`align_profiles`, interpolated
+    onto a grid of *npoints* depths spanning the best profile plus a
+    10% margin on either side, and folded into running estimates of the
+    *contours* percentiles (see :class:`StreamingQuantiles`).  Memory use
+    does not grow with the number of points.
+
+    The points are evaluated in a pool of *processes* worker processes,
+    which defaults to one per CPU.  Use *processes=1* to evaluate them
+    in the current process.
+
+    If *save* is given, the aligned profiles and the residuals for each
+    sample are appended to *save*\_rho_samples#.dat and
+    *save*\_resid_samples#.dat as they arrive, and the contours are saved
+    to the files written by :func:`show_errors` with *plots=0*.
+
+    Returns a list of :class:`ErrorBands`, one for each experiment.
+    """
+    original = problem.getp()
+    try:
+        sampler = _BandSampler(problem, align, npoints)
+        bands = [ErrorBands(m.name, z, best, Q, contours)
+                 for m, z, best, Q in zip(sampler.experiments, sampler.z,
+                                          sampler.best_samples, sampler.Q)]
+        files = []
+        if save:
+            for k, m in enumerate(sampler.experiments):
+                files.append((open(save+"_rho_samples%d.dat"%(k+1), "wt"),
+                              open(save+"_resid_samples%d.dat"%(k+1), "wt")))
+                files[-1][0].write("# %s\n# z\n"%m.name)
+                np.savetxt(files[-1][0], sampler.z[k][None, :])
+                files[-1][1].write("# %s\n# Q\n"%m.name)
+                np.savetxt(files[-1][1], sampler.Q[k][None, :])
+        try:
+            for result in _map_samples(sampler, points, processes):
+                for k, (band, sample) in enumerate(zip(bands, result)):
+                    band.add(*sample)
+                    if files:
+                        rho, rhoM, resid = sample
+                        np.savetxt(files[k][0], rho[None, :])
+                        np.savetxt(files[k][1], resid[None, :])
+        finally:
+            for fids in files:
+                for fid in fids:
+                    fid.close()
+    finally:
+        problem.setp(original)
+        problem.chisq()
+
+    if save:
+        for k, band in enumerate(bands):
+            band.save(save, k+1)
+    return bands
+
+def show_error_bands(bands):
+    """
+    Plot the profile and residual bands returned from :func:`calc_error_bands`.
+    """
+    import pylab
+    from bumps.plotutil import _plot_quantiles
+
+    pylab.subplot(211)
+    any_magnetic = False
+    for band in bands:
+        for best, stream in ((band.rho, band.rho_quantiles),
+                             (band.rhoM, band.rhoM_quantiles)):
+            if best is None:
+                continue
+            color = next_color()
+            _plot_quantiles(band.z, stream.quantiles(), color, None)
+            pylab.plot(band.z, best, '-', color=dhsv(color,dv=-0.2))
+        any_magnetic = any_magnetic or band.rhoM is not None
+    _profiles_labels(any_magnetic)
+
+    pylab.subplot(212)
+    shift = 0
+    for band in bands:
+        color = next_color()
+        _plot_quantiles(band.Q, shift+band.resid_quantiles.quantiles(),
+                        color, None)
+        pylab.plot(band.Q, shift+band.residuals, '.', markersize=1,
+                   color=dhsv(color,dv=-0.2)) # best
+        shift += 5
+    _residuals_labels()
+
+class ErrorBands(object):
+    """
+    Uncertainty bands for one experiment, as returned by
+    :func:`calc_error_bands`.
+
+    *name* is the name of the experiment.
+
+    *z*, *rho*, *rhoM* are the depths and the best profile on those
+    depths, with *rhoM* set to None for nonmagnetic models.
+
+    *Q*, *residuals* are the data points and the residuals for the best fit.
+
+    *contours* are the percentiles for the bands.  The running estimates
+    of the quantiles are in *rho_quantiles*, *rhoM_quantiles* and
+    *resid_quantiles*, with the pairs of values for each contour returned
+    by their *quantiles()* method.
+
+    *samples* is the number of samples included in the bands.
+    """
+    def __init__(self, name, z, best, Q, contours):
+        rho, rhoM, resid = best
+        self.name = name
+        self.z, self.rho, self.rhoM = z, rho, rhoM
+        self.Q, self.residuals = Q, resid
+        self.contours = list(reversed(sorted(contours)))
+        prob = [[(100.-c)/200, (100.+c)/200] for c in self.contours]
+        self.rho_quantiles = StreamingQuantiles(prob)
+        self.rhoM_quantiles = (StreamingQuantiles(prob)
+                               if rhoM is not None else None)
+        self.resid_quantiles = StreamingQuantiles(prob)
+        self.samples = 0
+
+    def add(self, rho, rhoM, resid):
+        """
+        Include the profile and residuals for another sample.
+        """
+        self.rho_quantiles.add(rho)
+        if self.rhoM_quantiles is not None:
+            self.rhoM_quantiles.add(rhoM)
+        self.resid_quantiles.add(resid)
+        self.samples += 1
+
+    def save(self, basename, index):
+        """
+        Save the contours to *basename*\_rho_contour#.dat,
+        *basename*\_rhoM_contour#.dat and *basename*\_resid_contour#.dat,
+        where # is *index*.
+        """
+        if self.samples == 0:
+            return
+        prob = self.rho_quantiles.prob
+        columns = ["z", "best"] + list("%g%%"%v for v in 100*prob.flatten())
+        def contour(x, best, stream):
+            q = stream.quantiles()
+            return np.vstack((x, best, np.reshape(q,(-1,q.shape[2]))))
+        _write_file(basename+"_rho_contour%d.dat"%index,
+                    contour(self.z, self.rho, self.rho_quantiles),
+                    str(self.name), columns)
+        if self.rhoM is not None:
+            _write_file(basename+"_rhoM_contour%d.dat"%index,
+                        contour(self.z, self.rhoM, self.rhoM_quantiles),
+                        str(self.name), columns)
+        columns[0] = "q"
+        _write_file(basename+"_resid_contour%d.dat"%index,
+                    contour(self.Q, self.residuals, self.resid_quantiles),
+                    str(self.name), columns)
+
+class StreamingQuantiles(object):
+    """
+    Running estimate of quantiles for a stream of vectors.
+
+    *prob* is an array of probabilities in [0,1].  Each call to *add(x)*
+    includes another vector *x*, and *quantiles()* returns an array of
+    shape prob.shape + x.shape with the current estimates.
+
+    The first *nexact* vectors are kept and the quantiles are exact until
+    then.  After that, each element of the vector and each probability
+    has its own P-squared estimator [Jain and Chlamtac, CACM 28:1076
+    (1985)] initialized from the exact quantiles, so that memory does not
+    depend on the number of vectors.
+    """
+    def __init__(self, prob, nexact=100):
+        self.prob = np.asarray(prob, 'd')
+        self.nexact = max(nexact, 5)
+        self.count = 0
+        self._buffer = []
+        self._q = self._n = None
+
+    def add(self, x):
+        x = np.asarray(x, 'd')
+        self.count += 1
+        if self._q is None and len(self._buffer) < self.nexact:
+            self._buffer.append(x.copy())
+            return
+        if self._q is None:
+            self._start()
+        self._update(x)
+
+    def quantiles(self):
+        if self._q is None:
+            if not self._buffer:
+                raise ValueError("no samples")
+            q = np.percentile(np.array(self._buffer), 100*self.prob.flatten(),
+                              axis=0)
+        else:
+            q = self._q[:, 2]
+        return np.reshape(q, self.prob.shape + q.shape[1:])
+
+    def _start(self):
+        # Markers at the min, p/2, p, (1+p)/2 and max order statistics.
+        y = np.sort(np.array(self._buffer), axis=0)
+        y = np.reshape(y, (len(y), -1))
+        p = self.prob.flatten()[:, None]
+        self._dn = np.hstack((0*p, p/2, p, (1+p)/2, 1+0*p))
+        self._ndesired = 1 + (len(y)-1)*self._dn
+        n = np.round(self._ndesired).astype('i')
+        # Keep the marker positions distinct
+        n[:, 1] = np.maximum(n[:, 1], 2)
+        n[:, 3] = np.minimum(n[:, 3], len(y)-1)
+        n[:, 2] = np.clip(n[:, 2], n[:, 1]+1, n[:, 3]-1)
+        self._q = y[n-1]  # P x 5 x M
+        self._n = np.repeat(n[:, :, None].astype('d'), y.shape[1], axis=2)
+        self._buffer = []
+
+    def _update(self, x):
+        q, n = self._q, self._n
+        x = np.reshape(x, (1, -1))
+        np.minimum(q[:, 0], x, out=q[:, 0])
+        np.maximum(q[:, 4], x, out=q[:, 4])
+        # Markers above the cell containing x move up by one
+        n[:, 1:4] += (x < q[:, 1:4])
+        n[:, 4] += 1
+        self._ndesired += self._dn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in (1, 2, 3):
+                d = self._ndesired[:, i, None] - n[:, i]
+                step = np.where((d >= 1) & (n[:, i+1]-n[:, i] > 1), 1.,
+                                np.where((d <= -1) & (n[:, i-1]-n[:, i] < -1),
+                                         -1., 0.))
+                if not step.any():
+                    continue
+                qm, qi, qp = q[:, i-1], q[:, i], q[:, i+1]
+                nm, ni, np_ = n[:, i-1], n[:, i], n[:, i+1]
+                parabolic = qi + step/(np_-nm)*((ni-nm+step)*(qp-qi)/(np_-ni)
+                                                + (np_-ni-step)*(qi-qm)/(ni-nm))
+                qnext = np.where(step > 0, qp, qm)
+                nnext = np.where(step > 0, np_, nm)
+                linear = qi + step*(qnext-qi)/(nnext-ni)
+                new = np.where((qm < parabolic) & (parabolic < qp),
+                               parabolic, linear)
+                q[:, i] = np.where(step != 0, new, qi)
+                n[:, i] += step
+
+class _BandSampler(object):
+    """
+    Aligned profiles on a common grid and residuals for each experiment.
+    """
+    def __init__(self, problem, align, npoints):
+        self.problem = problem
+        self.align = align
+        self.experiments = _experiments(problem)
+        problem.chisq()
+        profiles = [_sample_profile(m) for m in self.experiments]
+        self.best = [(z, rho) for z, rho, _, _ in profiles]
+        self.offset = [_find_offset(t, align)
+                       if align not in ('auto', None) else None
+                       for _, _, _, t in profiles]
+        self.z = []
+        for z, _, _, _ in profiles:
+            margin = 0.1*(z[-1] - z[0])
+            self.z.append(np.linspace(z[0]-margin, z[-1]+margin, npoints))
+        self.Q = [np.hstack([xs.Q for xs in m.probe.xs if xs is not None])
+                  if m.probe.polarized else m.probe.Q
+                  for m in self.experiments]
+        self.best_samples = self(None)
+
+    def __call__(self, point):
+        if point is not None:
+            self.problem.setp(point)
+        self.problem.chisq() # Force reflectivity recalculation
+        result = []
+        for k, m in enumerate(self.experiments):
+            z, rho, rhoM, slabs = _sample_profile(m)
+            if self.align is not None:
+                z = z + _align_profile_pair(self.best[k][0], self.best[k][1],
+                                            self.offset[k], z, rho, slabs,
+                                            self.align)
+            zp = self.z[k]
+            result.append((np.interp(zp, z, rho),
+                           np.interp(zp, z, rhoM) if rhoM is not None else None,
+                           m.residuals()+0))
+        return result
+
+def _sample_profile(m):
+    slabs = np.array([L.thickness.value for L in m.sample[1:-1]])
+    if m.ismagnetic:
+        z, rho, _, rhoM, _ = m.magnetic_profile()
+    else:
+        z, rho, _ = m.smooth_profile()
+        rhoM = None
+    return z, rho, rhoM, slabs
+
+def _map_samples(sampler, points, processes):
+    """
+    Yield sampler(p) for each p, using a pool of worker processes.
+    """
+    if processes is None:
+        import multiprocessing
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(points) < 2:
+        for p in points:
+            yield sampler(p)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, initializer=_init_band_worker,
+                                initargs=(sampler,))
+    try:
+        chunksize = max(1, len(points)//(4*processes))
+        for result in pool.imap(_band_worker, points, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+_BAND_SAMPLER = None
+def _init_band_worker(sampler):
+    global _BAND_SAMPLER
+    _BAND_SAMPLER = sampler
+
+def _band_worker(point):
+    return _BAND_SAMPLER(point)
+
 def align_profiles(profiles, slabs, align):
     """
     Align profiles for each sample
@@ -466,3 +799,59 @@ def _find_offset(v, align):
     offset = np.sum(v[:idx]) + (align-idx)*v[idx]
     #print offset, idx, v[:idx], align
     return offset
+
+def test_streaming_quantiles():
+    rng = np.random.RandomState(1)
+    x = rng.randn(2000, 3)*[1, 2, 3]
+    prob = [[0.16, 0.84], [0.025, 0.975]]
+    stream = StreamingQuantiles(prob, nexact=50)
+    for xi in x[:50]:
+        stream.add(xi)
+    exact = np.percentile(x[:50], [16, 84, 2.5, 97.5], axis=0)
+    assert np.allclose(stream.quantiles(), np.reshape(exact, (2, 2, 3)))
+    for xi in x[50:]:
+        stream.add(xi)
+    exact = np.percentile(x, [16, 84, 2.5, 97.5], axis=0)
+    assert np.allclose(stream.quantiles(), np.reshape(exact, (2, 2, 3)),
+                       atol=0.1, rtol=0)
+
+def test_calc_error_bands():
+    from bumps.fitproblem import FitProblem
+    from .names import Material, NeutronProbe, Experiment, silicon, air
+
+    nickel = Material('Ni')
+    sample = silicon(0, 5) | nickel(100, 5) | air
+    sample[1].thickness.range(80, 120)
+    sample[1].interface.range(2, 8)
+    probe = NeutronProbe(T=np.linspace(0.1, 3, 50), dT=0.01, L=4.75,
+                         dL=0.0475)
+    M = Experiment(sample=sample, probe=probe)
+    _, M.probe.R = M.reflectivity()
+    M.probe.dR = 0.01*M.probe.R + 1e-6
+    problem = FitProblem(M)
+    best = problem.getp()
+    rng = np.random.RandomState(1)
+    points = best + rng.randn(40, 2)*[3, 0.5]
+
+    # compare to the quantiles of the profiles and residuals kept in memory
+    profiles, slabs, Q, residuals = calc_errors(problem, points)
+    problem.setp(best)
+    for align in ('auto', None, 0.5):
+        for processes in (1, 2):
+            band, = calc_error_bands(problem, points, align=align,
+                                     processes=processes)
+            assert np.array_equal(problem.getp(), best)
+            assert band.samples == len(points)
+            prob = 100*band.rho_quantiles.prob.flatten()
+            shape = band.rho_quantiles.prob.shape + (-1,)
+            aligned = (align_profiles(profiles, slabs, align)
+                       if align is not None else profiles)[M]
+            rho = [np.interp(band.z, p[0], p[1]) for p in aligned[1:]]
+            rho = np.reshape(np.percentile(rho, prob, axis=0), shape)
+            assert np.allclose(band.rho_quantiles.quantiles(), rho,
+                               rtol=0, atol=1e-10)
+            assert np.allclose(band.rho, np.interp(band.z, *aligned[0][:2]))
+            resid = np.percentile(residuals[M][:, 1:], prob, axis=1)
+            assert np.allclose(band.resid_quantiles.quantiles(),
+                               np.reshape(resid, shape), rtol=0, atol=1e-10)
+            assert np.array_equal(band.Q, Q[M])
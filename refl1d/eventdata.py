@@ -0,0 +1,200 @@
+# This program is in the public domain
+r"""
+Event mode time-of-flight data
+
+Event mode instruments record each detected neutron as an event with its
+time-of-flight, the detector pixel and the time of the source pulse,
+rather than as a histogram.  :class:`EventHistogram` accumulates the
+events into wavelength bins one chunk at a time, so that event files much
+larger than memory can be reduced to a probe::
+
+    from refl1d.names import *
+    from refl1d.rebin import logbin_edges
+    from refl1d.resolution import bins
+    from refl1d.eventdata import EventHistogram
+
+    instrument = SNS.Liquids(slits_at_Tlo=0.2)
+    edges = logbin_edges(bins(2.5, 6.5, 0.02))
+    hist = EventHistogram(edges, instrument.d_moderator, tof_scale=0.1,
+                          pixels=range(30000, 40000))
+    hist.add_file('REF_L_1234_neutron_event.dat')
+    probe = hist.probe(instrument, T=1.2, monitor=incident_spectrum)
+
+The events in each chunk are counted into channels one time-of-flight
+unit wide with :func:`numpy.bincount`, and the channels are rebinned into
+the wavelength bins with :func:`refl1d.rebin.rebin`.  Memory use depends
+on the chunk size and the number of channels, not on the size of the
+event file.
+
+The uncertainty in the counts is the Poisson uncertainty $\sqrt{N}$,
+using 1 for empty bins.  Channels which straddle a wavelength bin edge
+are split between the bins in proportion to their overlap, so the counts
+need not be integers; this has little effect on the uncertainty when the
+channels are much narrower than the wavelength bins.
+"""
+from __future__ import division
+
+import numpy as np
+
+from .rebin import rebin
+from .resolution import TOF2L
+from .probe import make_probe
+
+__all__ = ['EventHistogram', 'read_events', 'EVENT_DTYPE']
+
+#: Record layout of the SNS pre-NeXus neutron_event.dat files, with
+#: time-of-flight in units of 100 ns and the detector pixel id.
+EVENT_DTYPE = np.dtype([('tof', '<u4'), ('pixel', '<u4')])
+
+
+def read_events(filename, chunk_size=1000000, dtype=None):
+    """
+    Yield chunks of at most *chunk_size* events from *filename*.
+
+    Files ending in .npy are read as numpy structured arrays.  Other
+    files are read as raw records with *dtype*, which defaults to
+    :data:`EVENT_DTYPE`.  The records need a *tof* field, and may have
+    *pixel* and *pulse_time* fields.
+    """
+    with open(filename, 'rb') as fid:
+        if filename.endswith('.npy'):
+            version = np.lib.format.read_magic(fid)
+            if version == (1, 0):
+                _, _, dtype = np.lib.format.read_array_header_1_0(fid)
+            else:
+                _, _, dtype = np.lib.format.read_array_header_2_0(fid)
+        elif dtype is None:
+            dtype = EVENT_DTYPE
+        while True:
+            chunk = np.fromfile(fid, dtype=dtype, count=chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+class EventHistogram(object):
+    """
+    Wavelength histogram accumulated from neutron events.
+
+    *edges* are the wavelength bin edges in |Ang|, such as those
+    returned by :func:`refl1d.rebin.logbin_edges`.
+
+    *d_moderator* is the moderator to detector distance used to convert
+    time-of-flight to wavelength, as for :func:`refl1d.resolution.TOF2L`.
+
+    *tof_scale* is the size of the event time-of-flight unit in
+    microseconds, such as 0.1 for :data:`EVENT_DTYPE` files.  Events are
+    counted in channels *tof_step* time-of-flight units wide before
+    rebinning to wavelength.
+
+    *pixels* is a list of the detector pixels to keep, or None to keep
+    events from all pixels.
+
+    *pulse_range* is the range of pulse times (start, stop) for the
+    events to keep, or None to keep events from all pulses.
+
+    The accumulated counts are in *counts* and the number of events
+    counted is in *events*.
+    """
+    def __init__(self, edges, d_moderator, tof_scale=1., tof_step=1.,
+                 pixels=None, pulse_range=None):
+        self.edges = np.asarray(edges, 'd')
+        if self.edges[0] > self.edges[-1]:
+            raise ValueError("wavelength bin edges must be increasing")
+        self.d_moderator = d_moderator
+        self.tof_scale = tof_scale
+        self.tof_step = tof_step
+        self.pulse_range = pulse_range
+        if pixels is not None:
+            pixels = np.asarray(pixels, 'i8')
+            self._pixel_mask = np.zeros(pixels.max()+1, 'bool')
+            self._pixel_mask[pixels] = True
+        else:
+            self._pixel_mask = None
+
+        # Time-of-flight channels covering the wavelength range
+        L_per_step = TOF2L(d_moderator, tof_step*tof_scale)
+        self._first = int(np.floor(self.edges[0]/L_per_step))
+        self._channels = int(np.ceil(self.edges[-1]/L_per_step)) - self._first
+        self._channel_edges = \
+            (self._first + np.arange(self._channels+1))*L_per_step
+
+        self.counts = np.zeros(len(self.edges)-1)
+        self.events = 0
+
+    def add(self, tof, pixel=None, pulse_time=None):
+        """
+        Count the events with time-of-flight *tof*, detector *pixel* and
+        source *pulse_time*.
+
+        *pixel* and *pulse_time* are only needed if the histogram selects
+        events by pixel or by pulse time.
+        """
+        tof = np.asarray(tof)
+        channel = np.floor(tof/self.tof_step).astype('i8') - self._first
+        keep = (channel >= 0) & (channel < self._channels)
+        if self._pixel_mask is not None:
+            pixel = np.asarray(pixel)
+            in_table = pixel < len(self._pixel_mask)
+            keep &= in_table
+            keep[in_table] &= self._pixel_mask[pixel[in_table]]
+        if self.pulse_range is not None:
+            start, stop = self.pulse_range
+            pulse_time = np.asarray(pulse_time)
+            keep &= (pulse_time >= start) & (pulse_time < stop)
+        channel = channel[keep]
+        if len(channel) == 0:
+            return
+        hist = np.bincount(channel, minlength=self._channels).astype('d')
+        self.counts += rebin(self._channel_edges, hist, self.edges)
+        self.events += len(channel)
+
+    def add_file(self, filename, chunk_size=1000000, dtype=None):
+        """
+        Count the events in *filename*, reading *chunk_size* at a time.
+
+        See :func:`read_events` for the supported file formats.
+        """
+        for chunk in read_events(filename, chunk_size=chunk_size,
+                                 dtype=dtype):
+            names = chunk.dtype.names
+            self.add(chunk['tof'],
+                     pixel=chunk['pixel'] if 'pixel' in names else None,
+                     pulse_time=(chunk['pulse_time']
+                                 if 'pulse_time' in names else None))
+
+    def reflectivity(self, monitor=1.):
+        """
+        Return the counts normalized by *monitor* as (R, dR).
+
+        *monitor* is a scalar, such as the proton charge, or the incident
+        counts in each wavelength bin.
+        """
+        monitor = np.asarray(monitor, 'd')*np.ones_like(self.counts)
+        dN = np.where(self.counts > 0, np.sqrt(self.counts), 1.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.counts/monitor, dN/monitor
+
+    def probe(self, instrument, T, monitor=1., **kw):
+        """
+        Return a probe for the accumulated counts.
+
+        *instrument* is the :class:`refl1d.instrument.Pulsed` instrument
+        used to compute the angular resolution at sample angle *T*.
+        *monitor* is as for :meth:`reflectivity`.  Other keyword arguments
+        are passed to the instrument resolution and to the probe.
+
+        Bins without monitor counts are dropped.  As in
+        :func:`refl1d.snsdata.TOF_to_data`, the wavelength resolution is
+        the bin width taken as the FWHM.
+        """
+        E = self.edges
+        L = (E[:-1]+E[1:])/2
+        dL = (E[1:]-E[:-1])/2.35   # FWHM is 2.35 sigma
+        R, dR = self.reflectivity(monitor)
+        keep = np.isfinite(R) & np.isfinite(dR)
+        L, dL, R, dR = [v[keep] for v in (L, dL, R, dR)]
+        T = np.array([T], 'd')
+        T, dT, L, dL = instrument.resolution(L=L, dL=dL, T=T, **kw)
+        kw.setdefault('radiation', instrument.radiation)
+        return make_probe(T=T, dT=dT, L=L, dL=dL, data=(R, dR), **kw)
@@ -17,6 +17,9 @@ import numpy
 from bumps import parameter
 
 from .reflectivity import reflectivity_amplitude as reflamp
+from .reflectivity import reflectivity_amplitude_batch as reflamp_batch
+from .reflectivity import reflectivity_jacobian as reflamp_jacobian
+from .reflectivity import PartialAmplitude
 from .reflectivity import magnetic_amplitude as reflmag
 #print("Using pure python reflectivity calculator")
 #from .abeles import refl as reflamp
@@ -52,6 +55,7 @@ class ExperimentBase(object):
         deleted formulas will be handled automatically.
         """
         self._probe_cache.reset()
+        self._slabs.reset_render_cache()
         self.update()
 
     def is_reset(self):
@@ -69,7 +73,8 @@ class ExperimentBase(object):
         # if we wanted to be particularly clever we could predefine
         # the optical matrices and only adjust those that have changed
         # as the result of a parameter changing.   More trouble than it
-        # is worth, methinks.
+        # is worth, methinks.  Expensive layers are instead re-rendered
+        # only when their own parameters change (see Layer.cache_render).
         #print("reseting calculation")
         self._cache = {}
 
@@ -80,13 +85,22 @@ class ExperimentBase(object):
                 or (not self.probe.polarized and self.probe.R is None)):
                 resid = numpy.zeros(0)
             else:
+                # The residuals are returned to the caller, so they need
+                # a fresh array, but they can be formed in place.
                 QR = self.reflectivity()
                 if self.probe.polarized:
-                    resid = numpy.hstack([(xs.R - QRi[1])/xs.dR
-                                          for xs,QRi in zip(self.probe.xs, QR)
-                                          if xs is not None])
+                    parts = [(xs, QRi[1]) for xs,QRi in zip(self.probe.xs, QR)
+                             if xs is not None]
+                    resid = numpy.empty(sum(len(Ri) for _,Ri in parts))
+                    offset = 0
+                    for xs,Ri in parts:
+                        part = resid[offset:offset+len(Ri)]
+                        numpy.subtract(xs.R, Ri, out=part)
+                        part /= xs.dR
+                        offset += len(Ri)
                 else:
-                    resid = (self.probe.R - QR[1])/self.probe.dR
+                    resid = numpy.subtract(self.probe.R, QR[1])
+                    resid /= self.probe.dR
             self._cache['residuals'] = resid
             #print(("%12s "*4)%("Q","R","dR","Rtheory"))
             #print("\n".join(("%12.6e "*4)%el for el in zip(QR[0],self.probe.R,self.probe.dR,QR[1]))
@@ -94,6 +108,21 @@ class ExperimentBase(object):
 
         return self._cache['residuals']
 
+    def _workspace(self, name, shape, dtype='d'):
+        """
+        Return the preallocated work array *name*.
+
+        The array is reallocated only if *shape* or *dtype* changes, as
+        happens when the probe is resampled.  Work arrays are overwritten
+        on the next evaluation, so they should not be returned to the caller.
+        """
+        workspace = self.__dict__.setdefault('_work', {})
+        work = workspace.get(name, None)
+        if (work is None or work.shape != shape
+                or work.dtype != numpy.dtype(dtype)):
+            work = workspace[name] = numpy.empty(shape, dtype)
+        return work
+
     def numpoints(self):
         if self.probe.polarized:
             return sum(len(xs.Q) for xs in self.probe.xs if xs is not None)
@@ -118,6 +147,22 @@ class ExperimentBase(object):
         # when dR changes, so maybe it belongs in probe.
         return 0.5*numpy.sum(self.residuals()**2) # + self._cache['nllf_scale']
 
+    def jacobian(self, parameters=None, step=1e-6):
+        """
+        Return the derivative of the residuals with respect to *parameters*.
+
+        *parameters* defaults to the fitted parameters of the model.  The
+        result has one row for each residual and one column for each
+        parameter.  The derivatives are computed numerically with a
+        forward step of *step* times the parameter value.
+        """
+        if parameters is None:
+            parameters = _fitted_parameters(self)
+        self.update()
+        J = numpy.empty((len(self.residuals()), len(parameters)))
+        _numeric_jacobian(self, parameters, range(len(parameters)), J, step)
+        return J
+
     def plot_reflectivity(self, show_resolution=False,
                           view=None, plot_shift=None):
 
@@ -259,6 +304,7 @@ class Experiment(ExperimentBase):
         *roughness_limit* limit the roughness based on layer thickness
         *dz* minimum step size for computed profile steps in Angstroms
         *dA* discretization condition for computed profiles
+        *dR* target error in the reflectivity for computed profiles
 
     If *step_interfaces* is True, then approximate the interface using
     microslabs with step size *dz*.  The microslabs extend throughout
@@ -286,14 +332,29 @@ class Experiment(ExperimentBase):
     then each profile step forms its own slab.  The *dA* condition will
     also apply to the slab approximation to the interfaces.
 
+    Rather than choosing *dA* by hand, give the relative error *dR* allowed
+    in the reflectivity at the largest *Q* of the probe, such as 0.01.
+    The tolerance for combining steps is then chosen to give the fewest
+    slabs for which a bound on the error is less than *dR*, with steps
+    combined only if they are similar for all wavelengths of the probe.
+    Use :meth:`contraction` to see the number of slabs and the estimated
+    error.  If *dR* is given, *dA* is ignored.
+
     *interpolation* indicates the number of points to plot in between
     existing points.
+
+    If *reuse_matrices* is True, then the transfer matrices for the layers
+    at the top and bottom of the stack which did not change since the
+    last calculation are reused (see :class:`refl1d.reflectivity.PartialAmplitude`).
+    This speeds up fits on thick stacks in which only a few layers vary.
+    It does not apply to magnetic samples.
     """
     profile_shift = 0
+    reuse_matrices = False
     def __init__(self, sample=None, probe=None, name=None,
                  roughness_limit=0, dz=None, dA=None,
                  step_interfaces=False, smoothness=None,
-                 interpolation=0):
+                 interpolation=0, reuse_matrices=False, dR=None):
         # Note: smoothness ignored
         self.sample = sample
         self._substrate=self.sample[0].material
@@ -305,8 +366,11 @@ class Experiment(ExperimentBase):
             if dz > 5: dz = 5
         self.dz = dz
         self.dA = dA
+        self.dR = dR
         self.step_interfaces = step_interfaces
         self.interpolation = interpolation
+        self.reuse_matrices = reuse_matrices
+        self._partial_amplitude = PartialAmplitude()
         self._slabs = profile.Microslabs(len(probe.unique_L) if probe.unique_L is not None else 1, dz=dz)
         self._probe_cache = material.ProbeCache(probe)
         self._cache = {}  # Cache calculated profiles/reflectivities
@@ -322,6 +386,36 @@ class Experiment(ExperimentBase):
                 'probe':self.probe.parameters(),
                 }
 
+    def adaptive_oversample(self, thickness=None, n=8, width=3):
+        """
+        Over-sample the probe where the resolution smears the Kiessig
+        fringes of the sample.
+
+        *thickness* is the total film thickness used to set the fringe
+        spacing.  If it is not given, the thickness of the sample as
+        currently rendered is used, excluding the substrate and surface.
+        If the layer thicknesses are fitted, give the largest thickness
+        expected during the fit instead.
+
+        The critical edge for the fringes is set from the largest
+        scattering density in the sample relative to the incident medium.
+
+        *n* and *width* are passed to
+        :meth:`refl1d.probe.Probe.adaptive_oversample`.
+        """
+        slabs = self._render_slabs()
+        if thickness is None:
+            thickness = numpy.sum(slabs.w[1:-1])
+        rho = slabs.rho[0]
+        incident = rho[0] if self.probe.back_reflectivity else rho[-1]
+        Qc = numpy.sqrt(16*pi*max(numpy.max(rho) - incident, 0)*1e-6)
+        self.probe.adaptive_oversample(thickness, n=n, width=width, Qc=Qc)
+        # The calculation points may have new wavelengths
+        probe = self.probe
+        self._slabs = profile.Microslabs(len(probe.unique_L) if probe.unique_L is not None else 1, dz=self.dz)
+        self._probe_cache = material.ProbeCache(probe)
+        self.update()
+
     def _render_slabs(self):
         """
         Build a slab description of the model from the individual layers.
@@ -330,12 +424,26 @@ class Experiment(ExperimentBase):
         if key not in self._cache:
             self._slabs.clear()
             self.sample.render(self._probe_cache, self._slabs)
+            Qmax = numpy.max(abs(self.probe.calc_Q)) if self.dR else None
             self._slabs.finalize(step_interfaces=self.step_interfaces,
                                  dA=self.dA,
-                                 roughness_limit=self.roughness_limit)
+                                 roughness_limit=self.roughness_limit,
+                                 dR=self.dR, Qmax=Qmax)
             self._cache[key] = True
         return self._slabs
 
+    def contraction(self):
+        """
+        Return (slabs, dR) for the rendered profile.
+
+        *slabs* is the number of slabs used to compute the reflectivity
+        and *dR* is the estimated relative error in the reflectivity from
+        combining similar steps in the profile, or None if the profile
+        was not contracted to a target error.
+        """
+        slabs = self._render_slabs()
+        return len(slabs), slabs.contract_error if self.dR else None
+
     def _reflamp(self):
         #calc_q = self.probe.calc_Q
         #return calc_q,calc_q
@@ -353,10 +461,19 @@ class Experiment(ExperimentBase):
                 Aguide = self.probe.Aguide.value
                 H = self.probe.H.value
                 calc_r = reflmag(-calc_q/2, depth=w, rho=rho[0], irho=irho[0],
-                                 rhoM=rhoM, thetaM=thetaM, Aguide=Aguide, H=H)
+                                 rhoM=rhoM, thetaM=thetaM, Aguide=Aguide, H=H,
+                                 xs=self._measured_xs())
             else:
-                calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
-                                 sigma=sigma)
+                out = self._workspace('calc_r', calc_q.shape, 'D')
+                repeats = slabs.repeats()
+                if len(repeats):
+                    calc_r = reflamp(-calc_q/2, depth=w, rho=rho, irho=irho,
+                                     sigma=sigma, repeats=repeats, out=out)
+                else:
+                    calc = (self._partial_amplitude if self.reuse_matrices
+                            else reflamp)
+                    calc_r = calc(-calc_q/2, depth=w, rho=rho, irho=irho,
+                                  sigma=sigma, out=out)
             if False and numpy.isnan(calc_r).any():
                 print("w",w)
                 print("rho",rho)
@@ -377,6 +494,178 @@ class Experiment(ExperimentBase):
             #if numpy.isnan(calc_r).any(): print("calc_r contains NaN")
         return self._cache[key]
 
+    def _measured_xs(self):
+        """
+        Return flags for the measured cross sections, or None for all.
+
+        Cross sections missing from a polarized probe are neither computed
+        nor converted to reflectivity.
+        """
+        if not self.probe.polarized:
+            return None
+        return [xs is not None for xs in self.probe.xs]
+
+    def nllf_population(self, parameters, population):
+        """
+        Return -log(P(data|model)) for each parameter vector in *population*.
+
+        *parameters* is the list of fitted parameters and *population*
+        is an array with one row of parameter values for each member of
+        the population, such as the candidates proposed by DE or DREAM in
+        one generation.
+
+        The sample is still rendered separately for each member, but the
+        reflectivity for the entire population is computed in a single
+        call to the batched reflectivity kernel.  Magnetic and polarized
+        models, models with repeated stacks or with a separate profile for
+        each wavelength, and populations in which the calculation points
+        change (e.g., when fitting *theta_offset*) are evaluated one member
+        at a time.  The batched kernel shares the layers which are the same
+        in every member, so *reuse_matrices* is not needed and is ignored.
+
+        The parameter values in place before the call are restored on
+        return.
+        """
+        saved = [p.value for p in parameters]
+        try:
+            if self.sample.ismagnetic or self.probe.polarized:
+                return self._nllf_serial(parameters, population)
+
+            # Render the slabs for each member of the population
+            calc_q, slabs = None, []
+            for point in population:
+                for p, v in zip(parameters, point):
+                    p.value = v
+                self.update()
+                q = self.probe.calc_Q
+                if calc_q is None:
+                    calc_q = q
+                elif len(q) != len(calc_q) or (q != calc_q).any():
+                    return self._nllf_serial(parameters, population)
+                S = self._render_slabs()
+                if len(S.repeats()) or len(S.rho) > 1:
+                    return self._nllf_serial(parameters, population)
+                slabs.append((S.w.copy(), S.sigma.copy(),
+                              S.rho[0].copy(), S.irho[0].copy()))
+            if not slabs:
+                return numpy.zeros(0)
+
+            # Compute reflectivity for the entire population at once
+            w, sigma, rho, irho = zip(*slabs)
+            calc_r = reflamp_batch(-calc_q/2, depth=w, rho=rho, irho=irho,
+                                   sigma=sigma)
+
+            # Apply beam properties for each member
+            nllf = numpy.empty(len(slabs))
+            no_data = self.probe.R is None
+            for k, point in enumerate(population):
+                if no_data:
+                    nllf[k] = 0.
+                    continue
+                for p, v in zip(parameters, point):
+                    p.value = v
+                R = _amplitude_to_magnitude(calc_r[k], ismagnetic=False,
+                                            polarized=False)
+                _, R = self.probe.apply_beam(calc_q, R)
+                resid = (self.probe.R - R)/self.probe.dR
+                nllf[k] = 0.5*numpy.sum(resid**2)
+            return nllf
+        finally:
+            for p, v in zip(parameters, saved):
+                p.value = v
+            self.update()
+
+    def _nllf_serial(self, parameters, population):
+        nllf = numpy.empty(len(population))
+        for k, point in enumerate(population):
+            for p, v in zip(parameters, point):
+                p.value = v
+            self.update()
+            nllf[k] = self.nllf()
+        return nllf
+
+    def jacobian(self, parameters=None, step=1e-6):
+        """
+        Return the derivative of the residuals with respect to *parameters*.
+
+        *parameters* defaults to the fitted parameters of the model.  The
+        result has one row for each residual and one column for each
+        parameter.
+
+        The reflectivity and its derivatives with respect to the thickness,
+        roughness and scattering length density of every slab come from a
+        single call to :func:`refl1d.reflectivity.reflectivity_jacobian`.
+        The change in the slabs for each parameter is found by rendering
+        the sample with the parameter shifted by *step* times its value,
+        and the chain rule then gives the change in reflectivity without
+        computing the reflectivity again.  Since the rendered slabs are
+        linear in the thickness, interface and SLD parameters of
+        :class:`refl1d.model.Slab` layers, the derivatives for these are
+        exact.  The beam intensity and background are handled directly.
+
+        Parameters which change the probe, or which change the number of
+        slabs, as can happen when the profile is contracted, are computed
+        numerically, as are all the parameters of magnetic and polarized
+        models.
+        """
+        if parameters is None:
+            parameters = _fitted_parameters(self)
+        if self.ismagnetic or self.probe.polarized:
+            return ExperimentBase.jacobian(self, parameters, step=step)
+
+        self.update()
+        theory = self.reflectivity()[1]
+        J = numpy.empty((len(self.residuals()), len(parameters)))
+        if len(J) == 0:
+            return J
+        probe = self.probe
+        calc_q = probe.calc_Q
+        base = self._render_slabs()
+        slabs = [numpy.array(v, 'd') for v in (base.w, base.sigma,
+                                               base.rho[0], base.irho[0])]
+        r, dr_w, dr_sigma, dr_rho, dr_irho = reflamp_jacobian(
+            -calc_q/2, depth=slabs[0], sigma=slabs[1],
+            rho=slabs[2], irho=slabs[3])
+        dR = [2*(r.conj()*dr).real for dr in (dr_w, dr_sigma, dr_rho, dr_irho)]
+        offset = probe.apply_beam(calc_q, numpy.zeros_like(calc_q))[1]
+
+        beam = [id(p) for p in parameter.unique(probe.parameters())]
+        numeric = []
+        for k, p in enumerate(parameters):
+            if p is probe.background:
+                J[:, k] = -1/probe.dR
+                continue
+            elif p is probe.intensity and p.value != 0:
+                J[:, k] = -(theory - offset)/p.value/probe.dR
+                continue
+            elif id(p) in beam:
+                numeric.append(k)
+                continue
+
+            # Change in the slabs for a step in the parameter.
+            value = p.value
+            h = _step(p, step)
+            try:
+                p.value = value + h
+                self.update()
+                S = self._render_slabs()
+                shifted = (S.w, S.sigma, S.rho[0], S.irho[0])
+                same = all(len(a) == len(b) for a, b in zip(slabs, shifted))
+                if same:
+                    dRdp = sum(numpy.dot((b - a)/h, dRdx)
+                               for a, b, dRdx in zip(slabs, shifted, dR))
+            finally:
+                p.value = value
+                self.update()
+            if not same:
+                numeric.append(k)
+                continue
+            dtheory = probe.apply_beam(calc_q, dRdp)[1] - offset
+            J[:, k] = -dtheory/probe.dR
+
+        _numeric_jacobian(self, parameters, numeric, J, step)
+        return J
+
     def amplitude(self, resolution=False):
         """
         Calculate reflectivity amplitude at the probe points.
@@ -399,9 +688,14 @@ class Experiment(ExperimentBase):
         key = ('reflectivity', resolution, interpolation)
         if key not in self._cache:
             Q, r = self._reflamp()
-            R = _amplitude_to_magnitude(r,
-                                        ismagnetic=self.ismagnetic,
-                                        polarized=self.probe.polarized)
+            ismagnetic, polarized = self.ismagnetic, self.probe.polarized
+            if not ismagnetic and not polarized:
+                R = self._workspace('calc_R', r.shape)
+            else:
+                R = None
+            R = _amplitude_to_magnitude(r, ismagnetic=ismagnetic,
+                                        polarized=polarized, out=R,
+                                        xs=self._measured_xs())
             res = self.probe.apply_beam(Q, R, resolution=resolution,
                                         interpolation=interpolation)
             self._cache[key] = res
@@ -575,6 +869,11 @@ class MixedExperiment(ExperimentBase):
         """
         total = sum(r.value for r in self.ratio)
         Qs,Rs = zip(*[p._reflamp() for p in self.parts])
+        # Cross sections which are not measured are not computed, but the
+        # parts are summed channel by channel so fill them with zeros.
+        Rs = [([(numpy.zeros_like(Qs[0], 'D') if xs is None else xs)
+                for xs in ri] if isinstance(ri, (list, tuple)) else ri)
+              for ri in Rs]
         if self.coherent == False:
             Rs = [numpy.asarray(ri)*numpy.sqrt(ratio_i.value/total)
               for ri,ratio_i in zip(Rs,self.ratio)]
@@ -664,15 +963,20 @@ class MixedExperiment(ExperimentBase):
     def penalty(self):
         return sum(s.penalty() for s in self.samples)
 
-def _polarized_nonmagnetic(r):
+def _polarized_nonmagnetic(r, xs=None):
     """Convert nonmagnetic data to polarized representation.
 
     Polarized non-magnetic data repeats the reflectivity in the non spin flip
-    channels and sets the spin flip channels to zero.
+    channels and sets the spin flip channels to zero.  If *xs* is given,
+    then only the flagged cross sections are returned, with None for the
+    others.
     """
     nsf = r
     sf = 0*r
-    return [nsf, sf, sf, nsf]
+    R = [nsf, sf, sf, nsf]
+    if xs is not None:
+        R = [(Ri if want else None) for Ri, want in zip(R, xs)]
+    return R
 
 def _nonpolarized_magnetic(R):
     """Convert magnetic reflectivity to unpolarized representation.
@@ -682,19 +986,106 @@ def _nonpolarized_magnetic(R):
     """
     return reduce(numpy.add, R)/2
 
-def _amplitude_to_magnitude(r, ismagnetic, polarized):
+def _amplitude_to_magnitude(r, ismagnetic, polarized, out=None, xs=None):
     """
     Compute the reflectivity magnitude
+
+    For unpolarized nonmagnetic data, *out* can be an array to hold
+    the result.  For polarized data, *xs* flags the cross sections to
+    compute, with None returned for the others.
     """
     if ismagnetic:
-        R = [abs(xs)**2 for xs in r]
+        if not polarized or xs is None:
+            xs = (True, True, True, True)
+        R = [(abs(ri)**2 if want and ri is not None else None)
+             for ri, want in zip(r, xs)]
         if not polarized: R = _nonpolarized_magnetic(R)
+    elif out is not None and not polarized:
+        R = numpy.abs(r, out=out)
+        R *= R
     else:
         R = abs(r)**2
-        if polarized: R = _polarized_nonmagnetic(R)
+        if polarized: R = _polarized_nonmagnetic(R, xs)
     return R
 
 
+def jacobian(problem, p=None, step=1e-6):
+    """
+    Return the derivative of the residuals of a fit problem with respect
+    to the fitted parameters at *p*, or at the current point if *p* is None.
+
+    This is a replacement for :func:`bumps.lsqerror.jacobian` which uses
+    the *jacobian* method of the models, so the derivatives for slab
+    parameters do not need a reflectivity calculation for each parameter.
+    It can be passed to :func:`bumps.lsqerror.jacobian_cov` to compute
+    the covariance of the fitted parameters.  Models without a *jacobian*
+    method are differentiated numerically.
+
+    The current point is preserved.
+    """
+    p_init = problem.getp()
+    try:
+        if p is not None:
+            problem.setp(p)
+        parameters = parameter.varying(
+            parameter.unique(problem.model_parameters()))
+        if hasattr(problem, 'weights'):
+            fits = list(zip(problem.weights, problem.models))
+        else:
+            fits = [(1, problem)]
+        blocks = []
+        for weight, fit in fits:
+            model = fit.fitness
+            if hasattr(model, 'jacobian'):
+                J = model.jacobian(parameters, step=step)
+            else:
+                model.update()
+                J = numpy.empty((len(model.residuals()), len(parameters)))
+                _numeric_jacobian(model, parameters, range(len(parameters)),
+                                  J, step)
+            blocks.append(weight*J)
+        return numpy.vstack(blocks)
+    finally:
+        problem.setp(p_init)
+
+
+def _fitted_parameters(model):
+    return parameter.varying(parameter.unique(model.parameters()))
+
+
+def _step(p, step):
+    """
+    Return the numerical derivative step for parameter *p*, stepping back
+    if the forward step is outside the parameter bounds.
+    """
+    h = abs(p.value)*step if p.value != 0 else step
+    if p.value + h > p.bounds.limits[1]:
+        h = -h
+    return h
+
+
+def _numeric_jacobian(model, parameters, columns, J, step):
+    """
+    Fill *columns* of *J* with the forward difference derivative of the
+    model residuals with respect to the corresponding *parameters*.
+    The model must be up to date on entry, and is left up to date.
+    """
+    if not len(columns):
+        return
+    base = model.residuals().copy()
+    for k in columns:
+        p = parameters[k]
+        value = p.value
+        h = _step(p, step)
+        try:
+            p.value = value + h
+            model.update()
+            J[:, k] = (model.residuals() - base)/h
+        finally:
+            p.value = value
+            model.update()
+
+
 def nice(v, digits = 2):
     """Fix v to a value with a given number of digits of precision"""
     if v == 0.: return v
@@ -702,3 +1093,29 @@ def nice(v, digits = 2):
     place = floor(log10(abs(v)))
     scale = 10**(place-(digits-1))
     return sign*floor(abs(v)/scale+0.5)*scale
+
+
+def test_jacobian():
+    from .names import silicon, air, SLD, NeutronProbe
+    probe = NeutronProbe(T=numpy.linspace(0.1, 4, 100), dT=0.02,
+                         L=4.75, dL=0.02, background=1e-6)
+    film, cap = SLD("film", rho=4, irho=0.01), SLD("cap", rho=1)
+    sample = silicon(0, 4) | film(80, 5) | cap(30, 3) | air
+    M = Experiment(sample=sample, probe=probe)
+    probe.simulate_data(M.reflectivity(), noise=2)
+    parameters = [sample[1].thickness, sample[1].interface, film.rho,
+                  film.irho, sample[2].thickness, probe.intensity,
+                  probe.background, probe.theta_offset]
+    J = M.jacobian(parameters)
+    for k, p in enumerate(parameters):
+        value, h = p.value, 1e-6*abs(p.value) if p.value != 0 else 1e-6
+        p.value = value + h
+        M.update()
+        rp = M.residuals().copy()
+        p.value = value - h
+        M.update()
+        rm = M.residuals().copy()
+        p.value = value
+        M.update()
+        dr = (rp - rm)/(2*h)
+        assert numpy.allclose(J[:, k], dr, rtol=1e-4, atol=1e-4*abs(dr).max())
@@ -28,6 +28,7 @@ class FreeLayer(Layer):
     Layers have a slope of zero at the ends, so the automatically blend
     with slabs.
     """
+    cache_render = True
     def __init__(self, thickness=0, left=None, right=None,
                  rho=[], irho=[], rhoz=[], irhoz=[], name="Freeform"):
         self.name = name
@@ -77,6 +78,7 @@ class FreeformInterface01(Layer):
     Layers have a slope of zero at the ends, so the automatically blend
     with slabs.
     """
+    cache_render = True
     def __init__(self, thickness=0, interface=0,
                  below=None, above=None,
                  z=None, vf=None, name="Interface"):
@@ -121,6 +123,7 @@ class FreeInterface(Layer):
     Layers have a slope of zero at the ends, so the automatically blend
     with slabs.
     """
+    cache_render = True
     def __init__(self, interface=0,
                  below=None, above=None,
                  dz=None, dp=None, name="Interface"):
@@ -132,6 +132,7 @@ from .resolution import QL2T
 from .resolution import bins, binwidths, binedges
 from .resolution import slit_widths, divergence
 from .probe import make_probe, PolarizedNeutronProbe
+from .datacache import cached_parse
 
 
 class Monochromatic(object):
@@ -755,7 +756,7 @@ class GenericMonochromatic(Monochromatic):
 
         """
         # Load the data
-        data = numpy.loadtxt(filename).T
+        data = cached_parse(numpy.loadtxt, filename).T
         if data.shape[0] == 2:
             Q,R = data
             dR = None
@@ -783,7 +784,7 @@ class GenericPulsed(Pulsed):
         angular divergence.
         """
         # Load the data
-        data = numpy.loadtxt(filename).T
+        data = cached_parse(numpy.loadtxt, filename).T
         Q,dQ,R,dR,L = data
         dL = binwidths(L)
         T = kw.pop('T',QL2T(Q,L))
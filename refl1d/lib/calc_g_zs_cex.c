@@ -104,6 +104,63 @@ PyObject *Pcalc_g_zs_uniform(PyObject *self, PyObject *args)
     Py_RETURN_NONE;
 }
 
+// Derivative of G(z,s) in the direction which changes log(g_z) by w_z and
+// c_i by dc_i.  The first column of dg_zs is defined outside this function.
+PyObject *Pcalc_g_zs_jvp(PyObject *self, PyObject *args)
+{
+    PyArrayObject *g_z_pao, *w_pao, *dc_i_pao, *g_zs_pao, *dg_zs_pao;
+    double lambda_0, lambda_1, dcval;
+    double *g_z, *w, *dc_i, *g_zs, *dg_zs;
+    Py_ssize_t segments, layers, r, z, i;
+    
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!ddnn",
+                            &PyArray_Type,&g_z_pao,
+                            &PyArray_Type,&w_pao,
+                            &PyArray_Type,&dc_i_pao,
+                            &PyArray_Type,&g_zs_pao,
+                            &PyArray_Type,&dg_zs_pao,
+                            &lambda_0,
+                            &lambda_1,
+                            &layers,
+                            &segments))
+    {return NULL;}
+
+    g_z=(double *) PyArray_DATA(g_z_pao);
+    w=(double *) PyArray_DATA(w_pao);
+    dc_i=(double *) PyArray_DATA(dc_i_pao);
+    g_zs=(double *) PyArray_DATA(g_zs_pao);
+    dg_zs=(double *) PyArray_DATA(dg_zs_pao);
+
+    for (r=1; r<segments; ++r) {
+        dcval = dc_i[segments-r-1];
+        i = layers*(r-1);
+
+        dg_zs[i+layers] = w[0] * g_zs[i+layers] + g_z[0] * (
+            dg_zs[i] * lambda_0
+            + dg_zs[1+i] * lambda_1
+            + dcval
+        );
+
+        for (z=1; z<(layers-1); ++z) {
+            dg_zs[z+i+layers] = w[z] * g_zs[z+i+layers] + g_z[z] * (
+                dg_zs[z+i-1] * lambda_1
+                + dg_zs[z+i] * lambda_0
+                + dg_zs[z+i+1] * lambda_1
+                + dcval
+            );
+        }
+
+        dg_zs[z+i+layers] = w[z] * g_zs[z+i+layers] + g_z[z] * (
+            dg_zs[z+i] * lambda_0
+            + dg_zs[z+i-1] * lambda_1
+            + dcval
+        );
+
+    }   
+
+    Py_RETURN_NONE;
+}
+
 // enhanced with pointer magic for a 20% speed decrease?!
 PyObject *Pcalc_g_zs_pointers(PyObject *self, PyObject *args)
 {
@@ -189,6 +246,9 @@ static PyMethodDef calc_g_zs_cex_methods[] =
     {"_calc_g_zs_uniform", Pcalc_g_zs_uniform, METH_VARARGS, 
     "_calc_g_zs_uniform(g_z,g_zs,lambda_0,lambda_1,layers,segments): calculate G(z,s) for uniform chains"
     },
+    {"_calc_g_zs_jvp", Pcalc_g_zs_jvp, METH_VARARGS, 
+    "_calc_g_zs_jvp(g_z,w,dc_i,g_zs,dg_zs,lambda_0,lambda_1,layers,segments): calculate the derivative of G(z,s)"
+    },
     {"_calc_g_zs_pointers", Pcalc_g_zs_pointers, METH_VARARGS, 
     "_calc_g_zs_pointers(g_z,c_i,g_zs,lambda_0,lambda_1,layers,segments): calculate G(z,s) using pointer tricks"
     },
@@ -1,6 +1,7 @@
 // This program is public domain.
 
 #include <iostream>
+#include <vector>
 
 #define GREEDY
 #define _USE_MATH_DEFINES
@@ -196,6 +197,246 @@ contract_mag(int n, double d[],
   return newi;
 }
 
+/* Joint contraction of nL wavelength columns, with rho[k*n+i] the value
+ * for slab i in column k.  The slice is added to the current layer only
+ * if the box area condition holds in every column, with dA[k] as the
+ * tolerance for column k.  The L1 error in each column, sum |v - v_avg| d
+ * over rho and irho, is accumulated in err[k].  If Q > 0, the error in
+ * each merged layer of thickness D is scaled by min(1, Q D/2), which
+ * bounds the change in the kinematic reflection amplitude at Q and below
+ * since the change in the profile averages to zero over the layer.
+ */
+static inline double
+layer_factor(double Q, double dz, int last)
+{
+  return (last || Q <= 0. || Q*dz/2. >= 1.) ? 1. : Q*dz/2.;
+}
+
+extern "C"
+int
+contract_by_area_multi(int n, int nL, double d[], double sigma[],
+                       double rho[], double irho[],
+                       const double dA[], double Q, double err[])
+{
+  std::vector<double> rholo(nL), rhohi(nL), irholo(nL), irhohi(nL);
+  double dz;
+  int i, k, j, start, newi;
+  for (k=0; k < nL; k++) err[k] = 0.;
+  i=newi=1; /* Skip the substrate */
+  while (i < n) {
+
+    /* Get ready for the next layer */
+    start = i;
+    dz = 0.;
+    for (k=0; k < nL; k++) {
+      rholo[k]=rhohi[k]=rho[k*n+i];
+      irholo[k]=irhohi[k]=irho[k*n+i];
+    }
+
+    /* Accumulate slices into layer */
+    for (;;) {
+      assert(i < n);
+      dz += d[i];
+
+      /* If no more slices or sigma != 0, break immediately */
+      if (++i == n || sigma[i-1] != 0.) break;
+
+      /* If next slice won't fit in any column, break */
+      for (k=0; k < nL; k++) {
+        const double r = rho[k*n+i], ir = irho[k*n+i];
+        if (r < rholo[k]) rholo[k] = r;
+        if (r > rhohi[k]) rhohi[k] = r;
+        if (ir < irholo[k]) irholo[k] = ir;
+        if (ir > irhohi[k]) irhohi[k] = ir;
+        if ((rhohi[k]-rholo[k])*(dz+d[i]) > dA[k]
+            || (irhohi[k]-irholo[k])*(dz+d[i]) > dA[k]) break;
+      }
+      if (k < nL) break;
+    }
+
+    /* Save the layer, with the last layer using the surface values and
+     * the middle layers using the average values. */
+    assert(newi < n);
+    for (k=0; k < nL; k++) {
+      double *r = rho + k*n, *ir = irho + k*n;
+      double rhoavg, irhoavg;
+      if (i == n) {
+        rhoavg = r[n-1];
+        irhoavg = ir[n-1];
+      } else {
+        double rhoarea = 0., irhoarea = 0.;
+        for (j=start; j < i; j++) {
+          rhoarea += d[j]*r[j];
+          irhoarea += d[j]*ir[j];
+        }
+        rhoavg = rhoarea / dz;
+        irhoavg = irhoarea / dz;
+      }
+      double layer_err = 0.;
+      for (j=start; j < i; j++) {
+        layer_err += d[j]*(fabs(r[j]-rhoavg) + fabs(ir[j]-irhoavg));
+      }
+      err[k] += layer_err*layer_factor(Q, dz, i == n);
+      r[newi] = rhoavg;
+      ir[newi] = irhoavg;
+    }
+    d[newi] = dz;
+    if (i < n) sigma[newi] = sigma[i-1];
+    newi++;
+  }
+
+  return newi;
+}
+
+/* Joint contraction of nL wavelength columns for magnetic profiles.
+ * As for contract_by_area_multi, with dA[nL] and err[nL] for the
+ * magnetism.  If Q is zero, slices are merged as in contract_mag, with
+ * the range of the in-plane magnetism rhoM cos(thetaM) checked over the
+ * slices already in the layer, so a single column gives the same slabs
+ * as contract_mag.  If Q > 0, the range of both components of the
+ * magnetization rhoM (cos(thetaM), sin(thetaM)) is checked including the
+ * next slice, and each merged layer takes the average magnetization
+ * vector, so that the error bound in err[nL] holds.  The error is the
+ * L1 norm of the change in the magnetization vector.
+ */
+extern "C"
+int
+contract_mag_multi(int n, int nL, double d[],
+                   double rho[], double irho[],
+                   double rhoM[], double thetaM[],
+                   const double dA[], double Q, double err[])
+{
+  std::vector<double> rholo(nL), rhohi(nL), irholo(nL), irhohi(nL);
+  const int bounded = (Q > 0.);
+  double dz, weighted_dz, weight, maglo, maghi, mag;
+  double mxlo, mxhi, mylo, myhi, mx, my;
+  int i, k, j, start, newi;
+  for (k=0; k <= nL; k++) err[k] = 0.;
+  i=newi=1; /* Skip the substrate */
+  while (i < n) {
+
+    /* Get ready for the next layer */
+    start = i;
+    dz = 0.;
+    for (k=0; k < nL; k++) {
+      rholo[k]=rhohi[k]=rho[k*n+i];
+      irholo[k]=irhohi[k]=irho[k*n+i];
+    }
+    maglo=maghi=rhoM[i]*cos(thetaM[i]*M_PI/180.);
+    mxlo=mxhi=maglo;
+    mylo=myhi=rhoM[i]*sin(thetaM[i]*M_PI/180.);
+
+    /* Accumulate slices into layer */
+    for (;;) {
+      assert(i < n);
+      dz += d[i];
+      if (!bounded) {
+        mag = rhoM[i]*cos(thetaM[i]*M_PI/180.);
+        if (mag < maglo) maglo = mag;
+        if (mag > maghi) maghi = mag;
+      }
+
+      /* If no more slices break immediately */
+      if (++i == n) break;
+
+      /* If next slice exceeds limit then break */
+      for (k=0; k < nL; k++) {
+        const double r = rho[k*n+i], ir = irho[k*n+i];
+        if (r < rholo[k]) rholo[k] = r;
+        if (r > rhohi[k]) rhohi[k] = r;
+        if (ir < irholo[k]) irholo[k] = ir;
+        if (ir > irhohi[k]) irhohi[k] = ir;
+        if ((rhohi[k]-rholo[k])*(dz+d[i]) > dA[k]
+            || (irhohi[k]-irholo[k])*(dz+d[i]) > dA[k]) break;
+      }
+      if (k < nL) break;
+      if (bounded) {
+        mx = rhoM[i]*cos(thetaM[i]*M_PI/180.);
+        my = rhoM[i]*sin(thetaM[i]*M_PI/180.);
+        if (mx < mxlo) mxlo = mx;
+        if (mx > mxhi) mxhi = mx;
+        if (my < mylo) mylo = my;
+        if (my > myhi) myhi = my;
+        if ((mxhi-mxlo)*(dz+d[i]) > dA[nL]
+            || (myhi-mylo)*(dz+d[i]) > dA[nL]) break;
+      } else {
+        if ((maghi-maglo)*(dz+d[i]) > dA[nL]) break;
+      }
+    }
+
+    /* Save the layer */
+    assert(newi < n);
+    for (k=0; k < nL; k++) {
+      double *r = rho + k*n, *ir = irho + k*n;
+      double rhoavg, irhoavg;
+      if (i == n) {
+        rhoavg = r[n-1];
+        irhoavg = ir[n-1];
+      } else {
+        double rhoarea = 0., irhoarea = 0.;
+        for (j=start; j < i; j++) {
+          rhoarea += d[j]*r[j];
+          irhoarea += d[j]*ir[j];
+        }
+        rhoavg = rhoarea / dz;
+        irhoavg = irhoarea / dz;
+      }
+      double layer_err = 0.;
+      for (j=start; j < i; j++) {
+        layer_err += d[j]*(fabs(r[j]-rhoavg) + fabs(ir[j]-irhoavg));
+      }
+      err[k] += layer_err*layer_factor(Q, dz, i == n);
+      r[newi] = rhoavg;
+      ir[newi] = irhoavg;
+    }
+
+    double rhoMavg, thetaMavg;
+    if (i == n) {
+      rhoMavg = rhoM[n-1];
+      thetaMavg = thetaM[n-1];
+    } else if (bounded) {
+      /* Average magnetization vector */
+      double mxarea = 0., myarea = 0.;
+      for (j=start; j < i; j++) {
+        mxarea += d[j]*rhoM[j]*cos(thetaM[j]*M_PI/180.);
+        myarea += d[j]*rhoM[j]*sin(thetaM[j]*M_PI/180.);
+      }
+      rhoMavg = hypot(mxarea, myarea) / dz;
+      thetaMavg = (rhoMavg > 0. ? atan2(myarea, mxarea)*180./M_PI
+                   : thetaM[start]);
+      if (thetaMavg < 0.) thetaMavg += 360.;
+    } else {
+      /* Weight the magnetic signal by the in-plane contribution
+       * when accumulating rhoM and thetaM. */
+      double rhoMarea = 0., thetaMarea = 0.;
+      weighted_dz = 0.;
+      for (j=start; j < i; j++) {
+        weight = cos(thetaM[j]*M_PI/180.);
+        rhoMarea += d[j]*rhoM[j]*weight;
+        thetaMarea += d[j]*thetaM[j]*weight;
+        weighted_dz += d[j]*weight;
+      }
+      rhoMavg = rhoMarea / weighted_dz;
+      thetaMavg = thetaMarea / weighted_dz;
+    }
+    mx = rhoMavg*cos(thetaMavg*M_PI/180.);
+    my = rhoMavg*sin(thetaMavg*M_PI/180.);
+    double mag_err = 0.;
+    for (j=start; j < i; j++) {
+      mag_err += d[j]*hypot(rhoM[j]*cos(thetaM[j]*M_PI/180.) - mx,
+                            rhoM[j]*sin(thetaM[j]*M_PI/180.) - my);
+    }
+    /* Only the average vector leaves a change with zero mean */
+    err[nL] += mag_err*(bounded ? layer_factor(Q, dz, i == n) : 1.);
+    rhoM[newi] = rhoMavg;
+    thetaM[newi] = thetaMavg;
+    d[newi] = dz;
+    newi++;
+  }
+
+  return newi;
+}
+
 #else
 #error "dynamic programming solution not yet implemented"
 // A correct solution will have to incorporate forced breaks at sigma != 0,
@@ -266,3 +266,108 @@ convolve(size_t Nin, const double xin[], const double yin[],
   }
 
 }
+
+/* Resolution matrix for convolve().
+
+The convolution computed by convolve() is linear in yin, so it can be
+written as y = W yin for a sparse matrix W which depends only on xin,
+x and dx.  This function returns W in compressed sparse row form, with
+the weights for y[out] stored in data[indptr[out]:indptr[out+1]] and
+the corresponding columns of yin in indices[indptr[out]:indptr[out+1]].
+
+If indices or data is NULL then only indptr is filled in, and the
+number of nonzeros indptr[Nout] is returned so that the caller can
+allocate space for a second call.
+*/
+size_t
+convolve_matrix(size_t Nin, const double xin[],
+                size_t Nout, const double x[], const double dx[],
+                int indptr[], int indices[], double data[])
+{
+  size_t in,out,nnz;
+
+  assert(Nin>1);
+
+  in = 0;
+  nnz = 0;
+  indptr[0] = 0;
+  for (out=0; out < Nout; out++) {
+    const double sigma = dx[out];
+    const double xo = x[out];
+    const double limit = sqrt(-2.*sigma*sigma* LOG_RESLIMIT);
+    size_t k, first;
+
+    /* Same window as convolve() */
+    while (in < Nin-1 && xin[in] < xo-limit) in++;
+    while (in > 0 && xin[in] > xo-limit) in--;
+
+    if (sigma > 0.) {
+      const double two_sigma_sq = 2. * sigma * sigma;
+      double z, Glo, erflo, erfmin, scale, *w;
+      size_t last, width;
+
+      /* Find the end of the window, as in convolve_point() */
+      last = in;
+      while (++last < Nin) if (xin[last] >= xo+limit) break;
+      if (last == Nin) last = Nin-1;
+      first = in;
+      width = last - first + 1;
+      nnz += width;
+      indptr[out+1] = (int)nnz;
+      if (indices == NULL || data == NULL) continue;
+
+      /* Collect the weights of yin[k-1] and yin[k] from each segment
+       * of the analytic convolution of the gaussian with a linear spline.
+       * In convolve_point() the segment contributes
+       *    0.5*(m*xo+b)*(erfhi-erflo) - sigma/SQRT2PI*m*(Ghi-Glo)
+       * where m*xo+b = yin[k] + (yin[k]-yin[k-1])*(xo-xin[k])/step.
+       */
+      w = data + indptr[out];
+      for (k=first; k <= last; k++) {
+        indices[indptr[out] + k - first] = (int)k;
+        w[k-first] = 0.;
+      }
+      k = first;
+      z = xo - xin[k];
+      Glo = exp(-z*z/two_sigma_sq);
+      erfmin = erflo = erf(-z/(SQRT2*sigma));
+      while (++k < Nin) if (xin[k] != xin[k-1]) {
+        const double zhi = xo - xin[k];
+        const double Ghi = exp(-zhi*zhi/two_sigma_sq);
+        const double erfhi = erf(-zhi/(SQRT2*sigma));
+        const double step = xin[k]-xin[k-1];
+        const double dE = 0.5*(erfhi-erflo);
+        const double dG = sigma/SQRT2PI*(Ghi-Glo)/step;
+        const double t = (xo-xin[k])/step;
+
+        w[k-first] += dE*(1.+t) - dG;
+        w[k-1-first] += -dE*t + dG;
+
+        Glo = Ghi;
+        erflo = erfhi;
+        if (xin[k] >= xo+limit) break;
+      }
+#ifdef USE_TRUNCATED_NORMALIZATION
+      scale = 2./(erflo - erfmin);
+#else
+      scale = 1.;
+#endif
+      for (k=0; k < width; k++) w[k] *= scale;
+
+    } else {
+      /* Linear interpolation or extrapolation through two points */
+      first = (in < Nin-1 ? in : in-1);
+      nnz += 2;
+      indptr[out+1] = (int)nnz;
+      if (indices == NULL || data == NULL) continue;
+      {
+        const double t = (xo-xin[first])/(xin[first+1]-xin[first]);
+        indices[nnz-2] = (int)first;
+        indices[nnz-1] = (int)first+1;
+        data[nnz-2] = 1.-t;
+        data[nnz-1] = t;
+      }
+    }
+  }
+  return nnz;
+}
@@ -6,6 +6,7 @@
 #include <cstdlib>
 #include <cmath>
 #include <limits>
+#include <vector>
 #include "reflcalc.h"
 
 #define MINIMAL_RHO_M 1e-2  // in units of 1e-6/A^2
@@ -249,7 +250,7 @@ C * Converted to subroutine from GEPORE.f
         S3L = S3LP; //
         GL = GLP;
         BL = BLP;
-        S1LP = -sqrt(Cplx(PI4*(RHO[LP]+RHOM[LP])-E0, -PI4*(fabs(IRHO[L])+EPS)));
+        S1LP = -sqrt(Cplx(PI4*(RHO[LP]+RHOM[LP])-E0, -PI4*(fabs(IRHO[LP])+EPS)));
         S3LP = -sqrt(Cplx(PI4*(RHO[LP]-RHOM[LP])-E0, -PI4*(fabs(IRHO[LP])+EPS)));
         if (abs(U1[LP]) <= 1.0) {
             // then Bz >= 0
@@ -364,6 +365,216 @@ C * Converted to subroutine from GEPORE.f
 
 }
 
+// The fused kernel below computes the same transfer matrix as Cr4xa, but
+// for both incident polarizations at once and with the terms which do not
+// depend on KZ computed once for all KZ.
+//
+// For each layer, the potentials PI4*(RHO +/- RHOM) are stored with S1 and
+// S3 already swapped when Bz < 0, along with the B and G values for the
+// layer.  For each interface, the DELTA terms are stored for the beam
+// travelling both forward (L -> L+1) and backward (L -> L-1) through the
+// stack.  The layer potentials depend on the column of RHO, so there is
+// one set for each column used by rho_index.
+struct MagneticInterface {
+  Cplx DELTA, DBB, DBG, DGB, DGG;
+};
+
+struct MagneticLayers {
+  int N;
+  std::vector<double> V1, V3, VI; // per column, per layer
+  std::vector<Cplx> B, G;         // per layer
+  std::vector<MagneticInterface> forward, backward; // indexed by LP
+};
+
+static void
+magnetic_layers(const int N, const int columns,
+                const double RHO[], const double IRHO[],
+                const double RHOM[], const Cplx U1[], const Cplx U3[],
+                MagneticLayers &layers)
+{
+  const double PI4=12.566370614359172e-6;
+  layers.N = N;
+  layers.V1.resize(N*columns);
+  layers.V3.resize(N*columns);
+  layers.VI.resize(N*columns);
+  layers.B.resize(N);
+  layers.G.resize(N);
+  layers.forward.resize(N);
+  layers.backward.resize(N);
+  for (int L=0; L < N; L++) {
+    const bool flip = !(abs(U1[L]) <= 1.0); // Bz < 0: swap S1 and S3
+    layers.B[L] = flip ? U3[L] : U1[L];
+    layers.G[L] = flip ? 1.0/U1[L] : 1.0/U3[L];
+    for (int k=0; k < columns; k++) {
+      const int j = k*N + L;
+      const double plus = PI4*(RHO[j]+RHOM[L]);
+      const double minus = PI4*(RHO[j]-RHOM[L]);
+      layers.V1[j] = flip ? minus : plus;
+      layers.V3[j] = flip ? plus : minus;
+      layers.VI[j] = -PI4*(fabs(IRHO[j])+EPS);
+    }
+  }
+  for (int LP=0; LP < N; LP++) {
+    const Cplx DELTA = 0.5 / (1.0 - (layers.B[LP]*layers.G[LP]));
+    for (int STEP=-1; STEP <= 1; STEP += 2) {
+      const int L = LP - STEP;
+      MagneticInterface &t = (STEP > 0 ? layers.forward[LP]
+                              : layers.backward[LP]);
+      t.DELTA = DELTA;
+      if (L < 0 || L >= N) continue;
+      const Cplx BL = layers.B[L], GL = layers.G[L];
+      const Cplx BLP = layers.B[LP], GLP = layers.G[LP];
+      t.DBB = (BL - BLP) * DELTA;
+      t.DBG = (1.0 - BL*GLP) * DELTA;
+      t.DGB = (1.0 - GL*BLP) * DELTA;
+      t.DGG = (GL - GLP) * DELTA;
+    }
+  }
+}
+
+// Transfer matrix state for one incident polarization.
+struct MagneticPass {
+  double E0;
+  Cplx S1LP, S3LP;
+  Cplx B[4][4];
+};
+
+static inline void
+magnetic_front(const MagneticLayers &layers, const int offset,
+               const int L, const int LP, MagneticPass &p)
+{
+  const MagneticInterface &t = (LP > L ? layers.forward[LP]
+                                : layers.backward[LP]);
+  const Cplx S1L = -sqrt(Cplx(layers.V1[offset+L]-p.E0, layers.VI[offset+L]));
+  const Cplx S3L = -sqrt(Cplx(layers.V3[offset+L]-p.E0, layers.VI[offset+L]));
+  p.S1LP = -sqrt(Cplx(layers.V1[offset+LP]-p.E0, layers.VI[offset+LP]));
+  p.S3LP = -sqrt(Cplx(layers.V3[offset+LP]-p.E0, layers.VI[offset+LP]));
+  const Cplx BLP = layers.B[LP], GLP = layers.G[LP];
+  const Cplx DELTA = t.DELTA;
+
+  const Cplx FS1S1 = S1L/p.S1LP;
+  const Cplx FS1S3 = S1L/p.S3LP;
+  const Cplx FS3S1 = S3L/p.S1LP;
+  const Cplx FS3S3 = S3L/p.S3LP;
+
+  p.B[0][0] = DELTA *   1.0 * (1.0 + FS1S1);
+  p.B[0][1] = DELTA *   1.0 * (1.0 - FS1S1);
+  p.B[0][2] = DELTA *  -GLP * (1.0 + FS3S1);
+  p.B[0][3] = DELTA *  -GLP * (1.0 - FS3S1);
+
+  p.B[1][0] = DELTA *   1.0 * (1.0 - FS1S1);
+  p.B[1][1] = DELTA *   1.0 * (1.0 + FS1S1);
+  p.B[1][2] = DELTA *  -GLP * (1.0 - FS3S1);
+  p.B[1][3] = DELTA *  -GLP * (1.0 + FS3S1);
+
+  p.B[2][0] = DELTA *  -BLP * (1.0 + FS1S3);
+  p.B[2][1] = DELTA *  -BLP * (1.0 - FS1S3);
+  p.B[2][2] = DELTA *   1.0 * (1.0 + FS3S3);
+  p.B[2][3] = DELTA *   1.0 * (1.0 - FS3S3);
+
+  p.B[3][0] = DELTA *  -BLP * (1.0 - FS1S3);
+  p.B[3][1] = DELTA *  -BLP * (1.0 + FS1S3);
+  p.B[3][2] = DELTA *   1.0 * (1.0 - FS3S3);
+  p.B[3][3] = DELTA *   1.0 * (1.0 + FS3S3);
+}
+
+static inline void
+magnetic_interior(const MagneticLayers &layers, const int offset,
+                  const int L, const int LP, const Cplx Z, MagneticPass &p)
+{
+  const Cplx CR(1.0,0.0);
+  const MagneticInterface &t = (LP > L ? layers.forward[LP]
+                                : layers.backward[LP]);
+  const Cplx S1L = p.S1LP, S3L = p.S3LP; // copy from the layer before
+  p.S1LP = -sqrt(Cplx(layers.V1[offset+LP]-p.E0, layers.VI[offset+LP]));
+  p.S3LP = -sqrt(Cplx(layers.V3[offset+LP]-p.E0, layers.VI[offset+LP]));
+  const Cplx S1LP = p.S1LP, S3LP = p.S3LP;
+
+  const Cplx ES1L = exp(S1L*Z);
+  const Cplx ENS1L = CR / ES1L;
+  const Cplx ES1LP = exp(S1LP*Z);
+  const Cplx ENS1LP = CR / ES1LP;
+  const Cplx ES3L = exp(S3L*Z);
+  const Cplx ENS3L = CR / ES3L;
+  const Cplx ES3LP = exp(S3LP*Z);
+  const Cplx ENS3LP = CR / ES3LP;
+
+  const Cplx FS1S1 = S1L/S1LP;
+  const Cplx FS1S3 = S1L/S3LP;
+  const Cplx FS3S1 = S3L/S1LP;
+  const Cplx FS3S3 = S3L/S3LP;
+
+  Cplx A[4][4];
+  A[0][0] = A[1][1] = t.DBG * (1.0 + FS1S1);
+  A[0][0] *= ES1L * ENS1LP;
+  A[1][1] *= ENS1L * ES1LP;
+  A[0][1] = A[1][0] = t.DBG * (1.0 - FS1S1);
+  A[0][1] *= ENS1L * ENS1LP;
+  A[1][0] *= ES1L  * ES1LP;
+  A[0][2] = A[1][3] = t.DGG * (1.0 + FS3S1);
+  A[0][2] *= ES3L  * ENS1LP;
+  A[1][3] *= ENS3L * ES1LP;
+  A[0][3] = A[1][2] = t.DGG * (1.0 - FS3S1);
+  A[0][3] *= ENS3L * ENS1LP;
+  A[1][2] *= ES3L  * ES1LP;
+
+  A[2][0] = A[3][1] = t.DBB * (1.0 + FS1S3);
+  A[2][0] *= ES1L * ENS3LP;
+  A[3][1] *= ENS1L * ES3LP;
+  A[2][1] = A[3][0] = t.DBB * (1.0 - FS1S3);
+  A[2][1] *= ENS1L * ENS3LP;
+  A[3][0] *= ES1L  * ES3LP;
+  A[2][2] = A[3][3] = t.DGB * (1.0 + FS3S3);
+  A[2][2] *= ES3L * ENS3LP;
+  A[3][3] *= ENS3L * ES3LP;
+  A[2][3] = A[3][2] = t.DGB * (1.0 - FS3S3);
+  A[2][3] *= ENS3L * ENS3LP;
+  A[3][2] *= ES3L * ES3LP;
+
+//    Matrix update B=A*B
+  for (int j=0; j < 4; j++) {
+    const Cplx B0=p.B[0][j], B1=p.B[1][j], B2=p.B[2][j], B3=p.B[3][j];
+    for (int i=0; i < 4; i++) {
+      p.B[i][j] = A[i][0]*B0 + A[i][1]*B1 + A[i][2]*B2 + A[i][3]*B3;
+    }
+  }
+}
+
+// Compute the transfer matrix for npass polarizations of the incident
+// beam at KZ, with E0 for each pass already set.
+static void
+magnetic_matrix(const MagneticLayers &layers, const double D[],
+                const int offset, const double KZ,
+                const int npass, MagneticPass pass[])
+{
+  const int N = layers.N;
+  const int STEP = (KZ < 0. ? -1 : 1);
+  int L = (KZ < 0. ? N-1 : 0);
+  if (N <= 1) {
+    for (int k=0; k < npass; k++) {
+      for (int i=0; i < 4; i++)
+        for (int j=0; j < 4; j++) pass[k].B[i][j] = (i == j ? 1.0 : 0.0);
+    }
+    return;
+  }
+
+  Cplx Z = 0.0;
+  int LP = L + STEP;
+  for (int k=0; k < npass; k++) magnetic_front(layers, offset, L, LP, pass[k]);
+  Z += D[LP];
+  L = LP;
+
+//    Process the loop once for each interior layer, either from
+//    front to back or back to front.
+  for (int I=1; I < N-1; I++) {
+    LP = L + STEP;
+    for (int k=0; k < npass; k++)
+      magnetic_interior(layers, offset, L, LP, Z, pass[k]);
+    Z += D[LP];
+    L = LP;
+  }
+}
+
 extern "C" void
 magnetic_amplitude(const int layers,
                       const double d[], const double sigma[],
@@ -373,36 +584,73 @@ magnetic_amplitude(const int layers,
                       const int points, const double KZ[], const int rho_index[],
                       Cplx Ra[], Cplx Rb[], Cplx Rc[], Cplx Rd[])
 {
-  Cplx dummy1,dummy2;
-  int ip;
-  if (fabs(rhoM[0]) <= MINIMAL_RHO_M && fabs(rhoM[layers-1]) <= MINIMAL_RHO_M) {
-    ip = 1; // calculations for I+ and I- are the same in the fronting and backing.
-    #ifdef _OPENMP
-    #pragma omp parallel for
-    #endif
+  // Cross sections which are not needed are given as NULL.  The I+ pass
+  // yields Ra and Rb and the I- pass yields Rc and Rd, so a pass is
+  // skipped if neither of its cross sections is needed.  If the fronting
+  // and backing are nonmagnetic, the calculations for I+ and I- are the
+  // same and one pass yields all four.
+  const bool plus = (Ra != NULL || Rb != NULL);
+  const bool minus = (Rc != NULL || Rd != NULL);
+  const bool shared = (fabs(rhoM[0]) <= MINIMAL_RHO_M
+                       && fabs(rhoM[layers-1]) <= MINIMAL_RHO_M);
+  if (!plus && !minus) return;
+  const double PI4=12.566370614359172e-6;
+
+  int columns = 1;
+  if (rho_index != NULL) {
     for (int i=0; i < points; i++) {
-      const int offset = layers*(rho_index != NULL?rho_index[i]:0);
-      Cr4xa(layers,d,sigma,ip,rho+offset,irho+offset,rhoM,u1,u3,
-            Aguide,KZ[i],Ra[i],Rb[i],Rc[i],Rd[i]);
+      if (rho_index[i] >= columns) columns = rho_index[i]+1;
     }
-  } else {
-    ip = 1; // plus polarization
-    #ifdef _OPENMP
-    #pragma omp parallel for
-    #endif
-    for (int i=0; i < points; i++) {
-      const int offset = layers*(rho_index != NULL?rho_index[i]:0);
-      Cr4xa(layers,d,sigma,ip,rho+offset,irho+offset,rhoM,u1,u3,
-            Aguide,KZ[i],Ra[i],Rb[i],dummy1,dummy2);
+  }
+  MagneticLayers table;
+  magnetic_layers(layers, columns, rho, irho, rhoM, u1, u3, table);
+
+  #ifdef _OPENMP
+  #pragma omp parallel for
+  #endif
+  for (int i=0; i < points; i++) {
+    const double kz = KZ[i];
+    if (fabs(kz) < 1.e-10) {
+      if (Ra != NULL) Ra[i] = -1.;
+      if (Rb != NULL) Rb[i] = 0.;
+      if (Rc != NULL) Rc[i] = 0.;
+      if (Rd != NULL) Rd[i] = -1.;
+      continue;
     }
-    ip = -1; // minus polarization
-    #ifdef _OPENMP
-    #pragma omp parallel for
-    #endif
-    for (int i=0; i < points; i++) {
-      const int offset = layers*(rho_index != NULL?rho_index[i]:0);
-      Cr4xa(layers,d,sigma,ip,rho+offset,irho+offset,rhoM,u1,u3,
-            Aguide,KZ[i],dummy1,dummy2,Rc[i],Rd[i]);
+    const int offset = layers*(rho_index != NULL?rho_index[i]:0);
+    const int L = (kz < 0. ? layers-1 : 0);
+
+//    Changing the target KZ is equivalent to subtracting the fronting
+//    medium SLD.  Pass 0 is for I+ and pass 1 for I-, unless only the
+//    I- pass is needed.
+    MagneticPass pass[2];
+    int npass = 0;
+    if (plus || shared) {
+      pass[npass++].E0 = kz*kz + PI4*(rho[offset+L]+rhoM[L]);
+    }
+    if (minus && !shared) {
+      pass[npass++].E0 = kz*kz + PI4*(rho[offset+L]-rhoM[L]);
+    }
+    magnetic_matrix(table, d, offset, kz, npass, pass);
+
+//    Calculate reflectivity coefficients specified by POLSTAT
+    const MagneticPass &p = pass[0];
+    const MagneticPass &m = pass[npass-1];
+    if (Ra != NULL) {
+      Ra[i] = (p.B[1][3]*p.B[3][0]-p.B[1][0]*p.B[3][3])
+              / (p.B[3][3]*p.B[1][1]-p.B[1][3]*p.B[3][1]); // ++
+    }
+    if (Rb != NULL) {
+      Rb[i] = (p.B[1][0]*p.B[3][1]-p.B[3][0]*p.B[1][1])
+              / (p.B[3][3]*p.B[1][1]-p.B[1][3]*p.B[3][1]); // +-
+    }
+    if (Rc != NULL) {
+      Rc[i] = (m.B[1][3]*m.B[3][2]-m.B[1][2]*m.B[3][3])
+              / (m.B[3][3]*m.B[1][1]-m.B[1][3]*m.B[3][1]); // -+
+    }
+    if (Rd != NULL) {
+      Rd[i] = (m.B[1][2]*m.B[3][1]-m.B[3][2]*m.B[1][1])
+              / (m.B[3][3]*m.B[1][1]-m.B[1][3]*m.B[3][1]); // --
     }
   }
 }
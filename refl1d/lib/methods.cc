@@ -43,10 +43,10 @@ PyObject* Pmagnetic_amplitude(PyObject*obj,PyObject*args)
   INVECTOR(u3_obj,u3,nu3);
   INVECTOR(kz_obj,kz,nkz);
   INVECTOR(rho_index_obj, rho_index, nrho_index);
-  OUTVECTOR(r1_obj,r1,nr1);
-  OUTVECTOR(r2_obj,r2,nr2);
-  OUTVECTOR(r3_obj,r3,nr3);
-  OUTVECTOR(r4_obj,r4,nr4);
+  OPTIONAL_OUTVECTOR(r1_obj,r1,nr1,nkz);
+  OPTIONAL_OUTVECTOR(r2_obj,r2,nr2,nkz);
+  OPTIONAL_OUTVECTOR(r3_obj,r3,nr3,nkz);
+  OPTIONAL_OUTVECTOR(r4_obj,r4,nr4,nkz);
   if (nd != nrho || nd != nirho || nd != nrhom || nd != nu1 || nd != nu3 || nd != nsigma+1) {
     //printf("%ld %ld %ld %ld %ld %ld\n",
     //    long(nd), long(nsigma), long(nrho), long(nirho), long(nrhom), long(nu1));
@@ -63,8 +63,10 @@ PyObject* Pmagnetic_amplitude(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   magnetic_amplitude((int)nd, d, sigma, rho, irho, rhom, u1, u3,
                      Aguide, (int)nkz, kz, rho_index, r1, r2, r3, r4);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
@@ -116,11 +118,264 @@ PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   reflectivity_amplitude((int)nd, d, sigma, rho, irho, (int)nkz, kz, rho_index, r);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
 
+PyObject* Preflectivity_amplitude_partial(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj,
+    *pre_obj,*post_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index, npre, npost;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index;
+  int nprofiles, lo, hi, update;
+  Cplx *r, *pre, *post;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOiiiOOO:reflectivity_partial",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj,&lo,&hi,&update,&pre_obj,&post_obj,&r_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  OUTVECTOR(pre_obj,pre,npre);
+  OUTVECTOR(post_obj,post,npost);
+  OUTVECTOR(r_obj,r,nr);
+
+  // Determine how many profiles we have
+  nprofiles = 1;
+  for (int i=0; i < nrho_index; i++)
+    if (rho_index[i] > nprofiles-1) nprofiles = rho_index[i]+1;
+
+  // interfaces should be one shorter than layers
+  if (nrho%nd != 0 || nirho%nd != 0 || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nrho < nd*nprofiles || nirho < nd*nprofiles) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+    return NULL;
+  }
+  if (nkz != nr || nrho_index != nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+  if (npre != 4*nkz || npost != 4*nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "pre,post should be 4 x len(kz)");
+#endif
+    return NULL;
+  }
+  // the incident medium changes every matrix so it cannot be in [lo,hi)
+  if (lo < 1 || hi > nd-1 || hi < lo) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "need 0 < lo <= hi < len(d)");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_partial((int)nd, d, sigma, rho, irho, (int)nkz, kz,
+                                 rho_index, lo, hi, update, pre, post, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+
+PyObject* Preflectivity_amplitude_repeat(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,*rho_index_obj,
+    *repeats_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, nrho_index, nrepeats;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *rho_index, *repeats;
+  int nprofiles, end;
+  Cplx *r;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOOO:reflectivity_repeat",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&rho_index_obj,&repeats_obj,&r_obj))
+    return NULL;
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  INVECTOR(rho_index_obj, rho_index, nrho_index);
+  INVECTOR(repeats_obj, repeats, nrepeats);
+  OUTVECTOR(r_obj,r,nr);
+
+  // Determine how many profiles we have
+  nprofiles = 1;
+  for (int i=0; i < nrho_index; i++)
+    if (rho_index[i] > nprofiles-1) nprofiles = rho_index[i]+1;
+
+  // interfaces should be one shorter than layers
+  if (nrho%nd != 0 || nirho%nd != 0 || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nrho < nd*nprofiles || nirho < nd*nprofiles) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "rho_index too high");
+#endif
+    return NULL;
+  }
+  if (nkz != nr || nrho_index != nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "kz,rho_index,r have different lengths");
+#endif
+    return NULL;
+  }
+  // blocks are sorted, disjoint and between the substrate and the surface
+  end = 1;
+  for (Py_ssize_t i=0; i+2 < nrepeats; i += 3) {
+    if (repeats[i] < end || repeats[i+1] < 1 || repeats[i+2] < 1
+        || repeats[i] + repeats[i+1]*repeats[i+2] > nd-1) {
+      end = -1;
+      break;
+    }
+    end = repeats[i] + repeats[i+1]*repeats[i+2];
+  }
+  if (nrepeats%3 != 0 || end < 0) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "repeats should be sorted (start,period,count) within 0 < layer < len(d)-1");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_repeat((int)nd, d, sigma, rho, irho, (int)nkz, kz,
+                                rho_index, (int)(nrepeats/3), repeats, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+
+PyObject* Preflectivity_amplitude_batch(PyObject*obj,PyObject*args)
+{
+  PyObject *offset_obj,*kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj;
+  Py_ssize_t noffset, nkz, nr, nd, nrho, nirho, nsigma;
+  const double *kz, *d, *sigma, *rho, *irho;
+  const int *offset;
+  Cplx *r;
+  int lo = 0, top = 0;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOO|ii:reflectivity_batch",
+      &offset_obj,&d_obj,&sigma_obj,&rho_obj,&irho_obj,
+      &kz_obj,&r_obj,&lo,&top))
+    return NULL;
+  INVECTOR(offset_obj,offset,noffset);
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  OUTVECTOR(r_obj,r,nr);
+
+  const Py_ssize_t nmodels = noffset-1;
+  if (nmodels < 1 || offset[0] != 0 || offset[nmodels] != nd) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "offset does not match the number of layers");
+#endif
+    return NULL;
+  }
+  for (Py_ssize_t m=0; m < nmodels; m++) {
+    if (offset[m+1] <= offset[m]) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "every model needs at least one layer");
+#endif
+      return NULL;
+    }
+  }
+  // each model has one fewer interface than layers
+  if (nrho != nd || nirho != nd || nd != nsigma+nmodels) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nr != nmodels*nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "r should have models x len(kz) entries");
+#endif
+    return NULL;
+  }
+  // the shared layers must include the incident media and not overlap
+  if (lo > 0 && top > 0) {
+    for (Py_ssize_t m=0; m < nmodels; m++) {
+      if (lo + top > offset[m+1] - offset[m]) {
+#ifndef BROKEN_EXCEPTIONS
+        PyErr_SetString(PyExc_ValueError, "shared layers overlap");
+#endif
+        return NULL;
+      }
+    }
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_amplitude_batch((int)nmodels, offset, d, sigma, rho, irho,
+                               lo, top, (int)nkz, kz, r);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+
+PyObject* Preflectivity_jacobian(PyObject*obj,PyObject*args)
+{
+  PyObject *kz_obj,*r_obj,*d_obj,*rho_obj,*irho_obj,*sigma_obj,
+    *dd_obj,*dsigma_obj,*drho_obj,*dirho_obj;
+  Py_ssize_t nkz, nr, nd, nrho, nirho, nsigma, ndd, ndsigma, ndrho, ndirho;
+  const double *kz, *d, *sigma, *rho, *irho;
+  Cplx *r, *dd, *dsigma, *drho, *dirho;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOOOOO:reflectivity_jacobian",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,&kz_obj,&r_obj,
+      &dd_obj,&dsigma_obj,&drho_obj,&dirho_obj))
+    return NULL;
+  INVECTOR(d_obj,d,nd);
+  INVECTOR(sigma_obj,sigma,nsigma);
+  INVECTOR(rho_obj,rho,nrho);
+  INVECTOR(irho_obj,irho,nirho);
+  INVECTOR(kz_obj,kz,nkz);
+  OUTVECTOR(r_obj,r,nr);
+  OUTVECTOR(dd_obj,dd,ndd);
+  OUTVECTOR(dsigma_obj,dsigma,ndsigma);
+  OUTVECTOR(drho_obj,drho,ndrho);
+  OUTVECTOR(dirho_obj,dirho,ndirho);
+  // interfaces should be one shorter than layers
+  if (nd < 1 || nrho != nd || nirho != nd || nd != nsigma+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,sigma have different lengths");
+#endif
+    return NULL;
+  }
+  if (nr != nkz || ndd != nd*nkz || ndrho != nd*nkz || ndirho != nd*nkz
+      || ndsigma != nsigma*nkz) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "derivatives should have layers x len(kz) entries");
+#endif
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  reflectivity_jacobian((int)nd, d, sigma, rho, irho, (int)nkz, kz,
+                        r, dd, dsigma, drho, dirho);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
 
 PyObject* Pcontract_by_area(PyObject*obj,PyObject*args)
 {
@@ -143,7 +398,10 @@ PyObject* Pcontract_by_area(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
-  int newlen = contract_by_area((int)nd, d, sigma, rho, irho, dA);
+  int newlen;
+  Py_BEGIN_ALLOW_THREADS
+  newlen = contract_by_area((int)nd, d, sigma, rho, irho, dA);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("i",newlen);
 }
 
@@ -169,7 +427,76 @@ PyObject* Pcontract_mag(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
-  int newlen = contract_mag((int)nd, d, rho, irho, rhoM, thetaM, dA);
+  int newlen;
+  Py_BEGIN_ALLOW_THREADS
+  newlen = contract_mag((int)nd, d, rho, irho, rhoM, thetaM, dA);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("i",newlen);
+}
+
+
+PyObject* Pcontract_by_area_multi(PyObject*obj,PyObject*args)
+{
+  PyObject *d_obj,*rho_obj,*irho_obj,*sigma_obj,*dA_obj,*err_obj;
+  Py_ssize_t nd, nrho, nirho, nsigma, ndA, nerr;
+  double *d, *sigma, *rho, *irho, *dA, *error;
+  double Q;
+
+  if (!PyArg_ParseTuple(args, "OOOOOdO:contract_by_area_multi",
+      &d_obj,&sigma_obj,&rho_obj,&irho_obj,&dA_obj,&Q,&err_obj))
+    return NULL;
+  OUTVECTOR(d_obj,d,nd);
+  OUTVECTOR(sigma_obj,sigma,nsigma);
+  OUTVECTOR(rho_obj,rho,nrho);
+  OUTVECTOR(irho_obj,irho,nirho);
+  INVECTOR(dA_obj,dA,ndA);
+  OUTVECTOR(err_obj,error,nerr);
+  // rho,irho have one column of layers for each dA
+  if (nd < 1 || nd != nsigma+1 || nerr != ndA
+      || nrho != nd*ndA || nirho != nd*ndA) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,sigma,rho,irho,dA,err have inconsistent lengths");
+#endif
+    return NULL;
+  }
+  int newlen;
+  Py_BEGIN_ALLOW_THREADS
+  newlen = contract_by_area_multi((int)nd, (int)ndA, d, sigma, rho, irho,
+                                  dA, Q, error);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("i",newlen);
+}
+
+PyObject* Pcontract_mag_multi(PyObject*obj,PyObject*args)
+{
+  PyObject *d_obj,*rho_obj,*irho_obj,*rhoM_obj,*thetaM_obj,*dA_obj,*err_obj;
+  Py_ssize_t nd, nrho, nirho, nrhoM, nthetaM, ndA, nerr;
+  double *d, *rho, *irho, *rhoM, *thetaM, *dA, *error;
+  double Q;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOdO:contract_mag_multi",
+      &d_obj,&rho_obj,&irho_obj,&rhoM_obj,&thetaM_obj,&dA_obj,&Q,&err_obj))
+    return NULL;
+  OUTVECTOR(d_obj,d,nd);
+  OUTVECTOR(rho_obj,rho,nrho);
+  OUTVECTOR(irho_obj,irho,nirho);
+  OUTVECTOR(rhoM_obj,rhoM,nrhoM);
+  OUTVECTOR(thetaM_obj,thetaM,nthetaM);
+  INVECTOR(dA_obj,dA,ndA);
+  OUTVECTOR(err_obj,error,nerr);
+  // rho,irho have one column of layers for each dA except the magnetic dA
+  if (nd < 1 || ndA < 2 || nerr != ndA || nrhoM != nd || nthetaM != nd
+      || nrho != nd*(ndA-1) || nirho != nd*(ndA-1)) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "d,rho,irho,rhoM,thetaM,dA,err have inconsistent lengths");
+#endif
+    return NULL;
+  }
+  int newlen;
+  Py_BEGIN_ALLOW_THREADS
+  newlen = contract_mag_multi((int)nd, (int)ndA-1, d, rho, irho, rhoM, thetaM,
+                              dA, Q, error);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("i",newlen);
 }
 
@@ -195,7 +522,10 @@ PyObject* Pcontract_by_step(PyObject*obj,PyObject*args)
 #endif
     return NULL;
   }
-  int newlen = contract_by_step((int)nd, d, sigma, rho, irho, dv);
+  int newlen;
+  Py_BEGIN_ALLOW_THREADS
+  newlen = contract_by_step((int)nd, d, sigma, rho, irho, dv);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("i",newlen);
 }
 
@@ -226,10 +556,62 @@ PyObject* Pconvolve(PyObject *obj, PyObject *args)
 #endif
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   convolve(nxi,xi,yi,nx,x,dx,y);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
+PyObject* Pconvolve_matrix(PyObject *obj, PyObject *args)
+{
+  PyObject *xi_obj,*x_obj,*dx_obj,*indptr_obj,*indices_obj=NULL,*data_obj=NULL;
+  const double *xi, *x, *dx;
+  int *indptr, *indices=NULL;
+  double *data=NULL;
+  Py_ssize_t nxi, nx, ndx, nindptr, nindices=0, ndata=0;
+  size_t nnz;
+
+  if (!PyArg_ParseTuple(args, "OOOO|OO:convolve_matrix",
+			&xi_obj,&x_obj,&dx_obj,&indptr_obj,
+			&indices_obj,&data_obj)) return NULL;
+  INVECTOR(xi_obj,xi,nxi);
+  INVECTOR(x_obj,x,nx);
+  INVECTOR(dx_obj,dx,ndx);
+  OUTVECTOR(indptr_obj,indptr,nindptr);
+  if (indices_obj != NULL && data_obj != NULL) {
+    OUTVECTOR(indices_obj,indices,nindices);
+    OUTVECTOR(data_obj,data,ndata);
+  }
+  if (nxi < 2) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "convolve_matrix: need at least two xi");
+#endif
+    return NULL;
+  }
+  if (nx != ndx || nindptr != nx+1) {
+#ifndef BROKEN_EXCEPTIONS
+    PyErr_SetString(PyExc_ValueError, "convolve_matrix: x, dx and indptr have different lengths");
+#endif
+    return NULL;
+  }
+  if (indices != NULL) {
+    // indptr must come from a previous call with the same x, dx
+    Py_BEGIN_ALLOW_THREADS
+    nnz = convolve_matrix(nxi,xi,nx,x,dx,indptr,NULL,NULL);
+    Py_END_ALLOW_THREADS
+    if ((Py_ssize_t)nnz != nindices || (Py_ssize_t)nnz != ndata) {
+#ifndef BROKEN_EXCEPTIONS
+      PyErr_SetString(PyExc_ValueError, "convolve_matrix: indices and data should have length indptr[-1]");
+#endif
+      return NULL;
+    }
+  }
+  Py_BEGIN_ALLOW_THREADS
+  nnz = convolve_matrix(nxi,xi,nx,x,dx,indptr,indices,data);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("n",(Py_ssize_t)nnz);
+}
+
 PyObject* Pconvolve_sampled(PyObject *obj, PyObject *args)
 {
   PyObject *xi_obj,*yi_obj,*xp_obj,*yp_obj,*x_obj,*dx_obj,*y_obj;
@@ -264,7 +646,9 @@ PyObject* Pconvolve_sampled(PyObject *obj, PyObject *args)
 #endif
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   convolve_sampled(nxi,xi,yi,nxp,xp,yp,nx,x,dx,y);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
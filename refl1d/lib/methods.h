@@ -17,14 +17,26 @@
         if (err < 0) return NULL; \
         len /= sizeof(*buf); \
     } while (0)
+#define OPTIONAL_OUTVECTOR(obj,buf,len,default_len) \
+    do { \
+        if (obj == Py_None) { buf = NULL; len = default_len; } \
+        else OUTVECTOR(obj,buf,len); \
+    } while (0)
 #define SCALAR(obj) PyFloat_AsDouble(obj)
 
 //PyObject* pyvector(int n, double v[]);
 
 PyObject* Preflectivity_amplitude(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_partial(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_repeat(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_amplitude_batch(PyObject*obj,PyObject*args);
+PyObject* Preflectivity_jacobian(PyObject*obj,PyObject*args);
 PyObject* Pmagnetic_amplitude(PyObject* obj, PyObject* args);
 PyObject* Pcontract_by_step(PyObject*obj,PyObject*args);
 PyObject* Pcontract_by_area(PyObject*obj,PyObject*args);
 PyObject* Pcontract_mag(PyObject*obj,PyObject*args);
+PyObject* Pcontract_by_area_multi(PyObject*obj,PyObject*args);
+PyObject* Pcontract_mag_multi(PyObject*obj,PyObject*args);
 PyObject* Pconvolve(PyObject*obj,PyObject*args);
+PyObject* Pconvolve_matrix(PyObject*obj,PyObject*args);
 PyObject* Pconvolve_sampled(PyObject*obj,PyObject*args);
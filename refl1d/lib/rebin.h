@@ -121,6 +121,36 @@ rebin_counts(const std::vector<double> &xold, const std::vector<T> &Iold,
                Inew.size(), &xnew[0], &Inew[0]);
 }
 
+// rebin_weights(Nx, x, Ny, y, from, to, weight)
+// Return the number of overlapping bin pairs between x and y, storing
+// the pairs as (from[k], to[k]) with the portion weight[k] of bin x[from]
+// that falls in bin y[to].  Rebinning I from x to y is then
+// Iy[to[k]] += weight[k]*Ix[from[k]] for each k.  There are at most
+// Nx+Ny-1 pairs.
+inline size_t
+rebin_weights(const size_t Nold, const double xold[],
+              const size_t Nnew, const double xnew[],
+              int from_bin[], int to_bin[], double weight[])
+{
+  size_t k = 0;
+  BinIter<double> from(Nold, xold);
+  BinIter<double> to(Nnew, xnew);
+  while (!from.atend && !to.atend) {
+    if (to.hi <= from.lo) ++to; // new must catch up to old
+    else if (from.hi <= to.lo) ++from; // old must catch up to new
+    else {
+      const double overlap = std::min(from.hi,to.hi) - std::max(from.lo,to.lo);
+      from_bin[k] = int(from.bin);
+      to_bin[k] = int(to.bin);
+      weight[k] = overlap/(from.hi-from.lo);
+      k++;
+      if (to.hi > from.hi) ++from;
+      else ++to;
+    }
+  }
+  return k;
+}
+
 // rebin_intensity(Nx, x, Ix, dIx, Ny, y, Iy, dIy)
 // Like rebin_counts, but includes uncertainty.  This could of course be
 // done separately, but it will be faster to rebin both at the same time.
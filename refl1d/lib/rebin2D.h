@@ -74,6 +74,40 @@ rebin_counts_2D(
 
 }
 
+// rebin_counts_2D_weights(Nx, fx, tx, wx, Ny, fy, ty, wy,
+//                         Nframes, Nxold, Nyold, Iold, Nxnew, Nynew, Inew)
+// Rebin a stack of Nframes frames using precomputed overlap weights
+// from rebin_weights for each axis, where:
+//    Nx, Ny are the number of overlapping bin pairs in x and y
+//    fx[Nx], tx[Nx], wx[Nx] are the x pairs (from, to, weight)
+//    fy[Ny], ty[Ny], wy[Ny] are the y pairs (from, to, weight)
+//    Iold[Nframes*Nxold*Nyold] input frames
+//    Inew[Nframes*Nxnew*Nynew] result frames
+// The result is the same as rebin_counts_2D on each frame, without the
+// cost of recomputing the overlaps.
+template <typename T> void
+rebin_counts_2D_weights(
+        const size_t Nx, const int fx[], const int tx[], const double wx[],
+        const size_t Ny, const int fy[], const int ty[], const double wy[],
+        const size_t Nframes,
+        const size_t Nxold, const size_t Nyold, const T Iold[],
+        const size_t Nxnew, const size_t Nynew, T Inew[])
+{
+  for (size_t f=0; f < Nframes; f++) {
+    const T *frame_old = Iold + f*Nxold*Nyold;
+    T *frame_new = Inew + f*Nxnew*Nynew;
+    for (size_t i=0; i < Nxnew*Nynew; i++) frame_new[i] = 0;
+    for (size_t i=0; i < Nx; i++) {
+      const T *row_old = frame_old + fx[i]*Nyold;
+      T *row_new = frame_new + tx[i]*Nynew;
+      const double portion = wx[i];
+      for (size_t j=0; j < Ny; j++) {
+        row_new[ty[j]] += T(row_old[fy[j]]*(wy[j]*portion));
+      }
+    }
+  }
+}
+
 template <typename T> inline void
 rebin_counts_2D(const std::vector<double> &xold,
 	const std::vector<double> &yold,
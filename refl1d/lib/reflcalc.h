@@ -123,6 +123,40 @@ reflectivity_amplitude(const int layers,
                        const double kz[], const int rho_offset[],
                        Cplx r[]);
 
+void
+reflectivity_amplitude_partial(const int layers,
+                               const double d[], const double sigma[],
+                               const double rho[], const double irho[],
+                               const int points,
+                               const double kz[], const int rho_offset[],
+                               const int lo, const int hi, const int update,
+                               Cplx pre[], Cplx post[], Cplx r[]);
+
+void
+reflectivity_amplitude_repeat(const int layers,
+                              const double d[], const double sigma[],
+                              const double rho[], const double irho[],
+                              const int points,
+                              const double kz[], const int rho_offset[],
+                              const int blocks, const int repeats[],
+                              Cplx r[]);
+
+void
+reflectivity_amplitude_batch(const int models, const int offset[],
+                             const double d[], const double sigma[],
+                             const double rho[], const double irho[],
+                             const int lo, const int top,
+                             const int points, const double kz[],
+                             Cplx r[]);
+
+void
+reflectivity_jacobian(const int layers,
+                      const double d[], const double sigma[],
+                      const double rho[], const double irho[],
+                      const int points, const double kz[],
+                      Cplx r[], Cplx dr_depth[], Cplx dr_sigma[],
+                      Cplx dr_rho[], Cplx dr_irho[]);
+
 void
 magnetic_amplitude(const int layers,
                    const double d[], const double sigma[],
@@ -145,10 +179,25 @@ int
 contract_mag(int n, double d[], double rho[], double irho[],
              double rhoM[], double thetaM[], double dA);
 
+int
+contract_by_area_multi(int n, int nL, double d[], double sigma[],
+                       double rho[], double irho[],
+                       const double dA[], double Q, double err[]);
+
+int
+contract_mag_multi(int n, int nL, double d[], double rho[], double irho[],
+                   double rhoM[], double thetaM[],
+                   const double dA[], double Q, double err[]);
+
 void
 convolve(size_t Nin, const double xin[], const double yin[],
          size_t N, const double x[], const double dx[], double y[]);
 
+size_t
+convolve_matrix(size_t Nin, const double xin[],
+                size_t N, const double x[], const double dx[],
+                int indptr[], int indices[], double data[]);
+
 void
 convolve_sampled(size_t Nin, const double xin[], const double yin[],
          size_t Np, const double xp[], const double yp[],
@@ -5,49 +5,51 @@
  */
 #include <iostream>
 #include <complex>
+#include <vector>
 #include "reflcalc.h"
 
-// Abeles matrix reflectivity calculation
+// Abeles matrix product for steps [first,last) of the path through the
+// stack, multiplied onto the partial product B = {B11, B12, B21, B22}.
+// For kz > 0 the beam enters through layer 0 and for kz < 0 it enters
+// through layer layers-1, so step i crosses from layer i to layer i+1 or
+// from layer layers-1-i to layers-2-i respectively.
 static void
-refl(const int layers,
+refl_product(const int layers,
      const double kz,
      const double depth[],
      const double sigma[],
      const double rho[],
      const double irho[],
-     Cplx& R)
+     const int first,
+     const int last,
+     Cplx B[4])
 {
   const Cplx J(0,1);
 
-  // Check that Q is not too close to zero.
   // For negative Q, reverse the layers.
-  const double cutoff = 1e-10;
   int next,step;
-  if (kz >= cutoff) {
+  if (kz >= 0) {
     next=0;
     step=1;
-  } else if (kz <= -cutoff) {
+  } else {
     next=layers-1;
     step=-1;
     sigma -= 1;
-  } else {
-    R = -1.;
-    return;
   }
 
   // Since sqrt(1/4 * x) = sqrt(x)/2, I'm going to pull the 1/2 into the
   // sqrt to save a multiplication later.
   const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
   const double kz_sq = kz*kz + pi4*rho[next];    // kz^2 + 4 pi Vrho
-  Cplx k(fabs(kz));
+  next += first*step;
+  Cplx k = (first == 0 ? Cplx(fabs(kz))
+            : sqrt(kz_sq - pi4*Cplx(rho[next],irho[next])));
 
-  Cplx B11, B12, B21, B22;
-  B11 = B22 = 1;
-  B12 = B21 = 0;
+  Cplx B11=B[0], B12=B[1], B21=B[2], B22=B[3];
 #if 0
   std::cout << "kz: " << kz << std::endl;
 #endif
-  for (int i=0; i < layers-1; i++) {
+  for (int i=first; i < last; i++) {
     // The loop index is not the layer number because we may be reversing
     // the stack.  Instead, n is set to the incident layer (which may be
     // first or last) and incremented or decremented each time through.
@@ -79,10 +81,58 @@ refl(const int layers,
     next += step;
     k = k_next;
   }
+  B[0]=B11; B[1]=B12; B[2]=B21; B[3]=B22;
+}
+
+// Multiply partial product B by partial product M, leaving the result in B.
+static inline void
+refl_multiply(Cplx B[4], const Cplx M[4])
+{
+  const Cplx B11 = B[0]*M[0] + B[2]*M[1];
+  const Cplx B21 = B[0]*M[2] + B[2]*M[3];
+  const Cplx B12 = B[1]*M[0] + B[3]*M[1];
+  const Cplx B22 = B[1]*M[2] + B[3]*M[3];
+  B[0]=B11; B[1]=B12; B[2]=B21; B[3]=B22;
+}
+
+// Raise partial product U to the power n by repeated squaring.
+static void
+refl_power(Cplx U[4], int n)
+{
+  Cplx P[4] = {1., 0., 0., 1.};
+  while (n > 0) {
+    if (n&1) refl_multiply(P, U);
+    n >>= 1;
+    if (n > 0) {
+      const Cplx V[4] = {U[0], U[1], U[2], U[3]};
+      refl_multiply(U, V);
+    }
+  }
+  U[0]=P[0]; U[1]=P[1]; U[2]=P[2]; U[3]=P[3];
+}
+
+// Abeles matrix reflectivity calculation
+static void
+refl(const int layers,
+     const double kz,
+     const double depth[],
+     const double sigma[],
+     const double rho[],
+     const double irho[],
+     Cplx& R)
+{
+  // Check that Q is not too close to zero.
+  const double cutoff = 1e-10;
+  if (kz > -cutoff && kz < cutoff) {
+    R = -1.;
+    return;
+  }
 
+  Cplx B[4] = {1., 0., 0., 1.};
+  refl_product(layers, kz, depth, sigma, rho, irho, 0, layers-1, B);
 
   // And we are done.
-  R = B12/B11;
+  R = B[1]/B[0];
 }
 
 
@@ -108,6 +158,370 @@ reflectivity_amplitude(const int    layers,
 }
 
 
+// Reflectivity for a stack containing repeated blocks of layers.  Block b
+// starts at layer repeats[3*b], with period repeats[3*b+1] layers repeated
+// repeats[3*b+2] times.  The blocks must be sorted, must not overlap, and
+// must lie strictly between the substrate and the surface.  Every step
+// along the path through the block except those of the final period is
+// the same, so the product for one period is computed and raised to the
+// power count-1, making the cost logarithmic in the number of repeats.
+static void
+refl_repeat(const int layers,
+     const double kz,
+     const double depth[],
+     const double sigma[],
+     const double rho[],
+     const double irho[],
+     const int blocks,
+     const int repeats[],
+     Cplx& R)
+{
+  const double cutoff = 1e-10;
+  if (kz > -cutoff && kz < cutoff) {
+    R = -1.;
+    return;
+  }
+
+  Cplx B[4] = {1., 0., 0., 1.};
+  int done = 0;
+  for (int j=0; j < blocks; j++) {
+    // Walk the blocks in the order they are met along the path.
+    const int b = (kz >= 0 ? j : blocks-1-j);
+    const int period = repeats[3*b+1], count = repeats[3*b+2];
+    const int start = (kz >= 0 ? repeats[3*b]
+                       : layers - repeats[3*b] - period*count);
+    refl_product(layers, kz, depth, sigma, rho, irho, done, start, B);
+    Cplx U[4] = {1., 0., 0., 1.};
+    refl_product(layers, kz, depth, sigma, rho, irho, start, start+period, U);
+    refl_power(U, count-1);
+    refl_multiply(B, U);
+    done = start + period*(count-1);
+  }
+  refl_product(layers, kz, depth, sigma, rho, irho, done, layers-1, B);
+  R = B[1]/B[0];
+}
+
+extern "C" void
+reflectivity_amplitude_repeat(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             const int    blocks,
+             const int    repeats[],
+             Cplx r[])
+{
+  #ifdef _OPENMP
+  #pragma omp parallel for
+  #endif
+  for (int i=0; i < points; i++) {
+    const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
+    refl_repeat(layers, kz[i], depth, sigma, rho+offset, irho+offset,
+                blocks, repeats, r[i]);
+  }
+}
+
+
+// Reflectivity with reuse of the matrix products for the unchanged part
+// of the stack.  Layers [lo,hi) are the ones which may have changed since
+// the products pre[4*i..4*i+3] and post[4*i..4*i+3] were saved for the
+// matrices before and after those layers along the path taken by kz[i].
+// If update is true then the products are recomputed and saved, otherwise
+// only the matrices touching layers [lo,hi) are computed.  The incident
+// medium for each kz (layer 0 for kz>0, layer layers-1 for kz<0) must lie
+// outside [lo,hi) since it changes every matrix in the stack.
+extern "C" void
+reflectivity_amplitude_partial(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             const int    rho_index[],
+             const int    lo,
+             const int    hi,
+             const int    update,
+             Cplx pre[],
+             Cplx post[],
+             Cplx r[])
+{
+  const double cutoff = 1e-10;
+  #ifdef _OPENMP
+  #pragma omp parallel for
+  #endif
+  for (int i=0; i < points; i++) {
+    const int offset = layers*(rho_index!=NULL ? rho_index[i] : 0);
+    const double *prho = rho+offset, *pirho = irho+offset;
+    Cplx *P = pre+4*i, *S = post+4*i;
+    if (kz[i] > -cutoff && kz[i] < cutoff) {
+      r[i] = -1.;
+      continue;
+    }
+
+    // Steps [first,last) along the path touch layers [lo,hi).
+    int first, last;
+    if (kz[i] >= 0) {
+      first = lo-1;
+      last = hi;
+    } else {
+      first = layers-1-hi;
+      last = layers-lo;
+    }
+    if (first < 0) first = 0;
+    if (last > layers-1) last = layers-1;
+    if (last < first) last = first;
+
+    if (update) {
+      P[0] = S[0] = 1.; P[1] = S[1] = 0.;
+      P[2] = S[2] = 0.; P[3] = S[3] = 1.;
+      refl_product(layers, kz[i], depth, sigma, prho, pirho, 0, first, P);
+      refl_product(layers, kz[i], depth, sigma, prho, pirho, last, layers-1, S);
+    }
+    Cplx B[4] = {P[0], P[1], P[2], P[3]};
+    refl_product(layers, kz[i], depth, sigma, prho, pirho, first, last, B);
+    refl_multiply(B, S);
+    r[i] = B[1]/B[0];
+  }
+}
+
+
+// Reflectivity for a set of models evaluated at the same kz points.
+// The models are stored end to end in depth, rho and irho, with model m
+// occupying layers offset[m] through offset[m+1]-1.  Since each model has
+// one fewer interface than layers, the interfaces for model m start at
+// sigma[offset[m]-m].  The amplitudes are returned in r[m*points + i].
+//
+// If the first lo layers and the last top layers are the same in every
+// model, with lo, top >= 1, then the matrix products for those layers are
+// computed once for each kz using model 0, and only the matrices touching
+// the layers in between are computed for each model, as for
+// reflectivity_amplitude_partial.  Use lo = top = 0 if the models do not
+// share layers.
+extern "C" void
+reflectivity_amplitude_batch(const int    models,
+             const int    offset[],
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    lo,
+             const int    top,
+             const int    points,
+             const double kz[],
+             Cplx r[])
+{
+  if (lo < 1 || top < 1) {
+    const int total = models*points;
+    #ifdef _OPENMP
+    #pragma omp parallel for
+    #endif
+    for (int k=0; k < total; k++) {
+      const int m = k/points;
+      const int i = k%points;
+      const int start = offset[m];
+      const int layers = offset[m+1] - start;
+      refl(layers, kz[i], depth+start, sigma+start-m,
+           rho+start, irho+start, r[k]);
+    }
+    return;
+  }
+
+  const double cutoff = 1e-10;
+  #ifdef _OPENMP
+  #pragma omp parallel for
+  #endif
+  for (int i=0; i < points; i++) {
+    if (kz[i] > -cutoff && kz[i] < cutoff) {
+      for (int m=0; m < models; m++) r[m*points+i] = -1.;
+      continue;
+    }
+
+    // The steps before first and after last only cross shared layers,
+    // so their products P and S are the same for every model.  Steps
+    // [first,last) along the path touch layers [lo,layers-top).
+    Cplx P[4] = {1., 0., 0., 1.}, S[4] = {1., 0., 0., 1.};
+    for (int m=0; m < models; m++) {
+      const int start = offset[m];
+      const int layers = offset[m+1] - start;
+      const double *d = depth+start, *s = sigma+start-m;
+      const double *prho = rho+start, *pirho = irho+start;
+      int first, last;
+      if (kz[i] >= 0) {
+        first = lo-1;
+        last = layers-top;
+      } else {
+        first = top-1;
+        last = layers-lo;
+      }
+      if (last > layers-1) last = layers-1;
+      if (last < first) last = first;
+
+      if (m == 0) {
+        refl_product(layers, kz[i], d, s, prho, pirho, 0, first, P);
+        refl_product(layers, kz[i], d, s, prho, pirho, last, layers-1, S);
+      }
+      Cplx B[4] = {P[0], P[1], P[2], P[3]};
+      refl_product(layers, kz[i], d, s, prho, pirho, first, last, B);
+      refl_multiply(B, S);
+      r[m*points+i] = B[1]/B[0];
+    }
+  }
+}
+
+
+// Reflectivity and its derivatives with respect to the layer parameters.
+// The path through the stack is the product of step matrices
+//     T[i] = [ M11, F M11 ; F M22, M22 ]
+// with r = P[1][0]/P[0][0] for P = T[0] T[1] ... T[n-2].  The derivative of
+// P[:,0] with respect to a parameter of step i is pre[i] dT[i] post[i],
+// where pre[i] is the product of the steps before i and post[i] is the
+// first column of the product of the steps after i.  Saving the prefix
+// products on the way forward and accumulating the suffix on the way
+// back gives all the derivatives in time proportional to the number of
+// layers.  The derivatives are returned as dr_dx[j*points + i] for layer
+// or interface j and point i.  Depth of the incident medium and substrate
+// and irho of the incident medium do not contribute.
+static void
+refl_jacobian(const int layers,
+     const double kz,
+     const double depth[],
+     const double sigma[],
+     const double rho[],
+     const double irho[],
+     const int points,
+     Cplx& R,
+     Cplx dr_depth[],
+     Cplx dr_sigma[],
+     Cplx dr_rho[],
+     Cplx dr_irho[])
+{
+  const Cplx J(0,1);
+  const double pi4=12.566370614359172e-6;        // 1e-6 * 4 pi
+  const int steps = layers-1;
+
+  for (int j=0; j < layers; j++) {
+    dr_depth[j*points] = dr_rho[j*points] = dr_irho[j*points] = 0.;
+    if (j < steps) dr_sigma[j*points] = 0.;
+  }
+  const double cutoff = 1e-10;
+  if ((kz > -cutoff && kz < cutoff) || steps < 1) {
+    R = -1.;
+    return;
+  }
+
+  // Layer and interface for each position p along the path.
+  const bool forward = (kz >= 0);
+#define LAYER(p) (forward ? (p) : layers-1-(p))
+#define INTERFACE(p) (forward ? (p) : layers-2-(p))
+
+  std::vector<Cplx> k(layers), F(steps), M11(steps), M22(steps),
+    pre(4*steps), dk(layers);
+  const double kz_sq = kz*kz + pi4*rho[LAYER(0)];
+  k[0] = fabs(kz);
+  for (int p=1; p < layers; p++) {
+    const int L = LAYER(p);
+    k[p] = sqrt(kz_sq - pi4*Cplx(rho[L],irho[L]));
+  }
+
+  // Forward pass saving the product of the steps before each step.
+  Cplx P[4] = {1., 0., 0., 1.}; // P00, P01, P10, P11
+  for (int i=0; i < steps; i++) {
+    const double s = sigma[INTERFACE(i)];
+    F[i] = (k[i]-k[i+1])/(k[i]+k[i+1])*exp(-2.*k[i]*k[i+1]*s*s);
+    M11[i] = (i>0 ? exp(J*k[i]*depth[LAYER(i)]) : 1.);
+    M22[i] = (i>0 ? exp(-J*k[i]*depth[LAYER(i)]) : 1.);
+    for (int m=0; m < 4; m++) pre[4*i+m] = P[m];
+    const Cplx T00=M11[i], T01=F[i]*M11[i], T10=F[i]*M22[i], T11=M22[i];
+    const Cplx P00 = P[0]*T00 + P[1]*T10, P01 = P[0]*T01 + P[1]*T11;
+    const Cplx P10 = P[2]*T00 + P[3]*T10, P11 = P[2]*T01 + P[3]*T11;
+    P[0]=P00; P[1]=P01; P[2]=P10; P[3]=P11;
+  }
+  R = P[2]/P[0];
+
+  // Backward pass accumulating post[i] = T[i+1] ... T[n-2] e0.  The change
+  // dT in step i changes r by (x1 - r x0)/P00 for x = pre[i] dT post[i].
+  Cplx v0 = 1., v1 = 0.;
+  for (int p=0; p < layers; p++) dk[p] = 0.;
+  for (int i=steps-1; i >= 0; i--) {
+    const Cplx *A = &pre[4*i];
+    const Cplx ka = k[i], kb = k[i+1];
+    const double s = sigma[INTERFACE(i)];
+    const Cplx g = (ka-kb)/(ka+kb);
+    const Cplx e = exp(-2.*ka*kb*s*s);
+    const Cplx sum_sq = (ka+kb)*(ka+kb);
+#define DR(D00,D01,D10,D11) \
+    (( A[2]*((D00)*v0 + (D01)*v1) + A[3]*((D10)*v0 + (D11)*v1) \
+      - R*(A[0]*((D00)*v0 + (D01)*v1) + A[1]*((D10)*v0 + (D11)*v1)) ) / P[0])
+
+    // Interface roughness
+    const Cplx F_s = g*e*(-4.*ka*kb*s);
+    dr_sigma[INTERFACE(i)*points] = DR(0., F_s*M11[i], F_s*M22[i], 0.);
+
+    // Wave vector in the layer after the step
+    const Cplx F_kb = e*(-2.*ka/sum_sq - g*2.*ka*s*s);
+    dk[i+1] += DR(0., F_kb*M11[i], F_kb*M22[i], 0.);
+
+    // Wave vector and thickness of the layer before the step
+    const Cplx F_ka = e*(2.*kb/sum_sq - g*2.*kb*s*s);
+    if (i > 0) {
+      const double d = depth[LAYER(i)];
+      const Cplx dM11 = J*d*M11[i], dM22 = -J*d*M22[i];
+      dk[i] += DR(dM11, F_ka*M11[i] + F[i]*dM11,
+                  F_ka*M22[i] + F[i]*dM22, dM22);
+      const Cplx tM11 = J*ka*M11[i], tM22 = -J*ka*M22[i];
+      dr_depth[LAYER(i)*points] = DR(tM11, F[i]*tM11, F[i]*tM22, tM22);
+    }
+#undef DR
+
+    // post[i-1] = T[i] post[i]
+    const Cplx w0 = M11[i]*v0 + F[i]*M11[i]*v1;
+    const Cplx w1 = F[i]*M22[i]*v0 + M22[i]*v1;
+    v0 = w0; v1 = w1;
+  }
+
+  // Chain through k = sqrt(kz^2 + 4 pi (rho[0] - rho - j irho)).  The
+  // wave vector in the incident medium is fixed at |kz|, but rho[0]
+  // appears in all the others.
+  Cplx incident = 0.;
+  for (int p=1; p < layers; p++) {
+    const int L = LAYER(p);
+    const Cplx dk_drho = -0.5*pi4/k[p];
+    dr_rho[L*points] += dk[p]*dk_drho;
+    dr_irho[L*points] += dk[p]*dk_drho*J;
+    incident -= dk[p]*dk_drho;
+  }
+  dr_rho[LAYER(0)*points] += incident;
+#undef LAYER
+#undef INTERFACE
+}
+
+extern "C" void
+reflectivity_jacobian(const int    layers,
+             const double depth[],
+             const double sigma[],
+             const double rho[],
+             const double irho[],
+             const int    points,
+             const double kz[],
+             Cplx r[],
+             Cplx dr_depth[],
+             Cplx dr_sigma[],
+             Cplx dr_rho[],
+             Cplx dr_irho[])
+{
+  #ifdef _OPENMP
+  #pragma omp parallel for
+  #endif
+  for (int i=0; i < points; i++) {
+    refl_jacobian(layers, kz[i], depth, sigma, rho, irho, points, r[i],
+                  dr_depth+i, dr_sigma+i, dr_rho+i, dr_irho+i);
+  }
+}
+
 /*************************************************************************/
 // We need  a number of tests as follows:
 // (note V=vacuum, S=substrate, n=interior layer n, r=reflectivity amplitude)
@@ -38,7 +38,9 @@ PyObject* Prebin(PyObject *obj, PyObject *args)
         "_reduction.rebin: must have one more bin edges than bins");
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   rebin_counts<T>(nin-1,in,Iin,nout-1,out,Iout);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
@@ -69,8 +71,72 @@ PyObject* Prebin2d(PyObject *obj, PyObject *args)
         "_reduction.rebin2d: must have one more bin edges than bins");
     return NULL;
   }
+  Py_BEGIN_ALLOW_THREADS
   rebin_counts_2D<T>(nxin-1,xin,nyin-1,yin,Iin,
       nxout-1,xout,nyout-1,yout,Iout);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("");
+}
+
+PyObject* Prebin_weights(PyObject *obj, PyObject *args)
+{
+  PyObject *in_obj,*out_obj,*from_obj,*to_obj,*w_obj;
+  Py_ssize_t nin, nout, nfrom, nto, nw;
+  double *in, *out, *w;
+  int *from, *to;
+  size_t nnz;
+
+  if (!PyArg_ParseTuple(args, "OOOOO:rebin_weights",
+                        &in_obj,&out_obj,&from_obj,&to_obj,&w_obj)) return NULL;
+  INVECTOR(in_obj,in,nin);
+  INVECTOR(out_obj,out,nout);
+  OUTVECTOR(from_obj,from,nfrom);
+  OUTVECTOR(to_obj,to,nto);
+  OUTVECTOR(w_obj,w,nw);
+  if (nin < 1 || nout < 1 || nfrom < nin+nout-3
+      || nto != nfrom || nw != nfrom) {
+    PyErr_SetString(PyExc_ValueError,
+        "_reduction.rebin_weights: need len(xi)+len(xo)-3 pairs");
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  nnz = rebin_weights(nin-1,in,nout-1,out,from,to,w);
+  Py_END_ALLOW_THREADS
+  return Py_BuildValue("n", (Py_ssize_t)nnz);
+}
+
+PyObject* Prebin2d_weights(PyObject *obj, PyObject *args)
+{
+  PyObject *fx_obj,*tx_obj,*wx_obj,*fy_obj,*ty_obj,*wy_obj,*Iin_obj,*Iout_obj;
+  Py_ssize_t nfx,ntx,nwx,nfy,nty,nwy,nIin,nIout;
+  Py_ssize_t nxin,nyin,nxout,nyout;
+  int *fx,*tx,*fy,*ty;
+  double *wx,*wy,*Iin,*Iout;
+
+  if (!PyArg_ParseTuple(args, "OOOOOOnnOnnO:rebin2d_weights",
+                        &fx_obj,&tx_obj,&wx_obj,&fy_obj,&ty_obj,&wy_obj,
+                        &nxin,&nyin,&Iin_obj,&nxout,&nyout,&Iout_obj))
+        return NULL;
+  INVECTOR(fx_obj,fx,nfx);
+  INVECTOR(tx_obj,tx,ntx);
+  INVECTOR(wx_obj,wx,nwx);
+  INVECTOR(fy_obj,fy,nfy);
+  INVECTOR(ty_obj,ty,nty);
+  INVECTOR(wy_obj,wy,nwy);
+  INVECTOR(Iin_obj,Iin,nIin);
+  OUTVECTOR(Iout_obj,Iout,nIout);
+  if (nfx != ntx || nfx != nwx || nfy != nty || nfy != nwy
+      || nxin < 1 || nyin < 1 || nxout < 1 || nyout < 1
+      || nIin % (nxin*nyin) != 0
+      || nIout != nIin/(nxin*nyin)*nxout*nyout) {
+    PyErr_SetString(PyExc_ValueError,
+        "_reduction.rebin2d_weights: inconsistent weight or frame sizes");
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS
+  rebin_counts_2D_weights<double>(nfx,fx,tx,wx,nfy,fy,ty,wy,
+      nIin/(nxin*nyin),nxin,nyin,Iin,nxout,nyout,Iout);
+  Py_END_ALLOW_THREADS
   return Py_BuildValue("");
 }
 
@@ -81,10 +147,30 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "_reflectivity_amplitude(d,sigma,rho,irho,Q,rho_offset,R): compute reflectivity putting it into vector R of len(Q)"},
 
+	{"_reflectivity_amplitude_partial",
+	 Preflectivity_amplitude_partial,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_partial(d,sigma,rho,irho,Q,rho_offset,lo,hi,update,pre,post,R): compute reflectivity\nputting it into vector R of len(Q), reusing the matrix products pre and post\nof len(4*Q) for the layers outside [lo,hi) unless update is true"},
+
+	{"_reflectivity_amplitude_repeat",
+	 Preflectivity_amplitude_repeat,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_repeat(d,sigma,rho,irho,Q,rho_offset,repeats,R): compute reflectivity\nputting it into vector R of len(Q), where repeats holds (start,period,count)\nfor each block of repeated layers"},
+
+	{"_reflectivity_amplitude_batch",
+	 Preflectivity_amplitude_batch,
+	 METH_VARARGS,
+	 "_reflectivity_amplitude_batch(offset,d,sigma,rho,irho,Q,R[,lo,top]): compute reflectivity for len(offset)-1 models\nstored end to end, putting it into vector R of len(offset)-1 x len(Q)\nThe first lo and last top layers may be shared by all models"},
+
+	{"_reflectivity_jacobian",
+	 Preflectivity_jacobian,
+	 METH_VARARGS,
+	 "_reflectivity_jacobian(d,sigma,rho,irho,Q,R,dd,dsigma,drho,dirho): compute amplitude R of len(Q) and its\nderivatives with respect to each layer parameter, of len(d) x len(Q)"},
+
 	{"_magnetic_amplitude",
 	 Pmagnetic_amplitude,
 	 METH_VARARGS,
-	 "_magnetic_amplitude(d,sigma,rho,irho,rhoM,u1,u3,Aguide,Q,rho_offset,R1,R2,R3,R4): compute amplitude putting it into vector R of len(Q)"},
+	 "_magnetic_amplitude(d,sigma,rho,irho,rhoM,u1,u3,Aguide,Q,rho_offset,R1,R2,R3,R4): compute amplitude putting it into vector R of len(Q)\nCross sections given as None are not computed"},
 
 	{"_contract_by_area",
          Pcontract_by_area,
@@ -96,6 +182,16 @@ static PyMethodDef methods[] = {
           METH_VARARGS,
           "_contract_mag(d,sigma,rho,irho,rhoM,thetaM,dA): join layers in microstep profile, keeping error under control"},
 
+        {"_contract_by_area_multi",
+         Pcontract_by_area_multi,
+         METH_VARARGS,
+         "_contract_by_area_multi(d,sigma,rho,irho,dA,Q,err): join layers in microstep profile jointly across the rho,irho columns, returning the error bound at Q for each column in err"},
+
+        {"_contract_mag_multi",
+         Pcontract_mag_multi,
+         METH_VARARGS,
+         "_contract_mag_multi(d,rho,irho,rhoM,thetaM,dA,Q,err): join layers in magnetic microstep profile jointly across the rho,irho columns and the magnetism, returning the error bound at Q for each in err"},
+
         {"_contract_by_step",
          Pcontract_by_step,
          METH_VARARGS,
@@ -106,11 +202,26 @@ static PyMethodDef methods[] = {
 	 METH_VARARGS,
 	 "convolve(xi,yi,x,dx,y): compute convolution of width dx[k] at points x[k],\nreturned in y[k]"},
 
+	{"convolve_matrix",
+	 Pconvolve_matrix,
+	 METH_VARARGS,
+	 "convolve_matrix(xi,x,dx,indptr[,indices,data]): sparse matrix W in CSR form such\nthat convolve(xi,yi,x,dx) is W yi; fills indptr and returns the number of\nnonzeros, then fills indices and data when they are given"},
+
 	{"convolve_sampled",
 	 Pconvolve_sampled,
 	 METH_VARARGS,
 	 "convolve_sampled(xi,yi,xp,yp,x,dx,y): compute convolution with sampled\ndistribution of width dx[k] at points x[k], returned in y[k]"},
 
+	{"rebin_weights",
+	 &Prebin_weights,
+	 METH_VARARGS,
+	 "rebin_weights(xi,xo,from,to,w): overlap weights w[k] from bin from[k] of xi to bin to[k] of xo;\nreturns the number of pairs, which is at most len(xi)+len(xo)-3"},
+
+	{"rebin2d_weights",
+	 &Prebin2d_weights,
+	 METH_VARARGS,
+	 "rebin2d_weights(fx,tx,wx,fy,ty,wy,nxi,nyi,Ii,nxo,nyo,Io): 2-D rebin of a stack of nxi x nyi frames\nto nxo x nyo frames using the overlap weights from rebin_weights for each axis"},
+
 	{"rebin_uint8",
 	 &Prebin<uint8_t>,
 	 METH_VARARGS,
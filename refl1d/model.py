@@ -50,6 +50,11 @@ class Layer(object): # Abstract base class
     """
     thickness = None
     interface = None
+
+    #: Reuse the rendered microslabs when the layer parameters are unchanged.
+    #: Only set this for layers whose profile depends on nothing but the
+    #: layer parameters and the probe, and which are expensive to render.
+    cache_render = False
     
     # Make magnetism a property so we can update the magnetism parameter
     # names with the layer name when we assign magnetism to the layer
@@ -289,7 +294,7 @@ class Stack(Layer):
         Render and sld stack in which no layers are magnetic.
         """ 
         for layer in self._layers:
-            layer.render(probe, slabs)
+            slabs.render_layer(layer, probe)
 
     def _render_magnetic(self, probe, slabs):
         """
@@ -314,7 +319,7 @@ class Stack(Layer):
                 end_layer = i + magnetism.extent - 1
 
             # Render nuclear layer
-            layer.render(probe, slabs)
+            slabs.render_layer(layer, probe)
 
             # Wait for end of magnetic layer
             if i == end_layer:
@@ -31,6 +31,7 @@ class FreeLayer(Layer):
     Layers have a slope of zero at the ends, so the automatically blend
     with slabs.
     """
+    cache_render = True
     def __init__(self, below=None, above=None, thickness=0,
                  z=[], rho=[], irho=[], name="Freeform"):
         self.name = name
@@ -99,6 +100,7 @@ class FreeInterface(Layer):
     Layers have a slope of zero at the ends, so the automatically blend
     with slabs.
     """
+    cache_render = True
     def __init__(self, thickness=0, interface=0,
                  below=None, above=None,
                  dz=None, dp=None, name="Interface"):
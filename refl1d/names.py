@@ -25,6 +25,7 @@ def ModelFunction(*args,**kw):
     raise NotImplementedError("ModelFunction no longer supported --- use PDF instead")
 
 from .experiment import Experiment, plot_sample, MixedExperiment
+from .parallel import ExperimentPool, ExperimentThreadPool
 from .material import SLD, Material, Compound, Mixture
 from .model import Slab, Stack
 from .polymer import (PolymerBrush, PolymerMushroom, EndTetheredPolymer, 
@@ -36,6 +37,7 @@ from .probe import (Probe, ProbeSet, XrayProbe, NeutronProbe, QProbe,
                     PolarizedNeutronProbe, PolarizedQProbe, load4)
 from .stajconvert import load_mlayer, save_mlayer
 from . import ncnrdata as NCNR, snsdata as SNS
+from .bulkload import load_files
 from .instrument import Monochromatic, Pulsed
 from .magnetic import MagneticSlab, MagneticTwist, FreeMagnetic, MagneticStack
 from .magnetism import Magnetism, MagnetismTwist, FreeMagnetism, MagnetismStack
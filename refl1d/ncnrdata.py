@@ -58,6 +58,7 @@ import os
 from bumps.data import parse_file
 
 from .instrument import Monochromatic
+from .datacache import cached_parse
 from .probe import PolarizedNeutronProbe
 
 
@@ -172,7 +173,7 @@ def parse_ncnr_file(filename):
     Slit geometry is set to the default from the instrument if it is not
     available in the reduced file.
     """
-    header, data = parse_file(filename)
+    header, data = cached_parse(parse_file, filename)
 
     # Fill in instrument parameters, if not available from the file
     if 'instrument' in header and header['instrument'] in INSTRUMENTS:
@@ -0,0 +1,365 @@
+# This program is in the public domain
+# Author: Paul Kienzle
+"""
+Parallel evaluation of experiments
+
+Simultaneous fits to many data sets, such as a contrast variation series
+or the separate angles of a time-of-flight measurement, evaluate each
+experiment in turn.  :class:`ExperimentPool` spreads the experiments
+across a set of long-lived worker processes.  Each worker holds its own
+copy of the experiments it is responsible for, so only the parameter
+values and the residuals cross the process boundary on each evaluation.
+
+Use the pooled models in place of the experiments when defining the
+fit problem::
+
+    pool = ExperimentPool([M_H2O, M_D2O, M_CMSi], processes=3)
+    problem = FitProblem(pool.models)
+
+Experiments with a :class:`refl1d.probe.ProbeSet` probe, such as those
+returned by *Pulsed.simulate*, are split into one experiment per member
+probe so that the individual angles can be computed in parallel.  Each
+member is then computed on its own calculation points rather than the
+union of the calculation points for the set.
+
+:class:`ExperimentThreadPool` evaluates the experiments in a pool of
+threads within the current process instead.  The compiled kernels
+release the global interpreter lock, so the threads run in parallel
+while computing reflectivity and resolution, and nothing needs to be
+pickled.  The python parts of the calculation, such as rendering the
+sample, are still serialized, so threads work best for models whose
+cost is dominated by the reflectivity calculation.
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import multiprocessing.pool
+import traceback
+
+import numpy
+from bumps import parameter
+
+from .experiment import Experiment
+from .probe import ProbeSet
+
+__all__ = ['ExperimentPool', 'ExperimentThreadPool', 'PooledExperiment']
+
+
+class ExperimentPool(object):
+    """
+    Evaluate a set of experiments in a pool of worker processes.
+
+    *models* is the list of experiments to evaluate.
+
+    *processes* is the number of worker processes, or None to use one
+    per CPU.  No more workers are started than there are experiments.
+
+    *split_probes* is True if experiments with a
+    :class:`refl1d.probe.ProbeSet` probe should be evaluated as separate
+    experiments for each member probe.
+
+    The workers are started on the first evaluation and run until
+    :meth:`close` is called or the program exits.  The pooled models
+    are available as *pool.models*.
+    """
+    def __init__(self, models, processes=None, split_probes=True):
+        self.processes = processes
+        self.models = [PooledExperiment(self, k, M)
+                       for k, M in enumerate(models)]
+        self._parts = [(k, part) for k, M in enumerate(models)
+                       for part in (_split_probes(M) if split_probes else [M])]
+        self._pars = [p for p in parameter.unique([M.parameters()
+                                                   for M in models])
+                      if isinstance(p, parameter.Parameter)]
+        self._workers = None
+        self._results = None
+
+    def __getstate__(self):
+        # Workers cannot be pickled; they are restarted on first use.
+        state = self.__dict__.copy()
+        state['_workers'] = state['_results'] = None
+        return state
+
+    def update(self):
+        """
+        Called when any parameter in the model is changed.
+        """
+        self._results = None
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        if self._workers is None:
+            return
+        for proc, conn, _ in self._workers:
+            try:
+                conn.send(None)
+                conn.close()
+            except (IOError, OSError):
+                pass
+        for proc, _, _ in self._workers:
+            proc.join()
+        self._workers = None
+
+    def _start(self):
+        n = self.processes if self.processes else multiprocessing.cpu_count()
+        n = max(1, min(n, len(self._parts)))
+
+        # Longest processing time first, using the number of measurement
+        # points as the cost of each experiment.
+        groups = [[] for _ in range(n)]
+        load = numpy.zeros(n)
+        cost = [M.numpoints() for _, M in self._parts]
+        for i in sorted(range(len(cost)), key=lambda i: -cost[i]):
+            w = numpy.argmin(load)
+            groups[w].append(i)
+            load[w] += cost[i]
+
+        self._workers = []
+        for group in groups:
+            parent, child = multiprocessing.Pipe()
+            models = [self._parts[i][1] for i in group]
+            proc = multiprocessing.Process(target=_worker,
+                                           args=(child, models, self._pars))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self._workers.append((proc, parent, group))
+
+    def _evaluate(self):
+        """
+        Return (residuals, nllf) for each model, evaluating if necessary.
+        """
+        if self._results is not None:
+            return self._results
+        if self._workers is None:
+            self._start()
+
+        values = [p.value for p in self._pars]
+        for _, conn, _ in self._workers:
+            conn.send(values)
+        parts = [None]*len(self._parts)
+        errors = []
+        for _, conn, group in self._workers:
+            results = conn.recv()
+            if isinstance(results, str):
+                errors.append(results)
+            else:
+                for i, r in zip(group, results):
+                    parts[i] = r
+        if errors:
+            raise RuntimeError("experiment pool worker failed:\n"
+                               + "\n".join(errors))
+
+        self._results = _combine(self._parts, parts, len(self.models))
+        return self._results
+
+
+class ExperimentThreadPool(object):
+    """
+    Evaluate a set of experiments in a pool of threads.
+
+    *models* is the list of experiments to evaluate.
+
+    *threads* is the number of threads, or None to use one per CPU.
+    No more threads are started than there are experiments.
+
+    *split_probes* is True if experiments with a
+    :class:`refl1d.probe.ProbeSet` probe should be evaluated as separate
+    experiments for each member probe.
+
+    The experiments are evaluated in the current process, sharing the
+    parameters with the fit, so each experiment must be safe to evaluate
+    while the others are being evaluated.  This is true of the models
+    in refl1d except for those which share a cache between layers, such
+    as :class:`refl1d.polymer.EndTetheredPolymer`.  The pooled models
+    are available as *pool.models*.
+    """
+    def __init__(self, models, threads=None, split_probes=True):
+        self.threads = threads
+        self.models = [PooledExperiment(self, k, M)
+                       for k, M in enumerate(models)]
+        self._parts = [(k, part) for k, M in enumerate(models)
+                       for part in (_split_probes(M) if split_probes else [M])]
+        self._threads = None
+        self._results = None
+
+    def __getstate__(self):
+        # Threads cannot be pickled; they are restarted on first use.
+        state = self.__dict__.copy()
+        state['_threads'] = state['_results'] = None
+        return state
+
+    def update(self):
+        """
+        Called when any parameter in the model is changed.
+        """
+        self._results = None
+
+    def close(self):
+        """
+        Stop the threads.
+        """
+        if self._threads is None:
+            return
+        self._threads.close()
+        self._threads.join()
+        self._threads = None
+
+    def _evaluate(self):
+        """
+        Return (residuals, nllf) for each model, evaluating if necessary.
+        """
+        if self._results is not None:
+            return self._results
+        if self._threads is None:
+            n = self.threads if self.threads else multiprocessing.cpu_count()
+            n = max(1, min(n, len(self._parts)))
+            self._threads = multiprocessing.pool.ThreadPool(n)
+
+        # Largest experiments first so the small ones fill in at the end.
+        order = sorted(range(len(self._parts)),
+                       key=lambda i: -self._parts[i][1].numpoints())
+        results = self._threads.map(_evaluate_part,
+                                    [self._parts[i][1] for i in order],
+                                    chunksize=1)
+        parts = [None]*len(self._parts)
+        for i, r in zip(order, results):
+            parts[i] = r
+        self._results = _combine(self._parts, parts, len(self.models))
+        return self._results
+
+
+class PooledExperiment(object):
+    """
+    Stand-in for an experiment evaluated by an :class:`ExperimentPool`.
+
+    The fitness methods :meth:`nllf` and :meth:`residuals` evaluate all
+    experiments in the pool at once.  Everything else, such as plotting
+    and saving, is forwarded to the underlying experiment, which is
+    available as *experiment*.
+    """
+    def __init__(self, pool, index, experiment):
+        self.pool = pool
+        self.index = index
+        self.experiment = experiment
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the stand-in.
+        if name == 'experiment':
+            raise AttributeError(name)
+        return getattr(self.experiment, name)
+
+    def parameters(self):
+        return self.experiment.parameters()
+
+    def update(self):
+        self.pool.update()
+        self.experiment.update()
+
+    def numpoints(self):
+        return self.experiment.numpoints()
+
+    def residuals(self):
+        return self.pool._evaluate()[self.index][0]
+
+    def nllf(self):
+        return self.pool._evaluate()[self.index][1]
+
+
+def _split_probes(model):
+    """
+    Return one experiment for each member of a ProbeSet, or [*model*].
+    """
+    if type(model) is not Experiment or not isinstance(model.probe, ProbeSet):
+        return [model]
+    return [Experiment(sample=model.sample, probe=probe,
+                       roughness_limit=model.roughness_limit,
+                       dz=model.dz, dA=model.dA,
+                       step_interfaces=model.step_interfaces,
+                       interpolation=model.interpolation,
+                       reuse_matrices=model.reuse_matrices,
+                       dR=model.dR)
+            for probe in model.probe.probes]
+
+
+def _combine(parts, results, n):
+    """
+    Join the (residuals, nllf) *results* for the split experiments *parts*
+    into the results for the *n* models.
+    """
+    resid = [[] for _ in range(n)]
+    nllf = [0.]*n
+    for (k, _), (r, f) in zip(parts, results):
+        resid[k].append(r)
+        nllf[k] += f
+    return [(numpy.hstack(r), f) for r, f in zip(resid, nllf)]
+
+
+def _evaluate_part(model):
+    model.update()
+    return model.residuals(), model.nllf()
+
+
+def _worker(conn, models, pars):
+    """
+    Evaluate *models* for each set of parameter values received on *conn*.
+
+    Sends back [(residuals, nllf), ...], or the traceback if the
+    evaluation fails.  Stops when it receives None.
+    """
+    while True:
+        values = conn.recv()
+        if values is None:
+            break
+        try:
+            for p, v in zip(pars, values):
+                p.value = v
+            results = []
+            for M in models:
+                M.update()
+                results.append((M.residuals(), M.nllf()))
+        except Exception:
+            results = traceback.format_exc()
+        conn.send(results)
+    conn.close()
+
+
+def _test_models():
+    from .names import silicon, air, SLD, NeutronProbe
+    T = numpy.linspace(0.1, 3, 50)
+    layer = SLD(name="film", rho=4)
+    models = []
+    for rho in (-0.5, 2, 6.3):
+        probe = NeutronProbe(T=T, dT=0.01, L=4.75, dL=0.02)
+        solvent = SLD(name="solvent", rho=rho)
+        M = Experiment(sample=silicon(0, 3) | layer(100, 5) | solvent,
+                       probe=probe)
+        probe.simulate_data(M.reflectivity(), noise=2)
+        models.append(M)
+    return models, layer
+
+
+def _check_pool(models, layer, pool):
+    try:
+        for thickness, rho in ((100, 4), (120, 3.5)):
+            models[0].sample[1].thickness.value = thickness
+            layer.rho.value = rho
+            for M, P in zip(models, pool.models):
+                M.update()
+                P.update()
+                assert abs(M.nllf() - P.nllf()) < 1e-10*M.nllf()
+                assert numpy.allclose(M.residuals(), P.residuals())
+    finally:
+        pool.close()
+
+
+def test():
+    models, layer = _test_models()
+    _check_pool(models, layer, ExperimentPool(models, processes=2))
+
+
+def test_threads():
+    models, layer = _test_models()
+    _check_pool(models, layer, ExperimentThreadPool(models, threads=2))
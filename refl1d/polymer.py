@@ -49,6 +49,8 @@ from __future__ import division, print_function, unicode_literals
 __all__ = ["PolymerBrush","PolymerMushroom","EndTetheredPolymer","VolumeProfile","layer_thickness"]
 
 import inspect
+import os
+import warnings
 
 import numpy as np
 
@@ -76,6 +78,10 @@ LAMBDA_1 = np.float64(1.0)/6.0 #always assume cubic lattice (1/6) for now
 LAMBDA_0 = 1.0-2.0*LAMBDA_1
 LAMBDA_ARRAY = np.array([LAMBDA_1,LAMBDA_0,LAMBDA_1])
 MINLAT = 25
+# Solutions saved by SCFSolutionCache are tagged with this version, and
+# solutions with a different version are ignored.  Bump it whenever a
+# change to the SCF equations or the solver changes the solutions.
+SCF_CACHE_VERSION = 1
 SQRT_PI=sqrt(pi)
 
 class PolymerBrush(Layer):
@@ -126,6 +132,7 @@ class PolymerBrush(Layer):
     roughness $\sigma$ and $\rho(z)$ is the complex scattering
     length density of the profile.
     """
+    cache_render = True
     def __init__(self, thickness=0, interface=0, name="brush",
                  polymer=None, solvent=None, base_vf=None,
                  base=None, length=None, power=None, sigma=None):
@@ -247,6 +254,8 @@ class VolumeProfile(Layer):
     thickness can be computed as :func: `layer_thickness`.
 
     """
+    cache_render = True
+
     # TODO: test that thickness(z) matches the thickness of the layer
     def __init__(self, thickness=0, interface=0, name="VolumeProfile",
                  material=None, solvent=None, profile=None, **kw):
@@ -351,6 +360,7 @@ class PolymerMushroom(Layer):
     Solutions are only strictly valid for vf << 1. 
     """
     
+    cache_render = True
     def __init__(self, thickness=0, interface=0, name="Mushroom",
                  polymer=None, solvent=None, sigma=0,
                  vf=0, delta=0):
@@ -512,6 +522,7 @@ class EndTetheredPolymer(Layer):
     with coordination number $Z = 6$ for a cubic lattice, $p_l = .233$.
     """
     
+    cache_render = True
     def __init__(self, thickness=0, interface=0, name="EndTetheredPolymer",
                  polymer=None, solvent=None, chi=0, chi_s=0, h_dry=None, 
                  l_lat=1, mn=None, m_lat=1, pdi=1):
@@ -612,10 +623,289 @@ def SCFprofile(z, chi=None, chi_s=None, h_dry=None, l_lat=1, mn=None,
     return phi
     
 
-def SCFcache(chi,chi_s,pdi,sigma,segments,disp=False,cache=OrderedDict()):
+class SCFSolutionCache(object):
+    """
+    Least recently used cache of SCF solutions with a nearest neighbour index.
+
+    Solutions are keyed by the scaled parameters (chi, chi_s, pdi, sigma,
+    segments) used by :func:`SCFcache`.  Up to *maxsize* solutions are held
+    in memory, with the least recently used solution dropped first, and
+    :meth:`nearest` finds the closest solution using a KD-tree over the
+    keys.  New keys go into a small buffer which is searched linearly,
+    and the tree is only rebuilt once more than *reindex* keys have been
+    added or dropped since it was built.
+
+    If *path* is given, solutions are also saved to an SQLite database at
+    that location, so they are available to other processes, such as the
+    workers in a parallel fit, and to later runs.  The most recent
+    solutions are loaded on first use, and the solutions added by other
+    processes are loaded each time the cache misses.  Each solution is
+    saved with :data:`SCF_CACHE_VERSION`, and solutions from other
+    versions are ignored.  Only the most recent *maxrows* solutions are
+    kept in the database.  If the database cannot be used, a warning is
+    given and the cache carries on in memory.
+    """
+    def __init__(self, maxsize=1000, path=None, reindex=64, maxrows=20000):
+        self.maxsize = maxsize
+        self.path = path
+        self.reindex = reindex
+        self.maxrows = maxrows
+        self._memory = OrderedDict()
+        self._stored = set()  # keys known to be in the database
+        self._tree = None
+        self._keys = None
+        self._pending = []  # keys added since the tree was built
+        self._dropped = 0   # keys in the tree that have left memory
+        self._db = None
+        self._pid = None
+        self._last_row = 0
+
+    def __getstate__(self):
+        # The database connection is reopened in the new process.
+        state = self.__dict__.copy()
+        state['_db'] = state['_tree'] = state['_keys'] = None
+        state['_pid'] = None
+        state['_pending'], state['_dropped'] = [], 0
+        return state
+
+    def __len__(self):
+        self._connect()
+        return len(self._memory)
+
+    def __iter__(self):
+        self._connect()
+        return iter(list(self._memory))
+
+    def __contains__(self, key):
+        self._connect()
+        if key in self._memory:
+            return True
+        if key in self._stored:
+            phi = self._fetch(key)
+            if phi is not None:
+                self._add(key, phi)
+                return True
+        return False
+
+    def __getitem__(self, key):
+        """
+        Return the solution for *key*, marking it as recently used.
+        """
+        if key not in self:
+            raise KeyError(key)
+        self._memory.move_to_end(key)
+        return self._memory[key]
+
+    def __setitem__(self, key, phi):
+        self._connect()
+        key = tuple(float(v) for v in key)
+        self._add(key, phi)
+        if key not in self._stored:
+            self._store(key, phi)
+
+    def pop(self, key):
+        """
+        Remove *key* from memory and return its solution.
+
+        The solution stays in the database.
+        """
+        if key not in self:
+            raise KeyError(key)
+        self._dropped += 1
+        return self._memory.pop(key)
+
+    def popitem(self, last=True):
+        self._connect()
+        item = self._memory.popitem(last=last)
+        self._dropped += 1
+        return item
+
+    def nearest(self, key):
+        """
+        Return the cached key closest to *key*.
+        """
+        self._connect()
+        if (self._tree is None
+                or len(self._pending) + self._dropped > self.reindex):
+            self._build_index()
+        point = np.asarray(key, 'd')
+        best, best_distance = None, np.inf
+        if self._keys:
+            # Dropped keys are still in the tree, so look past them.
+            k = min(len(self._keys), self._dropped + 1)
+            distances, indices = self._tree.query(point, k=k)
+            for distance, index in zip(np.atleast_1d(distances),
+                                       np.atleast_1d(indices)):
+                if self._keys[index] in self._memory:
+                    best, best_distance = self._keys[index], distance
+                    break
+        pending = [p for p in self._pending if p in self._memory]
+        if pending:
+            deltas = np.array(pending) - point
+            distances = sqrt(addred(deltas*deltas, axis=1))
+            index = distances.argmin()
+            if distances[index] < best_distance:
+                best = pending[index]
+        return best
+
+    def _build_index(self):
+        from scipy.spatial import cKDTree
+        self._keys = list(self._memory)
+        self._tree = cKDTree(np.array(self._keys)) if self._keys else None
+        self._pending, self._dropped = [], 0
+
+    def sync(self):
+        """
+        Load the solutions added to the database by other processes.
+        """
+        self._connect()
+        if self._db is None:
+            return
+        rows = self._query("SELECT rowid, chi, chi_s, pdi, sigma, segments,"
+                           " phi FROM scf WHERE rowid > ? AND version = ?"
+                           " ORDER BY rowid",
+                           (self._last_row, SCF_CACHE_VERSION))
+        for row in rows:
+            self._load_row(row)
+
+    def _add(self, key, phi):
+        if key in self._memory:
+            self._memory.pop(key)
+        else:
+            self._pending.append(key)
+        self._memory[key] = phi
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+            self._dropped += 1
+
+    def _connect(self):
+        if self.path is None or self._pid == os.getpid():
+            return
+        # Connections cannot be shared with forked processes.
+        self._pid = os.getpid()
+        self._db = None
+        try:
+            import sqlite3
+            path = os.path.expanduser(self.path)
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            try:
+                # Let readers proceed while another process is writing.
+                db.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.Error:
+                pass
+            db.execute("CREATE TABLE IF NOT EXISTS scf (chi REAL, chi_s REAL,"
+                       " pdi REAL, sigma REAL, segments REAL, phi BLOB,"
+                       " version INTEGER,"
+                       " PRIMARY KEY (chi, chi_s, pdi, sigma, segments))")
+            columns = [c[1] for c in db.execute("PRAGMA table_info(scf)")]
+            if 'version' not in columns:
+                # Upgrade a database from before the version column; its
+                # rows have no version so they are ignored.
+                try:
+                    db.execute("ALTER TABLE scf ADD COLUMN version INTEGER")
+                except sqlite3.OperationalError:
+                    pass  # another process added it first
+            db.commit()
+            self._db = db
+            rows = self._query("SELECT rowid, chi, chi_s, pdi, sigma,"
+                               " segments, phi FROM scf WHERE version = ?"
+                               " ORDER BY rowid DESC LIMIT ?",
+                               (SCF_CACHE_VERSION, self.maxsize))
+            rows.reverse()
+            for row in rows:
+                self._load_row(row)
+            keys = self._query("SELECT chi, chi_s, pdi, sigma, segments"
+                               " FROM scf WHERE version = ?",
+                               (SCF_CACHE_VERSION,))
+            self._stored.update(tuple(k) for k in keys)
+        except Exception as exc:
+            self._disable(exc)
+
+    def _load_row(self, row):
+        key = tuple(row[1:6])
+        self._last_row = max(self._last_row, row[0])
+        self._stored.add(key)
+        if key not in self._memory:
+            self._add(key, np.frombuffer(row[6], dtype='d').copy())
+
+    def _fetch(self, key):
+        if self._db is None:
+            return None
+        rows = self._query("SELECT phi FROM scf WHERE chi=? AND chi_s=?"
+                           " AND pdi=? AND sigma=? AND segments=?"
+                           " AND version=?", key + (SCF_CACHE_VERSION,))
+        if not rows:
+            # Dropped from the database to keep it under maxrows.
+            self._stored.discard(key)
+            return None
+        return np.frombuffer(rows[0][0], dtype='d').copy()
+
+    def _store(self, key, phi):
+        if self._db is None:
+            return
+        try:
+            # Replace rather than ignore, so that a solution from another
+            # version is overwritten.
+            phi = memoryview(np.ascontiguousarray(phi, 'd'))
+            self._db.execute("INSERT OR REPLACE INTO scf"
+                             " VALUES (?,?,?,?,?,?,?)",
+                             key + (phi, SCF_CACHE_VERSION))
+            self._db.commit()
+            self._prune()
+            self._stored.add(key)
+        except Exception as exc:
+            self._disable(exc)
+
+    def _prune(self):
+        # The rowid range bounds the number of rows and is quick to find,
+        # so only count them out when the database may be 10% too big.
+        span, = self._db.execute("SELECT (SELECT MAX(rowid) FROM scf)"
+                                 " - (SELECT MIN(rowid) FROM scf) + 1"
+                                 ).fetchone()
+        if span > 1.1*self.maxrows:
+            # Drop the oldest rows to keep the database size bounded.
+            self._db.execute("DELETE FROM scf WHERE rowid IN (SELECT rowid"
+                             " FROM scf ORDER BY rowid DESC LIMIT -1"
+                             " OFFSET ?)", (self.maxrows,))
+            self._db.commit()
+
+    def _query(self, sql, args):
+        try:
+            return self._db.execute(sql, args).fetchall()
+        except Exception as exc:
+            self._disable(exc)
+            return []
+
+    def _disable(self, exc):
+        warnings.warn("SCF cache %r is not available: %s" % (self.path, exc))
+        self._db = None
+
+
+def _default_cache_path():
+    """
+    Return the SCF solution database named by REFL1D_SCF_CACHE, or the
+    default location in the user's home directory.  Setting
+    REFL1D_SCF_CACHE to an empty string keeps the cache in memory.
+    """
+    path = os.environ.get('REFL1D_SCF_CACHE', None)
+    if path is None:
+        return os.path.join('~', '.refl1d', 'scfcache.db')
+    return path if path else None
+
+
+def SCFcache(chi,chi_s,pdi,sigma,segments,disp=False,
+             cache=SCFSolutionCache(path=_default_cache_path())):
     """Return a memoized SCF result by walking from a previous solution.
-    
-    Using an OrderedDict (because I want to prune keys FIFO)
+
+    The default cache is a :class:`SCFSolutionCache` shared with other
+    processes through a database in the user's home directory; set the
+    environment variable REFL1D_SCF_CACHE to use a different file, or to
+    an empty string to keep the solutions in memory.  An OrderedDict may
+    be given instead, in which case the nearest solution is found by a
+    linear search and the oldest keys are pruned FIFO.
     """
     # prime the cache with a known easy solution
     if not cache: 
@@ -629,29 +919,41 @@ def SCFcache(chi,chi_s,pdi,sigma,segments,disp=False,cache=OrderedDict()):
     # longshot, but return a cached result if we hit it
     if scaled_parameters in cache:
         if disp: print('SCFcache hit at:', scaled_parameters)
+        if hasattr(cache, 'nearest'):
+            return cache[scaled_parameters]
         phi = cache.pop(scaled_parameters) # pop and assign to shift the key
         cache[scaled_parameters] = phi     # to the end as "recently used"
         return phi
-    
-    # Find the closest parameters in the cache: O(len(cache))
-    
-    # Numpy setup
-    cached_parameters = list(cache)
-    cp_array = np.array(cached_parameters)
+
     p_array = np.array(scaled_parameters)
+    if hasattr(cache, 'nearest'):
+        # Pick up solutions from other processes before searching the index
+        cache.sync()
+        closest_cp = cache.nearest(scaled_parameters)
+        closest_cp_array = np.array(closest_cp)
+        closest_delta = p_array - closest_cp_array
+    else:
+        # Find the closest parameters in the cache: O(len(cache))
+
+        # Numpy setup
+        cached_parameters = list(cache)
+        cp_array = np.array(cached_parameters)
+
+        # Calculate distances to all cached parameters
+        deltas = p_array - cp_array # Parameter space displacement vectors
+        norms = sqrt(addred(deltas*deltas,axis=1)) # and their magnitudes
+        closest_index = norms.argmin()
+
+        # Organize closest point data for later use
+        closest_cp = cached_parameters[closest_index]
+        closest_cp_array = cp_array[closest_index]
+        closest_delta = deltas[closest_index]
     
-    # Calculate distances to all cached parameters
-    deltas = p_array - cp_array # Parameter space displacement vectors
-    norms = sqrt(addred(deltas*deltas,axis=1)) # and their magnitudes
-    closest_index = norms.argmin()
-    
-    # Organize closest point data for later use
-    closest_cp = cached_parameters[closest_index]
-    closest_cp_array = cp_array[closest_index]
-    closest_delta = deltas[closest_index]
-    
-    phi0 = cache.pop(closest_cp) # pop and assign to shift the key
-    cache[closest_cp] = phi0     # to the end as "recently used"
+    if hasattr(cache, 'nearest'):
+        phi0 = cache[closest_cp]
+    else:
+        phi0 = cache.pop(closest_cp) # pop and assign to shift the key
+        cache[closest_cp] = phi0     # to the end as "recently used"
     
     if disp:
         print("Walking from nearest:", closest_cp_array)
@@ -718,7 +1020,7 @@ def SCFcache(chi,chi_s,pdi,sigma,segments,disp=False,cache=OrderedDict()):
     if disp: print('SCFcache execution time:', round(time()-starttime,3), "s")
     
     # keep the cache from consuming all things
-    if len(cache)>1000:
+    if not hasattr(cache, 'nearest') and len(cache)>1000:
         if disp: print('pruning cache')
         for i in range(100):
             cache.popitem(last=False)
@@ -727,7 +1029,7 @@ def SCFcache(chi,chi_s,pdi,sigma,segments,disp=False,cache=OrderedDict()):
 
 
 def SCFsolve(chi=0,chi_s=0,pdi=1,sigma=None,segments=None,
-             disp=False,phi0=None,maxiter=15):
+             disp=False,phi0=None,maxiter=15,jacobian=False):
     """Solve SCF equations using an initial guess and lattice parameters
     
     This function finds a solution for the equations where the lattice size
@@ -735,6 +1037,11 @@ def SCFsolve(chi=0,chi_s=0,pdi=1,sigma=None,segments=None,
     
     The Newton-Krylov solver really makes this one. Krylov+gmres was faster
     than the other scipy.optimize alternatives by quite a lot.
+    
+    With jacobian=True the equations are solved by :func:`SCFnewton` using
+    the analytic Jacobian. Each Jacobian product costs more than the finite
+    difference used by scipy, so this only pays off for strongly segregated
+    brushes (large chi) where the scipy solver needs many steps.
     """
     
     from scipy.optimize import root
@@ -775,11 +1082,17 @@ def SCFsolve(chi=0,chi_s=0,pdi=1,sigma=None,segments=None,
         if disp: print("Solving SCF equations")
         
         try:
-            result = root(
-                SCFeqns,phi0,args=(chi,chi_s,sigma,segments,p_i),
-                method='Krylov',callback=callback,
-                options={'disp':bool(disp),'maxiter':maxiter,
-                         'jac_options':{'method':jac_solve_method}})
+            if jacobian:
+                result = SCFnewton(
+                    phi0,args=(chi,chi_s,sigma,segments,p_i),
+                    callback=callback,disp=disp,maxiter=maxiter,
+                    method=jac_solve_method)
+            else:
+                result = root(
+                    SCFeqns,phi0,args=(chi,chi_s,sigma,segments,p_i),
+                    method='Krylov',callback=callback,
+                    options={'disp':bool(disp),'maxiter':maxiter,
+                             'jac_options':{'method':jac_solve_method}})
             if disp: 
                 print('Solver exit code:',result.status,result.message)
                 
@@ -846,6 +1159,211 @@ def SCFsolve(chi=0,chi_s=0,pdi=1,sigma=None,segments=None,
     
     return phi
 
+def SCFnewton(phi0,args,callback=None,disp=False,maxiter=15,
+              method='gmres',f_tol=np.finfo(float).eps**(1./3)):
+    """Newton-Krylov solution of the SCF equations starting from phi0
+    
+    Follows scipy.optimize.root(method='Krylov'), with the same forcing
+    terms, line search and stopping condition, but uses the analytic
+    Jacobian-vector product and preconditioner from :class:`SCFJacobian`
+    in place of finite differences. *args* are the remaining arguments to
+    :func:`SCFeqns`, *method* is 'gmres' or 'lgmres' for the linear
+    solves, and *callback(x,f)* is called after each step.
+    
+    Returns an OptimizeResult with status 1 on convergence and 2 if
+    *maxiter* steps were taken.
+    """
+    from scipy.optimize import OptimizeResult
+    from scipy.sparse.linalg import LinearOperator, gmres, lgmres
+    
+    x = np.array(phi0, dtype='d')
+    f, jac = SCFeqns(x,*args,jacobian=True)
+    fnorm = np.linalg.norm(f)
+    
+    # Eisenstat-Walker forcing terms, as in scipy.optimize.nonlin
+    eta, eta_max, gamma = 1e-3, 0.9999, 0.9
+    
+    status, message, nit = 2, 'Maximum number of iterations reached', 0
+    for nit in range(maxiter+1):
+        if fabs(f).max() < f_tol:
+            status = 1
+            message = 'A solution was found at the specified tolerance.'
+            break
+        if nit == maxiter:
+            break
+        
+        # right preconditioning, so the tolerance is on the true residual
+        tol = min(eta, eta*fnorm)
+        op = LinearOperator((x.size,x.size),dtype='d',
+                            matvec=lambda v: jac.matvec(jac.psolve(v)))
+        if method == 'gmres':
+            y, _ = gmres(op,-f,tol=tol,atol=0,restart=20,maxiter=1)
+        else:
+            y, _ = lgmres(op,-f,tol=tol,atol=0,maxiter=1,inner_m=20)
+        dx = jac.psolve(y)
+        
+        # backtracking line search on |f|^2 with the Armijo condition
+        step = 1.0
+        while True:
+            f_new, jac_new = SCFeqns(x+step*dx,*args,jacobian=True)
+            fnorm_new = np.linalg.norm(f_new)
+            if fnorm_new**2 <= (1-2e-4*step)*fnorm**2 or step < 1e-2:
+                break
+            step *= 0.5
+        x = x + step*dx
+        
+        eta_A = gamma*fnorm_new**2/fnorm**2
+        if gamma*eta**2 < 0.1:
+            eta = min(eta_max, eta_A)
+        else:
+            eta = min(eta_max, max(eta_A, gamma*eta**2))
+        f, jac, fnorm = f_new, jac_new, fnorm_new
+        
+        if disp:
+            print("%d:  |F(x)| = %g; step %g" % (nit, fabs(f).max(), step))
+        if callback is not None:
+            callback(x,f)
+    
+    return OptimizeResult(x=x, fun=f, success=(status==1), status=status,
+                          message=message, nit=nit)
+
+class SCFJacobian(object):
+    """ Jacobian of :func:`SCFeqns` at x
+    
+    :meth:`matvec` applies the Jacobian by differentiating the propagator
+    recursion of :func:`calc_g_zs` alongside the stored weighting factors,
+    which costs about as much as one evaluation of the SCF equations and
+    has no finite difference error.  If the weighting factors overflow,
+    it falls back to a finite difference of the SCF equations.
+    
+    :meth:`psolve` applies an approximate inverse for preconditioning.
+    The SCF equations are eps = phi - phi_new(w) where w = log(g_z), so
+    the Jacobian is I + K A, with A = -dw/dphi tridiagonal on the lattice
+    and K the density response of the chains.  For chains on the lattice
+    K is close to h (T + a a')^-1 h, with h = sqrt(phi), T the tridiagonal
+    diffusion operator of the propagator, and the rank one term a = h
+    holding the amount of grafted polymer fixed.  With this model the
+    inverse needs two tridiagonal solves for each vector.
+    """
+    # Decay of the chain response along the lattice in the preconditioner
+    PRECONDITIONER_DECAY = 0.1
+    
+    def __init__(self,x,f,args,phi_z,dphi_dx,dpenalty,g_z,g_zs_ta,g_zs_free,
+                 c_i,phi_z_new):
+        self.x = x
+        self.f = f
+        self.args = args
+        self.phi_z = phi_z
+        self.dphi_dx = dphi_dx
+        self.dpenalty = dpenalty
+        self.g_z = g_z
+        self.g_zs_ta = g_zs_ta
+        self.g_zs_free = g_zs_free
+        self.c_i = c_i
+        self.phi_z_new = phi_z_new
+        self._precond = None
+        
+    def matvec(self,v):
+        layers, segments = self.g_zs_ta.shape
+        g_z, g_zs_ta, g_zs_free = self.g_z, self.g_zs_ta, self.g_zs_free
+        chi = self.args[0]
+        
+        # change in the normalized log weighting factors
+        dphi = self.dphi_dx*v
+        w = 2*chi*calc_phi_z_avg(dphi) - dphi/(1.0 - self.phi_z)
+        w -= addred(w)/layers
+        
+        # terminally attached chains
+        dg_zs_ta = np.zeros_like(g_zs_ta)
+        dg_zs_ta[0,0] = w[0]*g_zs_ta[0,0]
+        calc_dg_zs(g_z,w,0.0,g_zs_ta,dg_zs_ta,layers,segments)
+        
+        # free chains, including the change in normalization; uniform
+        # chains only have a source term for the last segment
+        if np.size(self.c_i) == 1:
+            c_i = np.zeros(segments)
+            c_i[-1] = self.c_i
+            dc_i = np.zeros(segments)
+            dc_i[-1] = -self.c_i*addred(dg_zs_ta[:,-1])/addred(g_zs_ta[:,-1])
+        else:
+            c_i = self.c_i.ravel()
+            dc_i = -c_i*addred(dg_zs_ta,axis=0)/addred(g_zs_ta,axis=0)
+        dg_zs_free = np.empty_like(g_zs_free)
+        dg_zs_free[:,0] = (dc_i[-1] + c_i[-1]*w)*g_z
+        calc_dg_zs(g_z,w,dc_i,g_zs_free,dg_zs_free,layers,segments)
+        
+        dphi_new = (calc_phi_z(dg_zs_ta,g_zs_free,g_z)
+                    + calc_phi_z(g_zs_ta,dg_zs_free,g_z)
+                    - self.phi_z_new*w)
+        result = dphi - dphi_new + self.dpenalty*v
+        if not np.isfinite(result).all():
+            result = self._fd_matvec(v)
+        return result
+    
+    def _fd_matvec(self,v):
+        # forward difference step as in scipy.optimize.KrylovJacobian
+        norm = np.linalg.norm(v)
+        if norm == 0:
+            return 0*v
+        step = sqrt(np.finfo(float).eps)*max(np.linalg.norm(self.x),1)/norm
+        return (SCFeqns(self.x+step*v,*self.args) - self.f)/step
+    
+    def psolve(self,r):
+        from scipy.linalg import solve_banded
+        if self._precond is None:
+            self._precond = self._setup_precond()
+        if self._precond is False:
+            return r
+        A, C, h, a, b, scale = self._precond
+        
+        # (I + h T^-1 h A)^-1 = I - h C^-1 h A, then Sherman-Morrison
+        z = r - h*solve_banded((1,1),C,h*_tridiag_matvec(A,r))
+        return z + a*(addred(b*z)*scale)
+    
+    def _setup_precond(self):
+        from scipy.linalg import solve_banded, LinAlgError
+        chi = self.args[0]
+        phi = self.phi_z
+        layers = phi.size
+        h = sqrt(phi)
+        
+        # A = -dw/dphi in banded storage
+        A = np.zeros((3,layers))
+        A[1] = 1.0/(1.0-phi) - 2*chi*LAMBDA_0
+        A[0,1:] = A[2,:-1] = -2*chi*LAMBDA_1
+        
+        # T = decay - LAMBDA_1*laplacian with reflecting ends
+        T = np.zeros((3,layers))
+        T[1] = self.PRECONDITIONER_DECAY + 2*LAMBDA_1
+        T[1,[0,-1]] -= LAMBDA_1
+        T[0,1:] = T[2,:-1] = -LAMBDA_1
+        
+        # C = T + h A h
+        C = T.copy()
+        C[1] += h*A[1]*h
+        C[0,1:] += h[:-1]*A[0,1:]*h[1:]
+        C[2,:-1] += h[1:]*A[2,:-1]*h[:-1]
+        
+        # rank one term of the chain response, a b' with b = A h u
+        try:
+            u = h*solve_banded((1,1),T,h)
+            a = u/addred(h*u)
+            a -= h*solve_banded((1,1),C,h*_tridiag_matvec(A,a))
+        except (LinAlgError, ValueError):
+            return False
+        b = _tridiag_matvec(A,u)
+        scale = 1.0/(1.0 - addred(b*a))
+        if not (np.isfinite(a).all() and np.isfinite(scale)):
+            return False
+        return A, C, h, a, b, scale
+
+def _tridiag_matvec(ab,v):
+    """Multiply v by the tridiagonal matrix ab in solve_banded storage"""
+    r = ab[1]*v
+    r[:-1] += ab[0,1:]*v[1:]
+    r[1:] += ab[2,:-1]*v[:-1]
+    return r
+
 def SZdist(pdi,nn,cache=OrderedDict()):
     """ Calculate Shultz-Zimm distribution from PDI and number average DP
     
@@ -940,14 +1458,18 @@ def short_circuit_callback(x,tol):
     if abs(x[-1]) > 4*tol:
         raise ShortCircuitError('Stopping, lattice too small!',x)
 
-def SCFeqns(phi_z,chi,chi_s,sigma,navgsegments,p_i):
+def SCFeqns(phi_z,chi,chi_s,sigma,navgsegments,p_i,jacobian=False):
     """ System of SCF equation for terminally attached polymers.
     
         Formatted for input to a nonlinear minimizer or solver.
+        
+        If jacobian is True, return the residuals and the
+        :class:`SCFJacobian` at phi_z.
     """
     
     # let the solver go negative if it wants
-    phi_z = fabs(phi_z)
+    x = phi_z
+    phi_z = fabs(x)
     
     # attempts to try fields with values greater than one are penalized
     toomuch = phi_z>.99999
@@ -996,7 +1518,17 @@ def SCFeqns(phi_z,chi,chi_s,sigma,navgsegments,p_i):
         phi_z_new = calc_phi_z(g_zs_ta_norm,g_zs_free_ngts_norm,g_z_norm)
         
     eps_z = phi_z - phi_z_new
-    return eps_z + penalty*np.sign(eps_z)
+    if not jacobian:
+        return eps_z + penalty*np.sign(eps_z)
+    
+    dphi_dx = np.where(x<0,-1.0,1.0)
+    dpenalty = np.where(toomuch,1e5*dphi_dx*np.sign(eps_z),0.0)
+    dphi_dx[toomuch] = 0.0
+    result = eps_z + penalty*np.sign(eps_z)
+    jac = SCFJacobian(x,result,(chi,chi_s,sigma,navgsegments,p_i),
+                      phi_z,dphi_dx,dpenalty,g_z_norm,g_zs_ta_norm,
+                      g_zs_free_ngts_norm,c_i_norm,phi_z_new)
+    return result, jac
 
 def _getmax(t, seen_t={}):
     try:
@@ -1067,3 +1599,14 @@ def calc_g_zs(g_z,c_i,layers,segments):
 #        pg_zs=g_zs[:,r]
                
     return g_zs
+
+def calc_dg_zs(g_z,w,dc_i,g_zs,dg_zs,layers,segments):
+    """Derivative of calc_g_zs along a change of w in log(g_z) and dc_i in c_i
+    
+    The first column of dg_zs is filled in by the caller, and the rest is
+    computed in place from the weighting factors g_zs.
+    """
+    dc_i = np.ascontiguousarray(np.broadcast_to(dc_i,(segments,)),'d')
+    from refl1d.calc_g_zs_cex import _calc_g_zs_jvp
+    _calc_g_zs_jvp(g_z,w,dc_i,g_zs,dg_zs,LAMBDA_0,LAMBDA_1,layers,segments)
+    return dg_zs
@@ -54,7 +54,8 @@ from .material import Vacuum
 from .resolution import QL2T, QT2L, TL2Q, dQdL2dT, dQdT2dLoL, dTdL2dQ
 from .resolution import sigma2FWHM, FWHM2sigma
 from .stitch import stitch
-from .reflectivity import convolve
+from .reflectivity import convolve_matrix
+from .datacache import cached_parse
 
 PROBE_KW = ('T', 'dT', 'L', 'dL', 'data', 'name', 'filename',
             'intensity', 'background', 'back_absorption',
@@ -310,6 +311,7 @@ class Probe(object):
             numpy.savetxt(fid, data.T)
 
     def _set_calc(self, T, L):
+        self._resolution_cache = None
         Q = TL2Q(T=T, L=L)
 
         idx = numpy.argsort(Q)
@@ -473,26 +475,81 @@ class Probe(object):
         L = numpy.hstack((self.L, L.flatten()))
         self._set_calc(T, L)
 
+    def adaptive_oversample(self, thickness, n=8, width=3, Qc=0):
+        r"""
+        Over-sample $Q$ only where the resolution smears the Kiessig fringes.
+
+        A film of total *thickness* $D$ (|Ang|) produces fringes with
+        period $2\pi/D$ in $Q$.  Calculation points are added on a
+        uniform grid with *n* points per fringe, but only within the
+        resolution window $Q_i \pm w\,\Delta Q_i$ (*w* = *width*) of
+        measurements whose window is wider than one grid step.  Nearby
+        measurements share grid points, so the calculation grid grows
+        with the thickness of the film and the width of the resolution
+        rather than with the number of measurements.
+
+        Within the film the fringes are periodic in $\sqrt{Q^2-Q_c^2}$
+        rather than $Q$, and so are closer together near the critical
+        edge $Q_c$ of the film.  Given *Qc*, the grid step is reduced
+        near the critical edge to match.
+
+        Use the largest thickness expected during the fit, such as the
+        sum of the upper bounds of the layer thicknesses, or the
+        fringes of the thicker films will be undersampled.  See
+        :meth:`refl1d.experiment.Experiment.adaptive_oversample` for
+        choosing the thickness from the current model.
+
+        Unlike :meth:`oversample`, the added points are deterministic and
+        vary only in angle, using the wavelength of a measurement whose
+        resolution window contains them.
+        """
+        T, L = _adaptive_sampling(self.T, self.L, self.Qo, self.dQ,
+                                  thickness, n, width, Qc)
+        self._set_calc(T, L)
+
     def _apply_resolution(self, Qin, Rin, interpolation):
         """
         Apply the instrument resolution function
         """
         Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
-        R = convolve(Qin, Rin, Q, dQ)
+        R = self._resolution_matrix(Qin, Q, dQ, interpolation).dot(Rin)
         return Q, R
 
+    def _resolution_matrix(self, Qin, Q, dQ, interpolation):
+        """
+        Return the sparse resolution matrix mapping theory at *Qin* to
+        the measurement points *Q* with resolution *dQ*.
+
+        The matrix is cached, and only recomputed if the calculation points
+        or the theta offset change.  The sampling methods such as
+        :meth:`oversample` clear the cache.
+        """
+        cache = getattr(self, '_resolution_cache', None)
+        if cache is None:
+            cache = self._resolution_cache = {}
+        theta_offset = self.theta_offset.value
+        entry = cache.get(interpolation, None)
+        if (entry is None or entry[0] != theta_offset
+                or not numpy.array_equal(entry[1], Qin)
+                or not numpy.array_equal(entry[2], dQ)):
+            W = convolve_matrix(Qin, Q, dQ)
+            entry = cache[interpolation] = (theta_offset, Qin.copy(),
+                                            numpy.array(dQ), W)
+        return entry[3]
+
     def apply_beam(self, calc_Q, calc_R, resolution=True, interpolation=0):
         """
         Apply factors such as beam intensity, background, backabsorption,
         resolution to the data.
         """
-        # Note: in-place vector operations are not notably faster.
-
         # Handle absorption through the substrate, which occurs when Q<0
         # (condition)*C is C when condition is True or 0 when False,
         # (condition)*(C-1)+1 is C when condition is True or 1 when False.
-        back = (calc_Q<0)*(self.back_absorption.value-1)+1
-        calc_R = calc_R * back
+        # Skip it when there is no absorption or no back reflectivity so
+        # we don't allocate the scale vector and a copy of R on every call.
+        if self.back_absorption.value != 1 and calc_Q.min() < 0:
+            back = (calc_Q<0)*(self.back_absorption.value-1)+1
+            calc_R = calc_R * back
 
         # For back reflectivity, reverse the sign of Q after computing
         if self.back_reflectivity:
@@ -511,7 +568,9 @@ class Probe(object):
             # if it is a problem before optimizing.
             Q, dQ = _interpolate_Q(self.Q, self.dQ, interpolation)
             Q, R = self.Q, numpy.interp(Q, calc_Q, calc_R)
-        R = self.intensity.value*R + self.background.value
+        # R is a new array from the convolution, so update it in place.
+        R *= self.intensity.value
+        R += self.background.value
         return Q, R
 
     def fresnel(self, substrate=None, surface=None):
@@ -833,9 +892,9 @@ class NeutronProbe(Probe):
 class ProbeSet(Probe):
     def __init__(self, probes, name=None):
         self.probes = list(probes)
-        self.R = numpy.hstack(p.R for p in self.probes)
-        self.dR = numpy.hstack(p.dR for p in self.probes)
-        self.dQ = numpy.hstack(p.dQ for p in self.probes)
+        self.R = numpy.hstack([p.R for p in self.probes])
+        self.dR = numpy.hstack([p.dR for p in self.probes])
+        self.dQ = numpy.hstack([p.dQ for p in self.probes])
         self.name = name if name is not None else self.probes[0].name
 
         back_refls = [f.back_reflectivity for f in self.probes]
@@ -850,12 +909,12 @@ class ProbeSet(Probe):
 
     def resynth_data(self):
         for p in self.probes: p.resynth_data()
-        self.R = numpy.hstack(p.R for p in self.probes)
+        self.R = numpy.hstack([p.R for p in self.probes])
     resynth_data.__doc__ = Probe.resynth_data.__doc__
 
     def restore_data(self):
         for p in self.probes: p.restore_data()
-        self.R = numpy.hstack(p.R for p in self.probes)
+        self.R = numpy.hstack([p.R for p in self.probes])
     restore_data.__doc__ = Probe.restore_data.__doc__
 
     def simulate_data(self, theory, noise=2):
@@ -870,21 +929,26 @@ class ProbeSet(Probe):
 
     @property
     def Q(self):
-        return numpy.hstack(p.Q for p in self.probes)
+        return numpy.hstack([p.Q for p in self.probes])
 
     @property
     def calc_Q(self):
-        return numpy.unique(numpy.hstack(p.calc_Q for p in self.probes))
+        return numpy.unique(numpy.hstack([p.calc_Q for p in self.probes]))
 
     @property
     def unique_L(self):
-        return numpy.unique(numpy.hstack(p.unique_L for p in self.probes))
+        return numpy.unique(numpy.hstack([p.unique_L for p in self.probes]))
 
     def oversample(self, **kw):
         for p in self.probes:
             p.oversample(**kw)
     oversample.__doc__ = Probe.oversample.__doc__
 
+    def adaptive_oversample(self, thickness, **kw):
+        for p in self.probes:
+            p.adaptive_oversample(thickness, **kw)
+    adaptive_oversample.__doc__ = Probe.adaptive_oversample.__doc__
+
     def scattering_factors(self, material, density):
         # TODO: support wavelength dependent systems
         return self.probes[0].scattering_factors(material, density)
@@ -1023,7 +1087,7 @@ class ProbeSet(Probe):
             \hat \sigma_R &= \sqrt{\sum \hat \sigma_{R_k}^2}/n
 
         """
-        Q, dQ, R, dR = stitch(self.probes)
+        Q, dQ, R, dR = stitch(self.probes, same_x=same_Q, same_dx=same_dQ)
         Po = self.probes[0]
         return QProbe(Q, dQ, data=(R, dR),
                       intensity=Po.intensity,
@@ -1097,7 +1161,8 @@ def load4(filename, keysep=":", sep=None, comment="#", name=None,
     *FWHM* is True if dQ, dT, dL are given as FWHM rather than 1-\ $\sigma$.
     *dR* is always 1-\ $\sigma$.
     """
-    data = parse_multi(filename, keysep=keysep, sep=sep, comment=comment)
+    data = cached_parse(parse_multi, filename,
+                        keysep=keysep, sep=sep, comment=comment)
     def _as_Qprobe(data):
         Q, R, dR, dQ = data[1]
         if FWHM: # dQ defaults to 1-sigma, if FWHM is not True
@@ -1365,6 +1430,13 @@ class PolarizedNeutronProbe(object):
         self._set_calc(T, L)
     oversample.__doc__ = Probe.oversample.__doc__
 
+    def adaptive_oversample(self, thickness, n=8, width=3, Qc=0):
+        # doc string is inherited from parent (see below)
+        T, L = _adaptive_sampling(self.T, self.L, self.Q, self.dQ,
+                                  thickness, n, width, Qc)
+        self._set_calc(T, L)
+    adaptive_oversample.__doc__ = Probe.adaptive_oversample.__doc__
+
     @property
     def calc_Q(self):
         return self.calc_Qo
@@ -1572,6 +1644,58 @@ def spin_asymmetry(Qp, Rp, dRp, Qm, Rm, dRm):
 
 
 
+def _adaptive_sampling(T, L, Q, dQ, thickness, n, width, Qc):
+    r"""
+    Helper function for adaptive oversampling.
+
+    Returns the measurement points *T*, *L* extended by points on a grid
+    with *n* steps per Kiessig fringe for a film of total *thickness*,
+    covering the window *Q* +/- *width* *dQ* of each measurement which
+    spans more than one step.
+
+    Inside a film with critical edge *Qc* the fringes are periodic in
+    $\sqrt{Q^2-Q_c^2}$, so they are compressed toward the critical edge.
+    The grid step is halved as needed to follow them, which keeps the
+    grids for neighbouring windows aligned so that they share points.
+    """
+    if thickness <= 0:
+        raise ValueError("thickness must be positive")
+    if n < 2:
+        raise ValueError("need at least two points per fringe")
+    base = 2*pi/(thickness*n)
+    Qlo = numpy.maximum(Q - width*dQ, 0)
+    Qhi = Q + width*dQ
+    # Local fringe period relative to the period far from the edge
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        scale = sqrt(numpy.clip(1 - (Qc/Qlo)**2, 0, 1))
+    level = numpy.ceil(-numpy.log2(numpy.maximum(scale, 2.**-_ADAPTIVE_LEVELS)))
+    level = level.astype('i')
+    idx = numpy.nonzero(Qhi - Qlo > base/2.**level)[0]
+    if len(idx) == 0:
+        return T, L
+
+    # Count in units of the finest step used by any window
+    top = numpy.max(level[idx])
+    stride = 2**(top - level[idx])
+    fine = base/2.**top
+    lo = numpy.ceil(Qlo[idx]/(fine*stride)).astype('i')
+    hi = numpy.floor(Qhi[idx]/(fine*stride)).astype('i')
+    lo = numpy.maximum(lo, 1)
+    count = numpy.maximum(hi - lo + 1, 0)
+    owner = numpy.repeat(idx, count)
+    start = numpy.repeat(numpy.cumsum(count) - count, count)
+    k = ((numpy.repeat(lo, count) + numpy.arange(len(owner)) - start)
+         * numpy.repeat(stride, count))
+    # Grid points shared between windows take the wavelength of the first
+    k, first = numpy.unique(k, return_index=True)
+    Qk, Lk = k*fine, L[owner[first]]
+    keep = Qk*Lk < 4*pi
+    Tk = QL2T(Q=Qk[keep], L=Lk[keep])
+    return numpy.hstack((T, Tk)), numpy.hstack((L, Lk[keep]))
+
+# Maximum number of times the grid step is halved near the critical edge
+_ADAPTIVE_LEVELS = 5
+
 def _interpolate_Q(Q, dQ, n):
     """
     Helper function to interpolate between data points.
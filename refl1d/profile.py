@@ -62,6 +62,7 @@ using one energy so we only show the first column.
 import numpy
 from numpy import inf
 from scipy.special import erf
+from bumps.parameter import flatten
 
 class Microslabs(object):
     """
@@ -89,6 +90,13 @@ class Microslabs(object):
         self.dz = dz
         self._z_offset = 0
         self._magnetic_sections = []
+        # _repeats contains (start, period, count) for each repeated block
+        self._repeats = []
+        # _render_cache maps layer => (parameter values, slabs, slabs_rho)
+        self._render_cache = {}
+        # Tolerance and estimated error from the last profile contraction
+        self.contract_dA = None
+        self.contract_error = None
 
     def microslabs(self, thickness=0):
         """
@@ -124,24 +132,66 @@ class Microslabs(object):
         """
         self._num_slabs = 0
         self._magnetic_sections = []
+        self._repeats = []
 
     def __len__(self):
         return self._num_slabs
 
+    def render_layer(self, layer, probe):
+        """
+        Render *layer* into the microslab model.
+
+        If *layer.cache_render* is True, the microslabs produced by the
+        layer are saved along with the values of the layer parameters.
+        When the layer is next rendered with the same parameter values
+        the saved microslabs are spliced into the model instead of
+        rendering the layer again.  Use :meth:`reset_render_cache` if
+        the layer depends on something other than its parameters, such
+        as the scattering factors for the probe.
+        """
+        if not layer.cache_render:
+            layer.render(probe, self)
+            return
+
+        key = [self.dz] + [p.value for p in flatten(layer.layer_parameters())]
+        cached = self._render_cache.get(layer, None)
+        if cached is not None and cached[0] == key:
+            _, slabs, slabs_rho = cached
+            nadd = len(slabs)
+            self._reserve(nadd)
+            idx = slice(self._num_slabs, self._num_slabs+nadd)
+            self._slabs[idx] = slabs
+            self._slabs_rho[idx] = slabs_rho
+            self._num_slabs += nadd
+        else:
+            start = self._num_slabs
+            layer.render(probe, self)
+            idx = slice(start, self._num_slabs)
+            self._render_cache[layer] = (key, self._slabs[idx].copy(),
+                                         self._slabs_rho[idx].copy())
+
+    def reset_render_cache(self):
+        """
+        Forget the saved microslabs for all layers.
+        """
+        self._render_cache = {}
+
     def repeat(self, start=0, count=1, interface=0):
         """
         Extend the model so that there are *count* versions of the slabs
         from *start* to the final slab.
 
         This is equivalent to L.extend(L[start:]*(count-1)) for list L.
+
+        The slabs are copied, but the block is also remembered so that
+        the reflectivity calculation can compute the matrix product for
+        one copy and raise it to a power (see :meth:`repeats`).
         """
-        # For now use the dumb implementation; a better implementation
-        # would remember the repeats and pre-calculate the matrix product
-        # for the repeating region, saving much work later.  This has
-        # to work in conjunction with interfaces and with magnetic profiles.
         repeats = count-1
         end = len(self)
         length = end-start
+        if repeats > 0 and length > 0:
+            self._repeats.append((start, length, count))
         fromidx = slice(start,end)
         toidx = slice(end,end+repeats*length)
         self._reserve(repeats*length)
@@ -155,6 +205,35 @@ class Microslabs(object):
         if self._magnetic_sections:
             raise NotImplementedError("Repeated magnetic layers not implemented")
 
+    def repeats(self):
+        """
+        Return the blocks of repeated slabs as an array of
+        (start, period, count), suitable for passing to
+        :func:`refl1d.reflectivity.reflectivity_amplitude`.
+
+        Only the blocks recorded by :meth:`repeat` whose slabs are still
+        identical in each copy are returned, so blocks which have been
+        merged or reshaped by :meth:`finalize` are computed slab by slab.
+        Where blocks overlap, as for nested repeats, the block which
+        covers the most slabs is used.  Blocks touching the substrate
+        or the surface are ignored.
+        """
+        n = self._num_slabs
+        blocks = []
+        for start, period, count in sorted(self._repeats,
+                                           key=lambda b: -b[1]*(b[2]-1)):
+            end = start + period*count
+            if start < 1 or end > n-1:
+                continue
+            if any(start < s+p*c and s < end for s, p, c in blocks):
+                continue
+            # The interface above the final copy can differ.
+            if (_periodic(self._slabs[start:end, 0], period)
+                    and _periodic(self._slabs[start:end-1, 1], period)
+                    and _periodic(self._slabs_rho[start:end], period)):
+                blocks.append((start, period, count))
+        return numpy.array(sorted(blocks), 'i').reshape(-1, 3)
+
     def _reserve(self, nadd):
         """
         Reserve space for at least *nadd* slabs.
@@ -250,7 +329,8 @@ class Microslabs(object):
     def ismagnetic(self):
         return self._magnetic_sections != []
 
-    def finalize(self, step_interfaces, dA, roughness_limit):
+    def finalize(self, step_interfaces, dA, roughness_limit, dR=None,
+                 Qmax=None):
         """
         Rendering complete.
 
@@ -269,17 +349,24 @@ class Microslabs(object):
         be merged.
 
         *roughness_limit* is the maximum
+
+        *dR* is the target relative error in the reflectivity at *Qmax*.
+        If it is given, the tolerance for merging layers is chosen to
+        give the fewest slabs with an estimated error below *dR*, and
+        *dA* is ignored.  Layers are merged only if they are similar
+        for all wavelengths.  The tolerance used is stored in
+        *contract_dA* and the estimated error in *contract_error*.
         """
         self.w[0] = self.w[-1] = 0
         self._limited_sigma(limit=roughness_limit)
         if self.ismagnetic:
             self._render_magnetic()
-            self._contract_magnetic(dA)
+            self._contract_magnetic(dA, dR, Qmax)
         elif step_interfaces:
             self._render_interfaces()
-            self._contract_profile(dA)
+            self._contract_profile(dA, dR, Qmax)
         else:
-            self._contract_profile(dA)
+            self._contract_profile(dA, dR, Qmax)
 
     def _render_interfaces(self):
         """
@@ -305,43 +392,128 @@ class Microslabs(object):
         self._z_offset = z[0]
         #print "z_offset", self._z_offset
 
-    def _contract_magnetic(self, dA):
-        from .reflmodule import _contract_mag
+    def _contract_magnetic(self, dA, dR=None, Qmax=None):
+        from .reflmodule import _contract_mag_multi
 
         # TODO: do we want to use common boundaries for all lambda?
-        # TODO: don't throw away other wavelengths
-        if dA is None: return
-        w,rho,irho,rhoM,thetaM = \
-            [numpy.ascontiguousarray(v,'d')
-             for v in (self.w,self.rho[0],self.irho[0],self.rhoM, self.thetaM)]
-        #print "final sld before contract",rho[-1]
-        n = _contract_mag(w,rho,irho,rhoM,thetaM,dA)
+        if dA is None and dR is None: return
+        contrast = _contrast(self.rho, self.irho)
+        if dR is None:
+            mag = self.rhoM*numpy.cos(numpy.radians(self.thetaM))
+            contrast = numpy.hstack((contrast,
+                                     max(contrast.max(), numpy.ptp(mag))))
+        else:
+            # Scale the magnetic tolerance to the smallest nuclear contrast
+            # so that its error is bounded relative to every column.
+            contrast = numpy.hstack((contrast, contrast.min()))
+        def contract(dA):
+            w,rho,irho,rhoM,thetaM = \
+                [numpy.array(v,'d',order='C')
+                 for v in (self.w,self.rho,self.irho,self.rhoM,self.thetaM)]
+            err = numpy.empty(len(dA))
+            n = _contract_mag_multi(w,rho,irho,rhoM,thetaM,dA,Qmax or 0.,err)
+            # Magnetic errors add to the nuclear errors in each column
+            error = (err[:-1] + err[-1])/contrast[:-1]
+            return n, error.max(), (w,rho,irho,rhoM,thetaM)
+        # The magnetization vector adds up to sqrt(2) dA to each layer.
+        n, (w,rho,irho,rhoM,thetaM) = \
+            self._contract(contract, contrast, dA, dR, Qmax,
+                           bound=2+numpy.sqrt(2))
+        #print "final sld before contract",rho[0][-1]
         self._num_slabs = n
         self.w[:] = w[:n]
-        self.rho[0][:] = rho[:n]
-        self.irho[0][:] = irho[:n]
+        self.rho[:] = rho[:,:n]
+        self.irho[:] = irho[:,:n]
         self.rhoM = rhoM[:n]
         self.thetaM = thetaM[:n]
         self.sigma[:] = 0
-        #print "final sld after contract",rho[n-1],self.rho[0][n-1],n
+        #print "final sld after contract",rho[0][n-1],self.rho[0][n-1],n
 
-    def _contract_profile(self, dA):
-        from .reflmodule import _contract_by_area
+    def _contract_profile(self, dA, dR=None, Qmax=None):
+        from .reflmodule import _contract_by_area_multi
 
         # TODO: do we want to use common boundaries for all lambda?
-        # TODO: don't throw away other wavelengths
-        if dA is None: return
-        w,sigma,rho,irho = \
-            [numpy.ascontiguousarray(v,'d')
-             for v in (self.w,self.sigma,self.rho[0],self.irho[0])]
-        #print "final sld before contract",rho[-1]
-        n = _contract_by_area(w,sigma,rho,irho,dA)
+        if dA is None and dR is None: return
+        contrast = _contrast(self.rho, self.irho)
+        def contract(dA):
+            w,sigma,rho,irho = \
+                [numpy.array(v,'d',order='C')
+                 for v in (self.w,self.sigma,self.rho,self.irho)]
+            err = numpy.empty(len(dA))
+            n = _contract_by_area_multi(w,sigma,rho,irho,dA,Qmax or 0.,err)
+            return n, (err/contrast).max(), (w,sigma,rho,irho)
+        n, (w,sigma,rho,irho) = \
+            self._contract(contract, contrast, dA, dR, Qmax)
+        #print "final sld before contract",rho[0][-1]
         self._num_slabs = n
         self.w[:] = w[:n]
-        self.rho[0,:] = rho[:n]
-        self.irho[0,:] = irho[:n]
+        self.rho[:] = rho[:,:n]
+        self.irho[:] = irho[:,:n]
         self.sigma[:] = sigma[:n-1]
-        #print "final sld after contract",rho[n-1],self.rho[0][n-1],n
+        #print "final sld after contract",rho[0][n-1],self.rho[0][n-1],n
+
+    def _contract(self, contract, contrast, dA, dR, Qmax, bound=2):
+        """
+        Choose the tolerance for merging slabs and return the contracted
+        slabs as (n, arrays).
+
+        *contract(dA)* merges a copy of the slabs with tolerance dA[k] for
+        column k, returning (n, error, arrays) with the error in the
+        profile relative to the column *contrast*.  The error in each
+        merged layer is at most *bound* times the tolerance.
+
+        In the kinematic approximation, changing the profile by $\delta\rho$
+        changes the reflection amplitude at $Q$ by
+        $4\pi/Q |\int \delta\rho(z) e^{iQz} dz|$, while the Fresnel
+        reflection amplitude for a step of height $\Delta\rho$ is
+        $4\pi\Delta\rho/Q^2$.  Merging slices into a layer of thickness
+        $D$ gives a $\delta\rho$ which averages to zero over the layer, so
+        the integral is at most $\int |\delta\rho| dz \min(1, QD/2)$.
+        With $\Delta\rho$ the contrast and $E$ the sum of these bounds at
+        $Q_\max$, the relative error in the reflectivity at $Q_\max$ and
+        below is at most $(1 + Q_\max E/\Delta\rho)^2 - 1$.
+        """
+        def estimate(error):
+            return (1 + Qmax*error)**2 - 1 if Qmax else None
+
+        if dR is None:
+            n, error, arrays = contract(dA*numpy.ones_like(contrast))
+            self.contract_dA, self.contract_error = dA, estimate(error)
+            return n, arrays
+
+        if not Qmax:
+            raise ValueError("need Qmax to contract the profile to error dR")
+        # The box area condition bounds the error in each layer by
+        # bound*dA relative to the contrast, so dA = target/(bound n)
+        # always succeeds.
+        # Increase the tolerance until the error is too large or everything
+        # is merged, then bisect to find the fewest slabs.
+        target = (numpy.sqrt(1 + dR) - 1)/Qmax
+        scale = lo = target/(bound*len(self.w))
+        best = (lo,) + contract(lo*contrast)
+        hi, limit = None, 2*numpy.sum(self.w)
+        while scale < limit:
+            scale *= 2
+            trial = (scale,) + contract(scale*contrast)
+            if trial[2] > target:
+                hi = scale
+                break
+            lo = scale
+            if trial[1:3] <= best[1:3]:
+                best = trial
+        if hi is not None:
+            for _ in range(8):
+                scale = numpy.sqrt(lo*hi)
+                trial = (scale,) + contract(scale*contrast)
+                if trial[2] > target:
+                    hi = scale
+                else:
+                    lo = scale
+                    if trial[1:3] <= best[1:3]:
+                        best = trial
+        scale, n, error, arrays = best
+        self.contract_dA, self.contract_error = scale*contrast, estimate(error)
+        return n, arrays
 
     def _DEAD_apply_smoothness(self, dA, smoothness=0.3):
         """
@@ -446,8 +618,7 @@ class Microslabs(object):
         # Fill in gaps for magnetic profile
         wM, rhoM, thetaM, sigmaM = self._join_magnetic_sections()
 
-        rhoM = build_profile(z, wM, sigmaM, rhoM)
-        thetaM = build_profile(z, wM, sigmaM, thetaM)
+        rhoM, thetaM = build_profile(z, wM, sigmaM, [rhoM, thetaM])
         #print [len(v) for v in w, rho, irho, rhoM, thetaM]
 
         self.rhoM = rhoM
@@ -513,11 +684,27 @@ class Microslabs(object):
         right = thickness + max(10,self.sigma[-1]*3)
         z = numpy.arange(left,right+dz,dz)
         # Only show the first wavelength
-        rho  = build_profile(z, self.w, self.sigma, self.rho[0])
-        irho = build_profile(z, self.w, self.sigma, self.irho[0])
+        rho, irho = build_profile(z, self.w, self.sigma,
+                                  [self.rho[0], self.irho[0]])
         return z,rho,irho
 
 
+def _contrast(rho, irho):
+    """
+    Return the range of the scattering potential in each column, using 1
+    for flat profiles.
+    """
+    contrast = numpy.hypot(numpy.ptp(rho, axis=1), numpy.ptp(irho, axis=1))
+    contrast[contrast == 0] = 1.
+    return contrast
+
+
+def _periodic(v, period):
+    """
+    Return True if v[i] == v[i+period] for all i.
+    """
+    return numpy.array_equal(v[period:], v[:-period])
+
 def compute_limited_sigma(thickness, roughness, limit):
     # Limit roughness to the depths of the surrounding layers.  Roughness
     # of the first and last layers interfaces is limited only by the
@@ -548,43 +735,60 @@ def build_profile(z, thickness, roughness, value):
     *z*          calculation points
     *thickness*  thickness of the layers (first and last values ignored)
     *roughness*  roughness of the interfaces (one less than d)
-    *value*      profile being computed
-    *max_rough*  limit the roughness to a fraction of the layer thickness
+    *value*      profile being computed, or k x n array for k profiles
+                 which share the same layer boundaries
+
+    Each point takes its value from the layer containing it, blended with
+    the neighbouring layers according to the distance to the interfaces
+    on either side.  The blend weights are computed once for all profiles
+    in *value*, and the error function is only evaluated near each
+    interface, where the blend is distinguishable from zero.
     """
+    z = numpy.asarray(z, 'd')
+    thickness = numpy.asarray(thickness, 'd')
+    roughness = numpy.asarray(roughness, 'd')
 
     # Find interface depths
     offset = numpy.hstack( (-inf, 0, numpy.cumsum(thickness[1:-1]), inf) )
 
-    # gives the layer boundaries in terms of the index of the z
-    idx = numpy.searchsorted(z, offset)
-    # TODO: The following hack makes sure the final z value is calculated.
-    # TODO: Make sure it works even when z is wider than the range of offsets.
-    if idx[-1] < len(z):
-        idx[-1] = len(z)
-
-    # compute the results
-    result = numpy.empty_like(z)
-    for i,mvalue in enumerate(value):
-        zo = z[idx[i]:idx[i+1]]
-        if i==0:
-            lsigma = lvalue = lblend = 0
-        else:
-            lsigma = roughness[i-1]
-            lvalue = value[i-1]
-            lblend = blend(zo-offset[i],lsigma)
-        if i >= len(value)-1:
-            rsigma = rvalue = rblend = 0
-        else:
-            rsigma = roughness[i]
-            rvalue = value[i+1]
-            rblend = blend(offset[i+1]-zo,rsigma)
-        #print "zo",i,zo
-        #print "lblend",lsigma,lblend
-        #print "rblend",rsigma,rblend
-        mblend = 1 - (lblend+rblend)
-        result[idx[i]:idx[i+1]] = mvalue*mblend + lvalue*lblend + rvalue*rblend
-        #result[idx[i]:idx[i+1]] = rvalue*rblend
-
+    # Layer containing each z, with points on a boundary belonging to the
+    # layer above the boundary.  A lone substrate extends to +inf.
+    layer = numpy.searchsorted(offset, z, side='right') - 1
+    layer = numpy.minimum(layer, len(thickness)-1)
+
+    # Portion of the layers below and above at each point.
+    lblend = numpy.zeros_like(z)
+    rblend = numpy.zeros_like(z)
+    idx = numpy.flatnonzero(layer > 0)
+    lblend[idx] = _blend_window(z[idx]-offset[layer[idx]],
+                                roughness[layer[idx]-1])
+    idx = numpy.flatnonzero(layer < len(thickness)-1)
+    rblend[idx] = _blend_window(offset[layer[idx]+1]-z[idx],
+                                roughness[layer[idx]])
+    mblend = 1 - (lblend+rblend)
+
+    # Pad with zero values beyond the surround so lvalue and rvalue are
+    # defined for every layer.
+    value = numpy.asarray(value, 'd')
+    padded = numpy.zeros(value.shape[:-1] + (value.shape[-1]+2,))
+    padded[..., 1:-1] = value
+    lvalue = padded[..., layer]
+    mvalue = padded[..., layer+1]
+    rvalue = padded[..., layer+2]
+    return mvalue*mblend + lvalue*lblend + rvalue*rblend
+
+# Number of roughness widths beyond which the interface blend is zero
+# in double precision, since erf(6) rounds to 1.
+_BLEND_WINDOW = 6*numpy.sqrt(2.0)
+
+def _blend_window(z, rough):
+    """
+    Vectorized :func:`blend` for distances *z* >= 0 from the interface,
+    with a separate roughness for each point.
+    """
+    result = numpy.where(numpy.greater(z, 0), 0.0, 1.0)
+    idx = numpy.flatnonzero((rough > 0) & (z < _BLEND_WINDOW*rough))
+    result[idx] = 0.5*( 1.0 - erf( z[idx]/( rough[idx]*numpy.sqrt(2.0) ) ) )
     return result
 
 def blend(z, rough):
@@ -2,7 +2,9 @@
 1-D and 2-D rebinning code.
 """
 
-__all__ = ["bin_edges", "logbin_edges", "rebin", "rebin2d"]
+__all__ = ["bin_edges", "logbin_edges", "rebin", "rebin2d", "Rebin2D"]
+
+import multiprocessing.pool
 
 import numpy as np
 
@@ -122,7 +124,7 @@ def rebin(x, I, xo, Io=None, dtype=np.float64):
     return Io
 
 
-def rebin2d(x, y, I, xo, yo, Io=None, dtype=None):
+def rebin2d(x, y, I, xo, yo, Io=None, dtype=None, threads=None):
     """
     Rebin a matrix.
 
@@ -158,6 +160,13 @@ def rebin2d(x, y, I, xo, yo, Io=None, dtype=None):
     correct shape and type for the input.  Otherwise it will raise a
     TypeError.  This will allow you to rebin the slices of an appropriately
     ordered matrix without making copies.
+
+    *threads* is the number of threads to use, or None to rebin in the
+    calling thread.  With threads, the rows of the result are split into
+    tiles which are rebinned independently, giving the same result as
+    the single threaded calculation.  The compiled kernel releases the
+    global interpreter lock, so other python threads can run as well.
+    Use :class:`Rebin2D` to rebin a stack of frames onto the same grid.
     """
     from . import reflmodule as _cmodule
 
@@ -187,10 +196,94 @@ def rebin2d(x, y, I, xo, yo, Io=None, dtype=None):
                         + I.dtype.name)
     # print x.shape, y.shape, I.shape, xo.shape, yo.shape, Io.shape
     # print x.dtype, y.dtype, I.dtype, xo.dtype, yo.dtype, Io.dtype
-    rebincore(x, y, I, xo, yo, Io)
+    if threads is None or threads <= 1 or len(Io) < 2:
+        rebincore(x, y, I, xo, yo, Io)
+    else:
+        # Rows of Io are contiguous, so each tile is a slice of the result.
+        # Use a few tiles per thread to balance the load.
+        n = len(Io)
+        cuts = np.unique(np.linspace(0, n, min(n, 4*threads)+1).astype(int))
+        tiles = list(zip(cuts[:-1], cuts[1:]))
+        _thread_map(lambda t: rebincore(x, y, I, xo[t[0]:t[1]+1], yo,
+                                        Io[t[0]:t[1]]),
+                    tiles, threads)
     return Io
 
 
+class Rebin2D(object):
+    """
+    Rebin frames from edges *x*, *y* to edges *xo*, *yo*.
+
+    The overlap weights along each axis are computed once when the
+    rebinner is created and reused for each frame, which saves time when
+    rebinning a stack of detector frames onto the same grid.  Calling
+    the rebinner with counts of shape (len(x)-1, len(y)-1) returns the
+    rebinned frame, the same as :func:`rebin2d` with float64 counts.
+    Counts of shape (n, len(x)-1, len(y)-1) are rebinned as *n* frames.
+    The result is always float64.
+
+    *threads* is the number of threads used to rebin a stack of frames,
+    or None to rebin them in the calling thread.
+    """
+    def __init__(self, x, y, xo, yo, threads=None):
+        x, y, xo, yo = [_input(v, dtype='d') for v in (x, y, xo, yo)]
+        self.shape_in = (len(x) - 1, len(y) - 1)
+        self.shape_out = (len(xo) - 1, len(yo) - 1)
+        self._x_weights = _rebin_weights(x, xo)
+        self._y_weights = _rebin_weights(y, yo)
+        self.threads = threads
+
+    def __call__(self, I):
+        I = _input(I, dtype='d')
+        if I.ndim < 2 or I.shape[-2:] != self.shape_in:
+            raise TypeError("input array incorrect shape %s" % str(I.shape))
+        Io = np.empty(I.shape[:-2] + self.shape_out, dtype='d')
+        frames = I.reshape((-1,) + self.shape_in)
+        out = Io.reshape((-1,) + self.shape_out)
+        n = len(frames)
+        if self.threads is None or self.threads <= 1 or n < 2:
+            self._rebin(frames, out)
+        else:
+            cuts = np.unique(np.linspace(0, n, min(n, 4*self.threads)+1)
+                             .astype(int))
+            _thread_map(lambda t: self._rebin(frames[t[0]:t[1]],
+                                              out[t[0]:t[1]]),
+                        list(zip(cuts[:-1], cuts[1:])), self.threads)
+        return Io
+
+    def _rebin(self, frames, out):
+        from . import reflmodule as _cmodule
+        _cmodule.rebin2d_weights(*(self._x_weights + self._y_weights
+                                   + (self.shape_in[0], self.shape_in[1],
+                                      frames, self.shape_out[0],
+                                      self.shape_out[1], out)))
+
+
+def _rebin_weights(x, xo):
+    """
+    Return the overlapping bin pairs (from, to, weight) from *x* to *xo*.
+    """
+    from . import reflmodule as _cmodule
+
+    n = max(len(x) + len(xo) - 3, 0)
+    from_bin, to_bin = np.empty(n, 'i'), np.empty(n, 'i')
+    weight = np.empty(n, 'd')
+    nnz = _cmodule.rebin_weights(x, xo, from_bin, to_bin, weight)
+    return from_bin[:nnz].copy(), to_bin[:nnz].copy(), weight[:nnz].copy()
+
+
+def _thread_map(fn, items, threads):
+    """
+    Call *fn* on each item in a pool of *threads* threads.
+    """
+    pool = multiprocessing.pool.ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(fn, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def _input(v, dtype='d'):
     """
     Force v to be a contiguous array of the correct type, avoiding copies
@@ -262,6 +355,13 @@ def _check_one_2d(x, y, z, xo, yo, zo):
         "rebin2d failed for %s,%s->%s,%s\nexpected: %s\nbut got: %s" \
         % (x, y, xo, yo, zo, z)
 
+    # Tiles and precomputed weights give the same result
+    tiled = rebin2d(x, y, z, xo, yo, threads=3)
+    assert np.array_equal(tiled, result), "tiled rebin2d failed"
+    weighted = Rebin2D(x, y, xo, yo, threads=2)(np.array([z, z], 'd'))
+    assert np.linalg.norm(np.array([target, target]) - weighted) < 1e-13, \
+        "Rebin2D failed for %s,%s->%s,%s" % (x, y, xo, yo)
+
 
 def _check_uniform_2d(x, y):
     z = np.array([y], 'd') * np.array([x], 'd').T
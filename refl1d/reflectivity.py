@@ -14,8 +14,10 @@ from six.moves import reduce
 #__doc__ = "Fundamental reflectivity calculations"
 __author__ = "Paul Kienzle"
 __all__ = [ 'reflectivity', 'reflectivity_amplitude',
+            'reflectivity_amplitude_batch', 'reflectivity_jacobian',
+            'PartialAmplitude',
             'magnetic_reflectivity', 'magnetic_amplitude',
-            'unpolarized_magnetic', 'convolve',
+            'unpolarized_magnetic', 'convolve', 'convolve_matrix',
             ]
 
 import numpy as np
@@ -26,6 +28,15 @@ from numpy import pi, sin, cos, conj, radians
 def _dense(x, dtype='d'):
     return np.ascontiguousarray(x, dtype)
 
+def _output(out, shape, dtype='d'):
+    if out is None:
+        return np.empty(shape, dtype)
+    if (out.shape != shape or out.dtype != np.dtype(dtype)
+            or not out.flags.c_contiguous):
+        raise ValueError("out should be a contiguous %s array of shape %s"
+                         % (np.dtype(dtype).name, shape))
+    return out
+
 
 def reflectivity(*args, **kw):
     """
@@ -64,6 +75,8 @@ def reflectivity_amplitude(kz=None,
                            irho=0,
                            sigma=0,
                            rho_index=None,
+                           out=None,
+                           repeats=None,
                            ):
     r"""
     Calculate reflectivity amplitude $r(k_z)$ from slab model.
@@ -85,6 +98,19 @@ def reflectivity_amplitude(kz=None,
             Points at which to evaluate the reflectivity
         *rho_index* = 0 : integer[M]
             *rho* and *irho* columns to use for the various kz.
+        *out* = None : complex[M]
+            Optional array to hold the result, which saves allocating
+            a new array on each call.
+        *repeats* = None : integer[B,3]
+            Blocks of repeated layers as (start, period, count), with
+            layers start through start+period*count-1 forming *count*
+            identical copies of the first *period* layers.  The blocks
+            must be sorted, must not overlap, and must not include the
+            substrate or the surface.  The matrix product for one period
+            is raised to the power count-1, so the cost of the block grows
+            with log(count) rather than count.  The layers are assumed to
+            repeat; use :meth:`refl1d.profile.Microslabs.repeats` to
+            find the blocks which do.
 
     :Returns:
         *r* | complex[M]
@@ -113,14 +139,281 @@ def reflectivity_amplitude(kz=None,
 
     #print depth.shape,rho.shape,irho.shape,sigma.shape
     #print depth.dtype,rho.dtype,irho.dtype,sigma.dtype
-    r = np.empty(kz.shape,'D')
+    r = _output(out, kz.shape, 'D')
     #print "amplitude",depth,rho,kz,rho_index
     #print depth.shape, sigma.shape, rho.shape, irho.shape, kz.shape
-    reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
-                                       rho_index, r)
+    if repeats is not None and len(repeats):
+        repeats = _dense(np.reshape(repeats, -1), 'i')
+        reflmodule._reflectivity_amplitude_repeat(depth, sigma, rho, irho, kz,
+                                                  rho_index, repeats, r)
+    else:
+        reflmodule._reflectivity_amplitude(depth, sigma, rho, irho, kz,
+                                           rho_index, r)
+    return r
+
+
+def reflectivity_amplitude_batch(kz=None,
+                                 depth=None,
+                                 rho=None,
+                                 irho=0,
+                                 sigma=0,
+                                 ):
+    r"""
+    Calculate reflectivity amplitude $r(k_z)$ for a set of slab models.
+
+    This is equivalent to calling :func:`reflectivity_amplitude` once for
+    each model, but the models are evaluated together in a single call to
+    the compiled kernel.  Population based fitters such as DE and DREAM
+    can use this to evaluate all members of the population at once.
+
+    Layers at the bottom and top of the stack which are the same in every
+    model, such as the substrate and a capping layer when only a buried
+    film varies, are detected and their transfer matrix products are
+    computed once for each *kz* rather than once for each model.
+
+    :Parameters :
+        *depth* : [float[N_k]] | |Ang|
+            Thickness of the individual layers for each of the K models
+            (incident and substrate depths are ignored).  The models
+            may have different numbers of layers.
+        *sigma* = 0 : float OR [float OR float[N_k-1]] | |Ang|
+            Interface roughness between the current layer and the next
+            for each model.
+        *rho*, *irho* = 0: [float[N_k]] | |1e-6/Ang^2|
+            Real and imaginary scattering length density for each model.
+            Unlike :func:`reflectivity_amplitude`, only one column of
+            scattering length density is supported.
+        *kz* : float[M] | |1/Ang|
+            Points at which to evaluate the reflectivity, shared by all
+            the models.
+
+    :Returns:
+        *r* | complex[K,M]
+            Complex reflectivity waveform, one row per model.
+
+    This function does not compute any instrument resolution corrections.
+    """
+    from . import reflmodule
+
+    kz = _dense(kz, 'd')
+    depth = [_dense(d, 'd') for d in depth]
+    nmodels = len(depth)
+    if np.isscalar(sigma):
+        sigma = [sigma]*nmodels
+    if np.isscalar(irho):
+        irho = [irho]*nmodels
+    if len(rho) != nmodels or len(irho) != nmodels or len(sigma) != nmodels:
+        raise ValueError("depth, rho, irho and sigma need one entry per model")
+
+    layers = [len(d) for d in depth]
+    offset = np.hstack((0, np.cumsum(layers))).astype('i')
+    def _stack(values, sizes):
+        return _dense(np.hstack([v*np.ones(n, 'd') if np.isscalar(v)
+                                 else _dense(v, 'd').flatten()
+                                 for v, n in zip(values, sizes)]), 'd')
+    depth = _stack(depth, layers)
+    rho = _stack(rho, layers)
+    irho = _stack(irho, layers)
+    sigma = _stack(sigma, [n-1 for n in layers])
+
+    lo, top = _shared_layers(offset, depth, sigma, rho, irho)
+    r = np.empty((nmodels, len(kz)), 'D')
+    reflmodule._reflectivity_amplitude_batch(offset, depth, sigma, rho, irho,
+                                             kz, r, lo, top)
     return r
 
 
+def _shared_layers(offset, depth, sigma, rho, irho):
+    """
+    Return the number of layers (lo, top) at the bottom and top of the
+    stack which are the same for all the models stored end to end, or
+    (0, 0) if the incident media differ.
+    """
+    nmodels = len(offset) - 1
+    nmin = np.min(np.diff(offset))
+    if nmodels < 2 or nmin < 2:
+        return 0, 0
+    # One row per layer with depth, roughness of the interface above,
+    # and rho, irho, as for PartialAmplitude.
+    above = np.zeros(len(depth))
+    above[np.delete(np.arange(len(depth)), offset[1:]-1)] = sigma
+    layers = np.vstack((depth, above, rho, irho)).T
+    step = np.arange(nmin)
+    bottom = layers[offset[:-1, None] + step]
+    same = (bottom == bottom[0]).all(axis=(0, 2))
+    lo = nmin if same.all() else np.argmin(same)
+    upper = layers[offset[1:, None] - 1 - step]
+    same = (upper == upper[0]).all(axis=(0, 2))
+    top = nmin if same.all() else np.argmin(same)
+    lo = min(lo, nmin-1)
+    top = min(top, nmin-lo)
+    return (lo, top) if lo > 0 and top > 0 else (0, 0)
+
+
+def reflectivity_jacobian(kz=None,
+                          depth=None,
+                          rho=None,
+                          irho=0,
+                          sigma=0,
+                          ):
+    r"""
+    Calculate reflectivity amplitude $r(k_z)$ and its derivatives with
+    respect to the slab parameters.
+
+    The derivatives for all the layers come from one pass forward and one
+    pass back through the stack, so they cost about three times as much
+    as the amplitude alone rather than once per parameter.
+
+    :Parameters :
+        *depth* : float[N] | |Ang|
+            Thickness of the individual layers (incident and substrate
+            depths are ignored)
+        *sigma* = 0 : float OR float[N-1] | |Ang|
+            Interface roughness between the current layer and the next.
+        *rho*, *irho* = 0: float[N] | |1e-6/Ang^2|
+            Real and imaginary scattering length density.  Unlike
+            :func:`reflectivity_amplitude`, only one column of scattering
+            length density is supported.
+        *kz* : float[M] | |1/Ang|
+            Points at which to evaluate the reflectivity
+
+    :Returns:
+        *r* | complex[M]
+            Complex reflectivity waveform.
+        *dr_depth*, *dr_rho*, *dr_irho* | complex[N,M]
+            Derivative of *r* with respect to the thickness and the
+            scattering length density of each layer.
+        *dr_sigma* | complex[N-1,M]
+            Derivative of *r* with respect to the roughness of each
+            interface.
+
+    The derivative of the reflectivity $|r|^2$ with respect to parameter
+    $x$ is $2\,\mathrm{Re}(\bar r\, dr/dx)$.
+
+    This function does not compute any instrument resolution corrections.
+    """
+    from . import reflmodule
+
+    kz = _dense(kz, 'd')
+    depth = _dense(depth, 'd')
+    n = len(depth)
+    if np.isscalar(sigma):
+        sigma = sigma*np.ones(n-1, 'd')
+    if np.isscalar(irho):
+        irho = irho*np.ones(n, 'd')
+    sigma, rho, irho = [_dense(v, 'd') for v in (sigma, rho, irho)]
+
+    r = np.empty(kz.shape, 'D')
+    dr_depth, dr_rho, dr_irho = [np.empty((n, len(kz)), 'D') for _ in range(3)]
+    dr_sigma = np.empty((n-1, len(kz)), 'D')
+    reflmodule._reflectivity_jacobian(depth, sigma, rho, irho, kz, r,
+                                      dr_depth, dr_sigma, dr_rho, dr_irho)
+    return r, dr_depth, dr_sigma, dr_rho, dr_irho
+
+
+class PartialAmplitude(object):
+    r"""
+    Reflectivity amplitude $r(k_z)$ which reuses the work from the
+    previous call for the layers which have not changed.
+
+    Call this with the same arguments as :func:`reflectivity_amplitude`.
+    The layers are compared against the previous call, and if only the
+    layers in the middle of the stack have changed then the transfer
+    matrix products for the unchanged layers on either side are reused.
+    This is useful when fitting a film on a fixed substrate or beneath
+    a fixed capping layer, where the bulk of the stack is the same from
+    one evaluation to the next.  Layers are matched by counting from
+    either end of the stack, so the changed region may gain or lose
+    layers without invalidating the saved products.
+
+    The first call on a new region of change computes the full matrix
+    product and saves the parts on either side of the region; after that
+    each call costs in proportion to the number of changed layers so long
+    as the changes stay within that region.  Changes to the incident or
+    substrate media, to *kz* or to *rho_index* force a full calculation.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the saved model, forcing a full calculation on the next call.
+        """
+        self._kz = self._rho_index = self._layers = self._r = None
+        self._pre = self._post = None
+        self._split = None
+
+    def __call__(self, kz=None, depth=None, rho=None, irho=0, sigma=0,
+                 rho_index=None, out=None):
+        from . import reflmodule
+
+        kz = _dense(kz, 'd')
+        if rho_index is None:
+            rho_index = np.zeros(kz.shape,'i')
+        else:
+            rho_index = _dense(rho_index, 'i')
+        depth = _dense(depth, 'd')
+        if np.isscalar(sigma):
+            sigma = sigma*np.ones(len(depth)-1, 'd')
+        else:
+            sigma = _dense(sigma, 'd')
+        rho = _dense(rho, 'd')
+        if np.isscalar(irho):
+            irho = irho * np.ones_like(rho)
+        else:
+            irho = _dense(irho, 'd')
+
+        # One row per layer with depth, roughness of the interface above,
+        # and the rho, irho values for each column.
+        n = len(depth)
+        layers = np.vstack((depth, np.hstack((sigma, 0.)),
+                            rho.reshape(-1, n), irho.reshape(-1, n))).T
+
+        if (self._layers is None
+                or layers.shape[1] != self._layers.shape[1]
+                or not np.array_equal(kz, self._kz)
+                or not np.array_equal(rho_index, self._rho_index)):
+            bottom = top = 0
+        else:
+            m = min(n, len(self._layers))
+            same = (layers[:m] == self._layers[:m]).all(axis=1)
+            bottom = m if same.all() else np.argmin(same)
+            same = (layers[::-1][:m] == self._layers[::-1][:m]).all(axis=1)
+            top = m if same.all() else np.argmin(same)
+            if bottom == m and top == m and n == len(self._layers):
+                r = _output(out, kz.shape, 'D')
+                r[:] = self._r
+                return r
+
+        r = _output(out, kz.shape, 'D')
+        if self._split is not None and bottom >= self._split[0] \
+                and top >= self._split[1] and n >= sum(self._split):
+            lo, hi = self._split[0], n - self._split[1]
+            reflmodule._reflectivity_amplitude_partial(
+                depth, sigma, rho, irho, kz, rho_index, lo, hi, 0,
+                self._pre, self._post, r)
+        elif bottom > 0 and top > 0 and n > 1:
+            # Save the products either side of the changed region, which
+            # may be empty if only the layer count changed.
+            lo, hi = min(bottom, n-1), max(n - top, 1)
+            if hi < lo:
+                lo = hi = min(lo, hi)
+            self._pre = np.empty(4*len(kz), 'D')
+            self._post = np.empty(4*len(kz), 'D')
+            reflmodule._reflectivity_amplitude_partial(
+                depth, sigma, rho, irho, kz, rho_index, lo, hi, 1,
+                self._pre, self._post, r)
+            self._split = (lo, n - hi)
+        else:
+            reflmodule._reflectivity_amplitude(
+                depth, sigma, rho, irho, kz, rho_index, r)
+            self._split = self._pre = self._post = None
+
+        self._kz, self._rho_index = kz.copy(), rho_index.copy()
+        self._layers, self._r = layers, r.copy()
+        return r
+
+
 def magnetic_reflectivity(*args,**kw):
     """
     Magnetic reflectivity for slab models.
@@ -150,6 +443,9 @@ def magnetic_reflectivity(*args,**kw):
         Angle of the magnetism within the layer.
     Aguide (degrees)
         Angle of the guide field; -90 is the usual case
+    xs
+        Flags for the cross sections to compute, or None for all four.
+        The cross sections which are not computed are returned as None.
 
     This function does not compute any instrument resolution corrections
     or interface diffusion
@@ -157,14 +453,25 @@ def magnetic_reflectivity(*args,**kw):
     Use magnetic_amplitude to return the complex waveform.
     """
     r = magnetic_amplitude(*args,**kw)
-    return [(z*z.conj()).real for z in r]
+    return [((z*z.conj()).real if z is not None else None) for z in r]
 
 def unpolarized_magnetic(*args,**kw):
     """
     Returns the average of magnetic reflectivity for all cross-sections.
 
     See :class:`magnetic_reflectivity <refl1d.reflectivity.magnetic_reflectivity>` for details.
+
+    If the magnetic field in every layer is parallel to the guide field,
+    then the spin flip cross sections are zero and the non spin flip
+    cross sections are computed with the faster nonmagnetic kernel.
+
+    The unpolarized reflectivity is the sum of all four cross sections,
+    so *xs* cannot be used to skip any of them; a ValueError is raised
+    if it does not select all four.
     """
+    xs = kw.pop('xs', None)
+    if xs is not None and not all(xs):
+        raise ValueError("unpolarized reflectivity needs all cross sections")
     return reduce(np.add, magnetic_reflectivity(*args,**kw))/2.
 
 B2SLD = 2.31604654  # Scattering factor for B field 1e-6/
@@ -180,6 +487,7 @@ def magnetic_amplitude(kz,
                        H=0,
                        rho_index=None,
                        rotate_M=True,
+                       xs=None,
                        ):
     """
     Returns the complex magnetic reflectivity waveform.
@@ -237,6 +545,14 @@ def magnetic_amplitude(kz,
     sld_b_y = sld_h_y + sld_m_y
     sld_b_z = sld_h_z + sld_m_z
 
+    # If B is everywhere along the quantization axis then there is no
+    # spin flip, and ++ and -- are nonmagnetic reflectivities for rho +/- B.
+    if xs is None:
+        xs = (True, True, True, True)
+    if Aguide == 0.0 and _collinear(sld_b_x, sld_b_y, sld_b_z):
+        return _collinear_amplitude(kz, depth, rho, irho, sld_b_z, rho_index,
+                                    xs)
+
     # avoid divide-by-zero:
     sld_b_x += EPS*(sld_b_x==0)
     sld_b_y += EPS*(sld_b_y==0)
@@ -253,18 +569,59 @@ def magnetic_amplitude(kz,
     #print "u1",u1
     #print "u3",u3
     
-    R1,R2,R3,R4 = [np.empty(kz.shape,'D') for pol in (1,2,3,4)]
+    R1,R2,R3,R4 = [(np.empty(kz.shape,'D') if want else None) for want in xs]
     reflmodule._magnetic_amplitude(depth, sigma, rho, irho,
                                    sld_b, u1, u3, Aguide, kz, rho_index,
                                    R1, R2, R3, R4)
     return R1,R2,R3,R4
 
 
-def convolve(xi, yi, x, dx):
+def _collinear(sld_b_x, sld_b_y, sld_b_z, tol=1e-10):
+    """
+    Return True if the transverse field is negligible in every layer.
+
+    Rounding in the rotation by Aguide leaves a transverse component of
+    order 1e-16 even when the magnetism is parallel to the guide field.
+    """
+    transverse = np.max(np.hypot(sld_b_x, sld_b_y))
+    return transverse <= tol*np.max(abs(sld_b_z))
+
+
+def _collinear_amplitude(kz, depth, rho, irho, sld_b_z, rho_index, xs):
+    """
+    Magnetic reflectivity waveform when B is along the quantization axis.
+
+    The ++ and -- cross sections come from two calls to the nonmagnetic
+    kernel and the spin flip cross sections are zero.  The interfaces are
+    sharp and the absorption positive, as in the 4x4 kernel, and the
+    waveform is conjugated to match its phase convention.
+    """
+    from . import reflmodule
+
+    n = len(depth)
+    sigma = np.zeros(n-1, 'd')
+    rho = np.reshape(rho, (-1, n))
+    irho = _dense(abs(np.reshape(irho, (-1, n))), 'd')
+    R = [None]*4
+    for k, rho_B in ((0, rho + sld_b_z), (3, rho - sld_b_z)):
+        if xs[k]:
+            R[k] = np.empty(kz.shape, 'D')
+            reflmodule._reflectivity_amplitude(depth, sigma,
+                                               _dense(rho_B, 'd'), irho, kz,
+                                               rho_index, R[k])
+            np.conj(R[k], out=R[k])
+    for k in (1, 2):
+        if xs[k]:
+            R[k] = np.zeros(kz.shape, 'D')
+    return tuple(R)
+
+
+def convolve(xi, yi, x, dx, out=None):
     """
     Apply x-dependent gaussian resolution to the theory.
 
-    Returns convolution y[k] of width dx[k] at points x[k].
+    Returns convolution y[k] of width dx[k] at points x[k].  If *out*
+    is given, the convolution is stored there instead of a new array.
 
     The theory function is a piece-wise linear spline which does not need to
     be uniformly sampled.  The theory calculation points *xi* should be dense
@@ -276,16 +633,39 @@ def convolve(xi, yi, x, dx):
     from . import reflmodule
 
     x = _dense(x)
-    y = np.empty_like(x)
+    y = _output(out, x.shape, 'd')
     reflmodule.convolve(_dense(xi), _dense(yi), x, _dense(dx), y)
     return y
 
 
-def convolve_sampled(xi, yi, xp, yp, x, dx):
+def convolve_matrix(xi, x, dx):
+    """
+    Resolution matrix for :func:`convolve`.
+
+    Returns a sparse matrix *W* such that *W.dot(yi)* is the same as
+    *convolve(xi, yi, x, dx)*.  The matrix depends only on the theory
+    and measurement points, so it can be computed once and applied
+    to each new theory curve, avoiding the cost of recomputing the
+    gaussian weights each time.
+    """
+    from scipy.sparse import csr_matrix
+    from . import reflmodule
+
+    xi, x, dx = _dense(xi), _dense(x), _dense(dx)
+    indptr = np.empty(len(x)+1, 'i')
+    nnz = reflmodule.convolve_matrix(xi, x, dx, indptr)
+    indices = np.empty(nnz, 'i')
+    data = np.empty(nnz, 'd')
+    reflmodule.convolve_matrix(xi, x, dx, indptr, indices, data)
+    return csr_matrix((data, indices, indptr), shape=(len(x), len(xi)))
+
+
+def convolve_sampled(xi, yi, xp, yp, x, dx, out=None):
     """
     Apply x-dependent arbitrary resolution function to the theory.
 
-    Returns convolution y[k] of width dx[k] at points x[k].
+    Returns convolution y[k] of width dx[k] at points x[k].  If *out*
+    is given, the convolution is stored there instead of a new array.
 
     Like :func:`convolve`, the theory *(xi,yi)* is represented as a
     piece-wise linear spline which should extend beyond the data
@@ -296,12 +676,168 @@ def convolve_sampled(xi, yi, xp, yp, x, dx):
     from . import reflmodule
 
     x = _dense(x)
-    y = np.empty_like(x)
+    y = _output(out, x.shape, 'd')
     reflmodule.convolve_sampled(_dense(xi), _dense(yi), _dense(xp), _dense(yp),
                                 x, _dense(dx), y)
     return y
 
 
+def test_reflectivity_amplitude_batch():
+    kz = np.linspace(-0.1, 0.1, 31)
+    models = [
+        ([0, 100, 0], 3, [2.07, 4.5, 0], 0),
+        ([0, 50, 20, 0], [2, 5, 1], [2.07, 6.2, -0.5, 1], [0, 0.1, 0, 0]),
+        ([0, 0], 0, [2.07, 0], 0),
+    ]
+    depth, sigma, rho, irho = zip(*models)
+    r = reflectivity_amplitude_batch(kz, depth=depth, rho=rho, irho=irho,
+                                     sigma=sigma)
+    assert r.shape == (len(models), len(kz))
+    for rk, (d, s, p, ip) in zip(r, models):
+        target = reflectivity_amplitude(kz, depth=d, rho=p, irho=ip, sigma=s)
+        assert np.linalg.norm(rk - target) < 1e-14
+
+    # Models which differ only in the middle of the stack share the
+    # products for the layers on either side.
+    models = [
+        ([0, 20, 100, 30, 0], [1, 2, 3, 4], [2.07, 1, 4.5, 6, 0], 0),
+        ([0, 20, 120, 30, 0], [1, 2, 3, 4], [2.07, 1, 4.5, 6, 0], 0),
+        ([0, 20, 50, 60, 30, 0], [1, 2, 5, 3, 4], [2.07, 1, 3, 8, 6, 0], 0),
+    ]
+    depth, sigma, rho, irho = zip(*models)
+    r = reflectivity_amplitude_batch(kz, depth=depth, rho=rho, irho=irho,
+                                     sigma=sigma)
+    for rk, (d, s, p, ip) in zip(r, models):
+        target = reflectivity_amplitude(kz, depth=d, rho=p, irho=ip, sigma=s)
+        assert np.linalg.norm(rk - target) < 1e-14
+
+
+def test_partial_amplitude():
+    kz = np.linspace(-0.1, 0.1, 31)
+    depth = np.array([0, 15, 100, 20, 50, 0], 'd')
+    rho = np.array([2.07, 3.5, 4.5, 1.0, 6.2, 0], 'd')
+    irho = np.array([0, 0, 0.1, 0, 0, 0], 'd')
+    sigma = np.array([3, 2, 5, 1, 4], 'd')
+    calc = PartialAmplitude()
+    def check(depth, rho, irho, sigma):
+        r = calc(kz, depth=depth, rho=rho, irho=irho, sigma=sigma)
+        target = reflectivity_amplitude(kz, depth=depth, rho=rho, irho=irho,
+                                        sigma=sigma)
+        assert np.linalg.norm(r - target) < 1e-12, calc._split
+    check(depth, rho, irho, sigma)
+    rho[2] = 5.0 # sets the split around layer 2
+    check(depth, rho, irho, sigma)
+    assert calc._split == (2, 3)
+    depth[2], sigma[2] = 80, 4 # reuses the saved products
+    check(depth, rho, irho, sigma)
+    assert calc._split == (2, 3)
+    # insert a layer within the changed region
+    check(np.insert(depth, 2, 10), np.insert(rho, 2, 3.0),
+          np.insert(irho, 2, 0), np.insert(sigma, 2, 2))
+    assert calc._split == (2, 3)
+    rho[4] = 5.5 # widens the region
+    check(depth, rho, irho, sigma)
+    rho[0] = 2.0 # substrate change; full calculation
+    check(depth, rho, irho, sigma)
+    assert calc._split is None
+
+
+def test_reflectivity_amplitude_repeat():
+    kz = np.linspace(-0.1, 0.1, 31)
+    period = [(30, 9.4, 0.01, 3), (20, -1.9, 0, 4)]
+    inner = [(4, 3.0, 0, 1), (3, 5.0, 0, 2)]
+    layers = ([(0, 2.07, 0, 5), (10, 3.0, 0, 2)] + period*7
+              + [(5, 4.0, 0, 1)] + inner*3 + [(6, 1.0, 0, 6)] + inner*5
+              + [(0, 0, 0, 0)])
+    depth, rho, irho, sigma = [np.array(v, 'd') for v in zip(*layers)]
+    sigma = sigma[:-1]
+    sigma[15] = 10 # interface above the final copy does not repeat
+    repeats = [(2, 2, 7), (17, 2, 3), (24, 2, 5)]
+    r = reflectivity_amplitude(kz, depth=depth, rho=rho, irho=irho,
+                               sigma=sigma, repeats=repeats)
+    target = reflectivity_amplitude(kz, depth=depth, rho=rho, irho=irho,
+                                    sigma=sigma)
+    assert np.linalg.norm(r - target) < 1e-12
+
+
+def test_reflectivity_jacobian():
+    kz = np.linspace(-0.08, 0.08, 161)
+    layers = dict(depth=[0, 50, 30, 80, 0], rho=[2.07, 8, 4, 6, 1],
+                  irho=[0.01, 0.01, 0, 0.02, 0.03], sigma=[3, 5, 2, 7])
+    r, dr_depth, dr_sigma, dr_rho, dr_irho = reflectivity_jacobian(kz, **layers)
+    assert np.allclose(r, reflectivity_amplitude(kz, **layers))
+    for name, dr in (('depth', dr_depth), ('sigma', dr_sigma),
+                     ('rho', dr_rho), ('irho', dr_irho)):
+        for j in range(len(layers[name])):
+            h = 1e-6
+            values = np.array(layers[name], 'd')
+            shifted = dict(layers)
+            shifted[name] = values + h*(np.arange(len(values)) == j)
+            rp = reflectivity_amplitude(kz, **shifted)
+            shifted[name] = values - h*(np.arange(len(values)) == j)
+            rm = reflectivity_amplitude(kz, **shifted)
+            assert np.allclose(dr[j], (rp-rm)/(2*h), rtol=0, atol=1e-8)
+
+
+def test_magnetic_collinear():
+    kz = np.linspace(-0.05, 0.05, 101)
+    depth = [0, 50, 30, 80, 0]
+    rho, irho = [2.07, 8, 4, 6, 0], [0, 0.01, 0, 0.02, 0]
+    rhoM = [0, 1.5, 0, 0.8, 0]
+    for thetaM, Aguide, H in ((270, 270, 0.5), (90, 270, 0.3), (90, 90, 0)):
+        fast = magnetic_amplitude(kz, depth, rho, irho, rhoM, thetaM,
+                                  Aguide=Aguide, H=H)
+        # A small tilt forces the full 4x4 calculation.
+        full = magnetic_amplitude(kz, depth, rho, irho, rhoM, thetaM+1e-6,
+                                  Aguide=Aguide, H=H)
+        assert (fast[1] == 0).all() and (fast[2] == 0).all()
+        for r_fast, r_full in zip(fast, full):
+            assert np.allclose(r_fast, r_full, atol=1e-6)
+
+
+def test_magnetic_absorption():
+    # Absorbing magnetic layers between nonabsorbing ones, with the field
+    # tilted so that the full 4x4 calculation is used.
+    kz = [0.006, 0.01, 0.015, 0.03]
+    depth, rho = [0, 50, 30, 80, 0], [2.07, 8, 4, 6, 0]
+    irho, rhoM = [0, 0.1, 0, 0.3, 0], [0, 1.5, 0, 0.8, 0]
+    r = magnetic_amplitude(kz, depth, rho, irho, rhoM, 200, Aguide=270, H=0.1)
+    target = [
+        [0.009729780688-0.59143608312j, 0.266408056331-0.201906094606j,
+         0.101452914326+0.037175925253j, 0.050209613887-0.013349653778j],
+        [0.05794908343+0.074967244828j, -0.024711986128+0.06665667521j,
+         -0.025269092784+0.007550756583j, -0.012461323699+0.005946669344j],
+        [0.07359687948+0.071904632844j, -0.02151037285+0.072953161977j,
+         -0.02679831558+0.008732354928j, -0.012477633296+0.006136576672j],
+        [-0.036945254459-0.643674172388j, 0.282757166185-0.252493303618j,
+         0.120396204543+0.031151844108j, 0.05928235595-0.017748408454j],
+        ]
+    for r_xs, target_xs in zip(r, target):
+        assert np.allclose(r_xs, target_xs, rtol=0, atol=1e-10)
+
+
+def test_magnetic_cross_sections():
+    kz = np.linspace(-0.05, 0.05, 101)
+    depth, rho, rhoM = [0, 50, 30, 0], [2, 8, 4, 1], [0.5, 1, 0, 0.6]
+    full = magnetic_amplitude(kz, depth, rho, 0, rhoM, 200, H=0.1)
+    for xs in ((1, 0, 0, 0), (0, 1, 1, 0), (0, 0, 0, 1)):
+        part = magnetic_amplitude(kz, depth, rho, 0, rhoM, 200, H=0.1, xs=xs)
+        for want, r_full, r_part in zip(xs, full, part):
+            assert (r_part is None) if not want else (r_part == r_full).all()
+
+    # The unpolarized sum needs every cross section.
+    R = unpolarized_magnetic(kz, depth, rho, 0, rhoM, 200, H=0.1)
+    assert (R == unpolarized_magnetic(kz, depth, rho, 0, rhoM, 200, H=0.1,
+                                      xs=(1, 1, 1, 1))).all()
+    try:
+        unpolarized_magnetic(kz, depth, rho, 0, rhoM, 200, H=0.1,
+                             xs=(1, 0, 0, 1))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError for partial xs")
+
+
 def test_convolve_sampled():
     x = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     y = [1, 3, 1, 2, 1, 3, 1, 2, 1, 3]
@@ -313,6 +849,17 @@ def test_convolve_sampled():
     _check_convolution("super wide", x, y, xp, yp, dx=10)
 
 
+def test_convolve_matrix():
+    xi = np.hstack((np.linspace(0, 1, 40), [0.5, 0.5], np.linspace(1, 2, 7)))
+    xi.sort()
+    yi = np.cos(8*xi)
+    x = np.array([0, 0.3, 0.52, 0.77, 1.5, 1.95])
+    for dx in (0, 0.01, 0.05, 0.5):
+        dx = dx*np.ones_like(x)
+        W = convolve_matrix(xi, x, dx)
+        assert np.linalg.norm(W.dot(yi) - convolve(xi, yi, x, dx)) < 1e-12
+
+
 def _check_convolution(name, x, y, xp, yp, dx):
     ystar = convolve_sampled(x, y, xp, yp, x, dx=np.ones_like(x) * dx)
 
@@ -19,6 +19,7 @@ from bumps.data import parse_file
 
 from .rebin import rebin
 from .instrument import Pulsed
+from .datacache import cached_parse
 from . import resolution
 from .probe import make_probe
 
@@ -121,7 +122,7 @@ def parse_sns_file(filename):
     *header* dictionary of fields such as 'data', 'title', 'instrument'
     *data* 2D array of data
     """
-    raw_header, data = parse_file(filename)
+    raw_header, data = cached_parse(parse_file, filename)
     header = {}
 
     # guess instrument from file name
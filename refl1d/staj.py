@@ -14,6 +14,8 @@ from math import pi
 import numpy
 from bumps.wsolve import wsolve
 
+from .datacache import cached_parse
+
 ERF_FWHM = 2.35482004503095 # 2 * sqrt(2*log(2))
 TANH_FWHM = 0.47320111770856327 # 1/2 atanh(erf(1/sqrt(2))) / acosh(sqrt(2))
 # Derivation
@@ -289,12 +291,8 @@ class MlayerModel(object):
         """
         Load a staj file, returning an MlayerModel object
         """
-        fin = open(filename,'r')
-        lines = fin.readlines()
-        fin.close()
-
         self = cls()
-        self._parse(lines)
+        self.__dict__.update(cached_parse(_read_staj, filename, cls))
         return self
 
     def save(self, filename):
@@ -827,13 +825,9 @@ class MlayerMagnetic(object):
         """
         Load a staj file, returning an MlayerModel object
         """
-        fin = open(filename,'r')
-        lines = fin.readlines()
-        fin.close()
-
         self = cls()
         try:
-            self._parse(lines)
+            self.__dict__.update(cached_parse(_read_staj, filename, cls))
         except:
             raise ValueError("Improper staj file")
         return self
@@ -1062,3 +1056,14 @@ class MlayerMagnetic(object):
         fid.write(" ".join(str(p) for p in self.fitpars)+"\n")
         #footer+2 to end: constraints
         fid.write(self.constraints)
+
+
+def _read_staj(filename, cls):
+    """
+    Parse the staj file into a new *cls* instance, returning its attributes.
+    """
+    with open(filename, 'r') as fin:
+        lines = fin.readlines()
+    self = cls()
+    self._parse(lines)
+    return vars(self)
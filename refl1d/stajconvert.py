@@ -14,6 +14,7 @@ from .magnetism import Magnetism
 from .material import SLD
 from .resolution import QL2T,sigma2FWHM
 from .probe import NeutronProbe, XrayProbe, PolarizedNeutronProbe
+from .datacache import cached_parse
 
 def load_mlayer(filename, fit_pmp=0, name=None, layers=None):
     """
@@ -127,7 +128,7 @@ def _load_probe(s, name, xs):
         R,dR = None,None
     else:
         filename = s.data_file
-        Q,R,dR = numpy.loadtxt(s.data_file+xs).T
+        Q,R,dR = cached_parse(numpy.loadtxt, s.data_file+xs).T
 
     # Use Q and wavelength L from the staj file to determine angle T
     L = s.wavelength
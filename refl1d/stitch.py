@@ -4,15 +4,22 @@ Data stitching.
 Join together datasets yielding unique sorted x.
 """
 
-from numpy import hstack, vstack, argsort, sum, sqrt
+import numpy as np
+from numpy import sqrt
 
-def stitch(data, same_x = 0.001, same_dx = 0.001):
+def stitch(data, same_x = 0.001, same_dx = 0.001, return_map=False):
     """
     Stitch together multiple measurements into one.
 
-    *data* a list of datasets with x,dx,y,dy attributes
+    *data* a list of datasets with x,dx,y,dy attributes, or probes with
+    Q,dQ,R,dR attributes.  Any number of datasets can be stitched at once.
     *same_x* minimum point separation (default is 0.001).
     *same_dx* minimum change in resolution that may be averaged (default is 0.001).
+    *return_map* is True if the :class:`StitchMap` should be returned as well.
+
+    Returns the array x,dx,y,dy, or (x,dx,y,dy), map if *return_map*.
+    Use *map.apply(theory)* to stitch a theory curve computed at the
+    points of the datasets the same way the data was stitched.
 
     WARNING: the returned x values may be data dependent, with two measured
     sets having different x after stitching, even though the measurement
@@ -35,48 +42,166 @@ def stitch(data, same_x = 0.001, same_dx = 0.001):
     the relative weights of the averaged data points.
     """
     if same_dx is None: same_dx = same_x
-    x = hstack(p.x for p in data)
-    dx = hstack(p.dx for p in data)
-    y = hstack(p.y for p in data)
-    dy = hstack(p.dy for p in data)
+    columns = [_columns(p) for p in data]
+    x, dx, y, dy = [np.hstack([c[k] for c in columns]).astype('d')
+                    for k in range(4)]
     if all(hasattr(p,'I') for p in data):
-        weight = hstack(p.I for p in data)
+        weight = np.hstack([p.I for p in data])
     else:
         weight = y/dy**2  # y/dy**2 is approximately the intensity
 
-    # Sort the data by increasing x
-    idx = argsort(x)
-    data = vstack((x,dx,y,dy,weight))
-    data = data[:, idx]
-    x = data[0, :]
-    dx = data[1, :]
-
-    # Skip through the data looking for regions of overlap.
-    keep = []
-    n, last, next = len(x), 0, 1
-    while next < n:
-        while next < n and abs(x[next]-x[last]) <= same_x:
-            next += 1
-        if next - last == 1:
-            # Only one point, so no averaging necessary
-            keep.append(last)
-        else:
-            # Pick the x in [last:next] with the best resolution and average
-            # them using Poisson averages.  Repeat until all points are used
-            remainder = data[:,last:next]
-            avg = []
-            while remainder.shape[1] > 0:
-                best_dx = min(remainder[1,:])
-                idx = (remainder[1,:]-best_dx <= same_dx)
-                avg.append(poisson_average(remainder[:,idx]))
-                remainder = remainder[:,~idx]
-            # Store the result in worst to best resolution order.
-            for i,d in enumerate(reversed(avg)):
-                data[:,last+i] = d
-                keep.append(last+i)
-        last = next
-
-    return data[:4,keep]
+    index = stitch_map(x, dx, weight, same_x=same_x, same_dx=same_dx)
+    y_avg = index.apply(y)
+    result = np.vstack((index.apply(x), index.apply(dx), y_avg,
+                        index.poisson_dy(y_avg, dy)))
+    return (result, index) if return_map else result
+
+def stitch_map(x, dx, weight, same_x=0.001, same_dx=0.001):
+    """
+    Return the :class:`StitchMap` for points *x*, *dx* with *weight*.
+
+    Points are sorted by x and split into runs, with each run starting at
+    the first point not within *same_x* of the start of the previous run.
+    Runs with more than one point are split again by resolution, starting
+    from the best resolution, with points within *same_dx* of the best
+    resolution averaged together.  The averages within each run are
+    returned in order from worst to best resolution.
+    """
+    x, dx = np.asarray(x, 'd'), np.asarray(dx, 'd')
+    n = len(x)
+
+    # Split the data sorted by x into runs of overlapping points.
+    order = np.argsort(x, kind='mergesort')
+    xs = x[order]
+    end = np.searchsorted(xs, xs + same_x, side='right')
+    end = _exact_end(xs, end, np.zeros(n, 'i'), n, same_x)
+    runs = _chain(end, n)
+    run_size = np.diff(np.hstack((runs, n)))
+    run_id = np.repeat(np.arange(len(runs)), run_size)
+
+    # Sort the points in runs with overlap by resolution and split them
+    # into groups with the same resolution, as measured from the best
+    # resolution in the group.  Points in runs without overlap are
+    # groups of their own.
+    next = np.arange(1, n+1)
+    overlap = np.flatnonzero(run_size[run_id] > 1)
+    if len(overlap):
+        # Sort and search on (run, rank of dx) integer keys.
+        ids = run_id[overlap]
+        dxs = dx[order[overlap]]
+        by_value = np.argsort(dxs, kind='mergesort')
+        values = dxs[by_value]
+        limit = np.searchsorted(values, values + same_dx, side='right')
+        rank = np.empty(len(dxs), 'i')
+        rank[by_value] = np.arange(len(dxs))
+        scale = len(dxs) + 1
+        key = ids*scale + rank
+        resort = np.argsort(key, kind='mergesort')
+        order[overlap] = order[overlap][resort]
+        key, dxs, rank = key[resort], dxs[resort], rank[resort]
+        end = np.searchsorted(key, ids*scale + limit[rank], side='left')
+        stop = np.searchsorted(ids, ids, side='right')
+        end = _exact_end(dxs, end, ids, stop, same_dx)
+        next[overlap] = overlap[end-1] + 1
+    starts = _chain(next, n)
+
+    # Within each run, output the groups from worst to best resolution.
+    group_run = run_id[starts]
+    first = np.searchsorted(group_run, group_run, side='left')
+    last = np.searchsorted(group_run, group_run, side='right') - 1
+    out = first + last - np.arange(len(starts))
+    single = run_size[group_run] == 1
+
+    return StitchMap(order, starts, out, np.asarray(weight, 'd')[order],
+                     single)
+
+class StitchMap(object):
+    """
+    Mapping from the measured points to the stitched points.
+
+    *order* sorts the measured points into groups beginning at *starts*.
+    *out* puts the group averages into their stitched order.  *weight*
+    is the sorted point weights and *single* is True for groups from
+    runs with only one point, which are copied rather than averaged.
+    """
+    def __init__(self, order, starts, out, weight, single):
+        self.order, self.starts, self.out = order, starts, out
+        self.weight, self.single = weight, single
+        self.total = (np.add.reduceat(weight, starts) if len(starts)
+                      else np.empty(0))
+
+    def __len__(self):
+        return len(self.out)
+
+    def apply(self, y):
+        """
+        Return the weighted average of *y* for each stitched point.
+
+        *y* is an array with a value for each measured point, or a list
+        of arrays, one for each dataset.
+        """
+        y = np.hstack(y) if isinstance(y, (list, tuple)) else np.asarray(y)
+        y = y[self.order]
+        if not len(self.starts):
+            return y
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = np.add.reduceat(y*self.weight, self.starts)/self.total
+        avg = np.where(self.single, y[self.starts], avg)
+        return avg[self.out]
+
+    def poisson_dy(self, y, dy):
+        """
+        Return the uncertainty in the stitched *y* given the measured *dy*.
+
+        See :func:`poisson_average` for details.
+        """
+        dy = np.asarray(dy)[self.order]
+        if not len(self.starts):
+            return dy
+        single, total = self.single[self.out], self.total[self.out]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(single, dy[self.starts][self.out], sqrt(y/total))
+
+def _columns(p):
+    if hasattr(p, 'x'):
+        return p.x, p.dx, p.y, p.dy
+    return p.Q, p.dQ, p.R, p.dR
+
+def _chain(next, n):
+    """
+    Return the indices visited by following *next* from 0 until *n*.
+    """
+    next = next.tolist()
+    visited, k = [], 0
+    while k < n:
+        visited.append(k)
+        k = next[k]
+    return np.array(visited, 'i')
+
+def _exact_end(v, end, run_id, stop, tol):
+    """
+    Adjust the search results *end* so that they match the test
+    *v[j] - v[k] <= tol* rather than *v[j] <= v[k] + tol*, which can
+    differ in the last bit.  *run_id* and *stop* give the run containing
+    each point and the end of that run.  Points with equal *v* in a run
+    move together, so ties at the boundary are resolved in one step.
+    """
+    n = len(v)
+    if n == 0:
+        return end
+    k = np.arange(n)
+    change = np.hstack((True, (v[1:] != v[:-1]) | (run_id[1:] != run_id[:-1])))
+    block = np.cumsum(change) - 1
+    first = np.flatnonzero(change)
+    last = np.hstack((first[1:], n))
+    while True:
+        grow = (end < stop) & (v[np.minimum(end, n-1)] - v <= tol)
+        shrink = (end > k+1) & (v[end-1] - v > tol)
+        if not (grow.any() or shrink.any()):
+            return end
+        end = end.copy()
+        end[grow] = last[block[end[grow]]]
+        end[shrink] = first[block[end[shrink]-1]]
 
 def poisson_average(xdxydyw):
     """
@@ -118,10 +243,10 @@ def poisson_average(xdxydyw):
     # TODO: check the accuracy of the formula in the presence of
     # attenuators.
     x,dx,y,_dy,weight = xdxydyw
-    w = sum(weight)
-    x = sum(x*weight)/w
-    dx = sum(dx*weight)/w
-    y = sum(y*weight)/w
+    w = np.sum(weight)
+    x = np.sum(x*weight)/w
+    dx = np.sum(dx*weight)/w
+    y = np.sum(y*weight)/w
     dy = sqrt(y/w)
     #print "averaging",xdxydy,x,dx,y,dy
     return x,dx,y,dy,w
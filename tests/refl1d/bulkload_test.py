@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from refl1d import ncnrdata
+from refl1d.bulkload import load_files
+
+testdir = os.path.dirname(__file__)
+def test():
+    root = tempfile.mkdtemp()
+    try:
+        source = os.path.join(testdir, 'cg1test.refl')
+        for name in ('run1.refl', 'run2.refl', 'mag.reflA', 'mag.reflD'):
+            shutil.copy(source, os.path.join(root, name))
+
+        instrument = ncnrdata.NG1(slits_at_Tlo=1)
+        probes = load_files([os.path.join(root, '*.refl'),
+                             os.path.join(root, 'mag.refl?'),
+                             os.path.join(root, 'run1.refl')],
+                            instrument=instrument, threads=2,
+                            options={os.path.join(root, 'run2.refl'):
+                                     dict(slits_at_Tlo=2)})
+        assert sorted(probes) == [os.path.join(root, name) for name in
+                                  ('mag.refl', 'run1.refl', 'run2.refl')]
+        assert len(probes.timing) == 4
+        assert probes.report().count("\n") == 6
+
+        single = instrument.load(os.path.join(root, 'run1.refl'))
+        probe = probes[os.path.join(root, 'run1.refl')]
+        assert np.all(probe.Q == single.Q) and np.all(probe.dQ == single.dQ)
+        wide = probes[os.path.join(root, 'run2.refl')]
+        assert np.all(wide.dT > probe.dT)
+
+        magnetic = instrument.load_magnetic(os.path.join(root, 'mag.refl'))
+        polarized = probes[os.path.join(root, 'mag.refl')]
+        assert [xs is None for xs in polarized.xs] \
+            == [xs is None for xs in magnetic.xs]
+        assert np.all(polarized.xs[0].Q == magnetic.xs[0].Q)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,126 @@
+import numpy as np
+
+from refl1d.profile import Microslabs
+from refl1d.reflectivity import reflectivity_amplitude, magnetic_amplitude
+from refl1d.reflmodule import (_contract_by_area, _contract_by_area_multi,
+                               _contract_mag, _contract_mag_multi)
+
+def sine_profile(nprobe=1, n=400):
+    z = np.arange(n, dtype='d')
+    rho = np.array([4 + np.sin(z/30)*(1 + 0.05*k) for k in range(nprobe)])
+    irho = 0.01*np.ones_like(rho)
+    slabs = Microslabs(nprobe, dz=1)
+    slabs.append(w=0, rho=[2.07]*nprobe)
+    slabs.extend(w=np.ones(n), sigma=np.zeros(n), rho=rho, irho=irho)
+    slabs.append(w=0, rho=[0]*nprobe)
+    return slabs
+
+def test_single_column():
+    # Joint contraction of one column matches the original kernel.
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        n = rng.randint(3, 60)
+        w = rng.uniform(0.5, 2, n)
+        sigma = np.where(rng.rand(n-1) < 0.1, 1., 0.)
+        rho = np.cumsum(rng.normal(0, 0.3, n))
+        irho = abs(rng.normal(0, 0.05, n))
+        dA = rng.uniform(0, 3)
+        old = [v.copy() for v in (w, sigma, rho, irho)]
+        n_old = _contract_by_area(*(old + [dA]))
+        new = [v.copy() for v in (w, sigma, rho, irho)]
+        n_new = _contract_by_area_multi(*(new + [np.array([dA]), 0.,
+                                                 np.empty(1)]))
+        assert n_old == n_new
+        for a, b in zip(old, new):
+            assert np.array_equal(a[:n_new-1], b[:n_new-1])
+
+def test_all_wavelengths():
+    slabs = sine_profile(nprobe=3)
+    total = np.sum(slabs.rho*slabs.w, axis=1)
+    slabs.finalize(step_interfaces=False, dA=1, roughness_limit=0)
+    # Every wavelength is contracted, preserving the scattering area
+    # apart from the final slab which takes the surface values.
+    area = np.sum((slabs.rho*slabs.w)[:, :-1], axis=1)
+    assert len(slabs) < 100
+    assert np.sum(slabs.w) == 400
+    assert np.allclose(area[1:], total[1:], rtol=0.05)
+    assert not np.array_equal(slabs.rho[0], slabs.rho[1])
+
+def test_target_error():
+    Q = np.linspace(0.005, 0.2, 2000)
+    def R(slabs):
+        r = reflectivity_amplitude(Q/2, slabs.w, rho=slabs.rho[0],
+                                   irho=slabs.irho[0], sigma=slabs.sigma)
+        return abs(r)**2
+    exact = sine_profile()
+    R0 = R(exact)
+    last = len(exact)
+    for dR in (1e-3, 1e-2, 0.1):
+        slabs = sine_profile()
+        slabs.finalize(step_interfaces=False, dA=None, roughness_limit=0,
+                       dR=dR, Qmax=Q[-1])
+        assert slabs.contract_error <= dR
+        assert np.max(abs(R(slabs) - R0)/R0) <= slabs.contract_error
+        assert len(slabs) < last
+        last = len(slabs)
+
+def magnetic_profile(nprobe=1, n=400):
+    slabs = sine_profile(nprobe=nprobe, n=n)
+    z = np.arange(n+2, dtype='d')
+    slabs.rhoM = np.where((z > 50) & (z < 300), 1 + 0.5*np.cos(z/20), 0.)
+    slabs.thetaM = 270 + 10*np.sin(z/40)
+    return slabs
+
+def test_magnetic_single_column():
+    # Joint contraction of one column matches the original kernel.
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        n = rng.randint(3, 60)
+        w = rng.uniform(0.5, 2, n)
+        rho = np.cumsum(rng.normal(0, 0.3, n))
+        irho = abs(rng.normal(0, 0.05, n))
+        rhoM = abs(np.cumsum(rng.normal(0, 0.3, n)))
+        thetaM = rng.uniform(0, 360, n)
+        dA = rng.uniform(0, 3)
+        old = [v.copy() for v in (w, rho, irho, rhoM, thetaM)]
+        n_old = _contract_mag(*(old + [dA]))
+        new = [v.copy() for v in (w, rho, irho, rhoM, thetaM)]
+        n_new = _contract_mag_multi(*(new + [np.array([dA, dA]), 0.,
+                                             np.empty(2)]))
+        assert n_old == n_new
+        for a, b in zip(old, new):
+            assert np.array_equal(a[:n_new], b[:n_new])
+
+def test_magnetic_all_wavelengths():
+    # With identical columns, every column is contracted as the first
+    # column is by the original kernel.
+    slabs = magnetic_profile(nprobe=3)
+    old = [np.array(v, 'd') for v in (slabs.w, slabs.rho[0], slabs.irho[0],
+                                      slabs.rhoM, slabs.thetaM)]
+    n = _contract_mag(*(old + [1.]))
+    slabs.rho[1:] = slabs.rho[0]
+    slabs.irho[1:] = slabs.irho[0]
+    slabs._contract_magnetic(dA=1)
+    assert len(slabs) == n
+    assert np.array_equal(slabs.w, old[0][:n])
+    for k in range(3):
+        assert np.array_equal(slabs.rho[k], old[1][:n])
+        assert np.array_equal(slabs.irho[k], old[2][:n])
+    assert np.array_equal(slabs.rhoM, old[3][:n])
+    assert np.array_equal(slabs.thetaM, old[4][:n])
+
+def test_magnetic_target_error():
+    Q = np.linspace(0.005, 0.2, 2000)
+    def R(slabs):
+        r = magnetic_amplitude(Q/2, slabs.w, slabs.rho[0], slabs.irho[0],
+                               slabs.rhoM, slabs.thetaM, Aguide=270)
+        return abs(np.array([r[0], r[3]]))**2
+    R0 = R(magnetic_profile())
+    last = len(magnetic_profile())
+    for dR in (1e-3, 1e-2, 0.1):
+        slabs = magnetic_profile()
+        slabs._contract_magnetic(dA=None, dR=dR, Qmax=Q[-1])
+        assert slabs.contract_error <= dR
+        assert np.max(abs(R(slabs) - R0)/R0) <= slabs.contract_error
+        assert len(slabs) < last
+        last = len(slabs)
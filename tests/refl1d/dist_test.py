@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.stats import norm
+
+from refl1d.names import Material, NeutronProbe, Experiment, silicon, air
+from refl1d.dist import Weights, GaussHermite, DistributionExperiment
+
+def build():
+    nickel = Material('Ni')
+    gold = Material('Au')
+    sample = silicon(0, 5) | nickel(200, 5) | gold(50, 3) | air
+    probe = NeutronProbe(T=np.linspace(0.1, 3, 200), dT=0.01, L=4.75,
+                         dL=0.0475)
+    return Experiment(sample=sample, probe=probe), sample[1].thickness
+
+def test_batched():
+    M, P = build()
+    dist = Weights(edges=np.linspace(150, 250, 21), cdf=norm.cdf,
+                   loc=200, scale=10)
+    for coherent in (False, True):
+        DM = DistributionExperiment(experiment=M, P=P, distribution=dist,
+                                    coherent=coherent)
+        points = [(x, w) for x, w in dist if w > 0]
+        Q, R = DM._calc_R()
+        assert P.value == 200
+        Qs, Rs = DM._calc_R_serial(points)
+        P.value = 200
+        assert np.array_equal(Q, Qs)
+        assert np.allclose(R, Rs, rtol=1e-12, atol=0)
+
+def test_gauss_hermite():
+    M, P = build()
+    fine = Weights(edges=np.linspace(140, 260, 241), cdf=norm.cdf,
+                   loc=200, scale=10)
+    target = DistributionExperiment(experiment=M, P=P,
+                                    distribution=fine).reflectivity()[1]
+    DM = DistributionExperiment(experiment=M, P=P,
+                                distribution=GaussHermite(200, 10, n=7))
+    R = DM.reflectivity()[1]
+    assert np.max(abs(R - target)/target) < 1e-3
+    assert 3 <= DM.adapt_points(tol=1e-3) <= 15
@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+import numpy as np
+
+from refl1d import snsdata
+from refl1d.eventdata import EventHistogram, EVENT_DTYPE
+from refl1d.rebin import logbin_edges, rebin
+from refl1d.resolution import bins, TOF2L
+
+def test():
+    instrument = snsdata.Liquids(slits_at_Tlo=0.2)
+    d = instrument.d_moderator
+    edges = logbin_edges(bins(3, 6, 0.02))
+
+    # Events in 100 ns units from 2 pixels, one of which is masked.
+    rng = np.random.RandomState(1)
+    events = np.empty(50000, EVENT_DTYPE)
+    events['tof'] = rng.uniform(2.5, 6.5, len(events))/TOF2L(d, 0.1)
+    events['pixel'] = rng.randint(0, 2, len(events))
+
+    fd, filename = tempfile.mkstemp(suffix='.dat')
+    os.close(fd)
+    try:
+        events.tofile(filename)
+        hist = EventHistogram(edges, d, tof_scale=0.1, pixels=[1])
+        hist.add_file(filename, chunk_size=7000)
+    finally:
+        os.remove(filename)
+
+    # Streaming matches a one-shot histogram of the selected events.
+    L = TOF2L(d, 0.1*events['tof'][events['pixel'] == 1])
+    lo, hi = edges[0], edges[-1]
+    assert hist.events == np.sum((L >= lo) & (L < hi))
+    fine = np.linspace(lo, hi, 20001)
+    expected = rebin(fine, np.histogram(L, fine)[0].astype('d'), edges)
+    assert np.allclose(hist.counts.sum(), hist.events)
+    assert np.all(abs(hist.counts - expected) < 0.05*expected + 5)
+
+    # Counting statistics give sqrt(N) uncertainty scaled by the monitor.
+    monitor = np.full(len(hist.counts), 10.)
+    monitor[0] = 0
+    R, dR = hist.reflectivity(monitor)
+    assert np.allclose(dR[1:], np.sqrt(hist.counts[1:])/10)
+    probe = hist.probe(instrument, T=1.2, monitor=monitor)
+    assert len(probe.Q) == len(hist.counts) - 1
+    assert np.allclose(np.sort(probe.R), np.sort(hist.counts[1:]/10))
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,68 @@
+import numpy as np
+
+from refl1d.names import (Material, NeutronProbe, PolarizedNeutronProbe,
+                          Experiment, silicon, air)
+from refl1d.probe import ProbeSet
+
+def probe(T=np.linspace(0.2, 4, 80)):
+    return NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+
+def added_points(p):
+    return np.setdiff1d(p.calc_Qo, p.Qo)
+
+def test_thickness():
+    # thicker films have closer fringes, so need more calculation points
+    counts = []
+    for thickness in (100, 1000, 5000):
+        p = probe()
+        p.adaptive_oversample(thickness)
+        counts.append(len(p.calc_Qo))
+    assert len(probe().calc_Qo) <= counts[0] < counts[1] < counts[2]
+
+    # every new point is inside the resolution window of a measurement
+    width = 3
+    p = probe()
+    p.adaptive_oversample(5000, width=width)
+    Q = added_points(p)
+    assert len(Q) > 0
+    inside = abs(Q[:, None] - p.Qo[None, :]) <= width*p.dQ[None, :]
+    assert inside.any(axis=1).all()
+
+    # and the measurements themselves are still calculated
+    assert np.all(np.in1d(p.Qo, p.calc_Qo))
+
+def test_delegation():
+    nickel = Material('Ni')
+    sample = silicon(0, 5) | nickel(1000, 5) | air
+    single = probe()
+    single.adaptive_oversample(1000)
+    expected = single.calc_Qo
+
+    # each probe in a probe set is oversampled in the same way
+    probes = ProbeSet([probe(), probe(np.linspace(0.3, 3, 50))])
+    probes.adaptive_oversample(1000)
+    assert np.array_equal(probes.probes[0].calc_Qo, expected)
+    assert len(probes.probes[1].calc_Qo) > 50
+
+    # polarized probes are oversampled across the cross sections
+    xs = [probe(), None, None, probe()]
+    polarized = PolarizedNeutronProbe(xs)
+    polarized.adaptive_oversample(1000)
+    assert np.array_equal(polarized.calc_Qo, expected)
+
+    # the experiment uses the rendered film thickness by default, and
+    # refines the grid near the critical edge of the film
+    M = Experiment(sample=sample, probe=probe())
+    M.adaptive_oversample()
+    Q = M.probe.calc_Qo
+    assert np.all(np.in1d(expected, Q)) and len(Q) > len(expected)
+    other = Experiment(sample=sample, probe=probe())
+    other.adaptive_oversample(1000)
+    assert np.array_equal(other.probe.calc_Qo, Q)
+    M.reflectivity()
+
+    M = Experiment(sample=sample, probe=PolarizedNeutronProbe(
+        [probe(), None, None, probe()]))
+    M.adaptive_oversample(1000)
+    assert np.array_equal(M.probe.calc_Qo, Q)
+    M.reflectivity()
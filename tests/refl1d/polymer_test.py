@@ -15,7 +15,7 @@ import numpy as np
 from refl1d.names import Material
 from refl1d.polymer import (PolymerBrush, PolymerMushroom, EndTetheredPolymer,
                             SCFprofile, SCFcache, SCFsolve, SCFeqns, SZdist,
-                            calc_g_zs)
+                            SCFSolutionCache, calc_g_zs)
 
 
 def calc_g_zs_test():
@@ -372,6 +372,26 @@ def SCFeqns_test():
     #TODO: check float overflow handling
     
     
+def SCFJacobian_test():
+    
+    # compare the jacobian-vector product to central differences
+    phi_z = easy_phi_z*(1+.05*np.sin(np.arange(easy_phi_z.size)))
+    v = np.cos(np.arange(phi_z.size))
+    step = 1e-7
+    for pdi, navgsegments in ((1.2, 95.5), (1, 100)):
+        p_i = SZdist(pdi,navgsegments)
+        args = (0.1,0.05,.1,navgsegments,p_i)
+        result, jac = SCFeqns(phi_z,*args,jacobian=True)
+        assert np.array_equal(result, SCFeqns(phi_z,*args))
+        data = (SCFeqns(phi_z+step*v,*args)
+                - SCFeqns(phi_z-step*v,*args))/(2*step)
+        assert np.allclose(jac.matvec(v), data, rtol=0, atol=1e-7)
+        
+        # the preconditioner is an approximate inverse
+        residual = jac.matvec(jac.psolve(v)) - v
+        assert np.linalg.norm(residual) < np.linalg.norm(v)
+    
+    
 def SCFsolve_test():
     
     #find the solution used in the previous test without an initial guess
@@ -383,7 +403,14 @@ def SCFsolve_test():
     data = easy_phi_z.copy()
     result = SCFsolve(chi,chi_s,pdi,sigma,navgsegments)
     assert np.allclose(result, data, atol=1e-14)
-    
+
+    # the analytic jacobian finds the same solution to within the solver
+    # tolerance
+    f_tol = np.finfo(float).eps**(1./3)
+    result = SCFsolve(chi,chi_s,pdi,sigma,navgsegments,jacobian=True)
+    assert result.shape == data.shape
+    assert np.allclose(result, data, rtol=0, atol=f_tol)
+
     # try a very hard one using the answer as an initial guess
     chi = 1
     chi_s = .5
@@ -422,7 +449,11 @@ def SCFsolve_test():
          9.20866301e-08))
     result = SCFsolve(chi,chi_s,pdi,sigma,navgsegments,False,phi0)
     assert np.allclose(result, data, atol=1e-14)
-    
+    result = SCFsolve(chi,chi_s,pdi,sigma,navgsegments,False,phi0,
+                      jacobian=True)
+    assert result.shape == data.shape
+    assert np.allclose(result, data, rtol=0, atol=f_tol)
+
          
 def SCFcache_test():
     
@@ -467,6 +498,72 @@ def SCFcache_test():
         assert newest_key == list(cache)[-2]
     
 
+def SCFSolutionCache_test():
+    import os
+    import tempfile
+    
+    path = os.path.join(tempfile.mkdtemp(), 'scfcache.db')
+    cache = SCFSolutionCache(maxsize=3, path=path)
+    for k in range(5):
+        cache[(k,0,0,.1,.2)] = np.arange(k+1.)
+    
+    # least recently used solutions are dropped from memory
+    assert list(cache) == [(2,0,0,.1,.2),(3,0,0,.1,.2),(4,0,0,.1,.2)]
+    cache[(2,0,0,.1,.2)]
+    assert list(cache)[-1] == (2,0,0,.1,.2)
+    assert cache.nearest((3.2,0,0,.1,.2)) == (3,0,0,.1,.2)
+    
+    # but are still available from the database
+    assert np.all(cache[(0,0,0,.1,.2)] == [0.])
+    
+    # as are solutions saved by other processes
+    other = SCFSolutionCache(maxsize=10, path=path)
+    assert len(other) == 5
+    cache[(5,0,0,.1,.2)] = np.arange(6.)
+    other.sync()
+    assert np.all(other[(5,0,0,.1,.2)] == np.arange(6.))
+    assert other.nearest((6,0,0,.1,.2)) == (5,0,0,.1,.2)
+
+    # solutions from another solver version are ignored
+    import sqlite3
+    db = sqlite3.connect(path)
+    db.execute("UPDATE scf SET version = version + 1"
+               " WHERE chi = 5 OR chi = 0")
+    db.commit()
+    db.close()
+    other = SCFSolutionCache(maxsize=10, path=path)
+    assert len(other) == 4
+    assert (5,0,0,.1,.2) not in other and (0,0,0,.1,.2) not in other
+    other[(5,0,0,.1,.2)] = np.arange(6.)
+    assert (5,0,0,.1,.2) in SCFSolutionCache(path=path)
+
+    # and the database only keeps the most recent solutions
+    other.maxrows = 3
+    other[(6,0,0,.1,.2)] = np.arange(7.)
+    cache = SCFSolutionCache(maxsize=10, path=path)
+    assert list(cache) == [(4,0,0,.1,.2),(5,0,0,.1,.2),(6,0,0,.1,.2)]
+
+    # the index agrees with a linear search as keys come and go
+    rng = np.random.RandomState(0)
+    cache = SCFSolutionCache(maxsize=50, reindex=8)
+    for k in range(300):
+        cache[tuple(rng.rand(5))] = None
+        if k % 7 == 6:
+            cache.pop(list(cache)[rng.randint(len(cache))])
+        point = rng.rand(5)
+        keys = np.array(list(cache))
+        closest = tuple(keys[np.argmin(np.sum((keys-point)**2,axis=1))])
+        assert cache.nearest(point) == closest
+
+    # check that walked solutions are shared through the database
+    path = os.path.join(os.path.dirname(path), 'walk.db')
+    data = SCFcache(1,0.5,1.2,.1,95.5,False,SCFSolutionCache(path=path))
+    cache = SCFSolutionCache(path=path)
+    assert (1,0.5*3,1.2-1,.1,95.5/500) in cache
+    assert np.allclose(SCFcache(1,0.5,1.2,.1,95.5,False,cache), data,
+                       atol=1e-14)
+    
+
 long_profile = np.array((
          4.99184756e-01,   4.87940275e-01,   4.76695793e-01,
          4.65451312e-01,   4.56517574e-01,   4.50163833e-01,
@@ -732,15 +829,51 @@ def PolymerBrush_test():
          5.16572477e-05,   3.77789065e-05,   2.70571017e-05))
     result = brush.profile(np.linspace(0,60,99))
     assert np.allclose(result, data, atol=1e-14)
-    
+
+
+def render_cache_test():
+    from refl1d.names import silicon, SLD, NeutronProbe, Experiment
+    from refl1d.profile import Microslabs
+    from refl1d.material import ProbeCache
+    PS = SLD(name='PS', rho=1.4)
+    D2O = SLD(name='D2O', rho=6.3)
+    brush = PolymerBrush(polymer=PS, solvent=D2O, base_vf=70, base=120,
+                         length=80, power=2, sigma=10, thickness=400)
+    sample = silicon(0, 5) | brush | D2O
+    probe = NeutronProbe(T=np.linspace(0.1, 5, 50), L=5)
+    M = Experiment(sample=sample, probe=probe, dz=2)
+
+    def fresh_profile():
+        slabs = Microslabs(1, dz=2)
+        sample.render(ProbeCache(probe), slabs)
+        return slabs.w.copy(), slabs.rho[0].copy()
+
+    # Cached profile matches a fresh render whether or not the brush changed
+    for length in (80, 90, 90):
+        brush.length.value = length
+        M.update()
+        slabs = M._render_slabs()
+        w, rho = fresh_profile()
+        assert np.array_equal(slabs.w, w) and np.array_equal(slabs.rho[0], rho)
+
+    # Changing the solvent material also re-renders the brush
+    D2O.rho.value = 6.0
+    M.update()
+    slabs = M._render_slabs()
+    w, rho = fresh_profile()
+    assert np.array_equal(slabs.w, w) and np.array_equal(slabs.rho[0], rho)
+
 
 if __name__ == '__main__':
     calc_g_zs_test()
     SZdist_test()
     SCFeqns_test()
+    SCFJacobian_test()
     SCFsolve_test()
     SCFcache_test()
+    SCFSolutionCache_test()
     SCFprofile_test()
     EndTetheredPolymer_test()
     PolymerMushroom_test()
     PolymerBrush_test()
+    render_cache_test()
@@ -0,0 +1,81 @@
+import numpy as np
+
+from refl1d.names import (Material, NeutronProbe, PolarizedNeutronProbe,
+                          Experiment, Magnetism, silicon, air)
+
+def probe(T=np.linspace(0.2, 4, 60)):
+    return NeutronProbe(T=T, dT=0.02, L=4.75, dL=0.0475)
+
+def model(sample, probe):
+    M = Experiment(sample=sample, probe=probe)
+    np.random.seed(1)
+    M.simulate_data(noise=2)
+    return M
+
+def population(parameters, n=6):
+    np.random.seed(2)
+    lo, hi = np.array([p.bounds.limits for p in parameters]).T
+    return lo + (hi-lo)*np.random.rand(n, len(parameters))
+
+def check(M, parameters, batched):
+    pop = population(parameters)
+    start = [p.value for p in parameters]
+
+    # record whether the population is evaluated one member at a time
+    serial = []
+    def record(parameters, population):
+        serial.append(True)
+        return type(M)._nllf_serial(M, parameters, population)
+    M._nllf_serial = record
+    nllf = M.nllf_population(parameters, pop)
+    del M._nllf_serial
+    assert bool(serial) != batched
+
+    # parameter values and the cached theory are restored
+    assert [p.value for p in parameters] == start
+    restored = M.nllf()
+
+    expected = M._nllf_serial(parameters, pop)
+    assert np.allclose(nllf, expected, rtol=1e-10, atol=0)
+    for p, v in zip(parameters, start):
+        p.value = v
+    M.update()
+    assert M.nllf() == restored
+
+def test_slab():
+    nickel, titanium = Material('Ni'), Material('Ti')
+    sample = silicon(0, 5) | nickel(200, 5) | titanium(100, 5) | air
+    sample[1].thickness.range(100, 300)
+    sample[2].material.density.range(3, 6)
+    sample[2].interface.range(1, 10)
+    M = model(sample, probe())
+    check(M, [sample[1].thickness, sample[2].material.density,
+              sample[2].interface], batched=True)
+
+def test_theta_offset():
+    nickel = Material('Ni')
+    sample = silicon(0, 5) | nickel(200, 5) | air
+    sample[1].thickness.range(100, 300)
+    M = model(sample, probe())
+    M.probe.theta_offset.range(-0.02, 0.02)
+    parameters = [sample[1].thickness, M.probe.theta_offset]
+    check(M, parameters, batched=False)
+
+def test_magnetic():
+    nickel = Material('Ni')
+    sample = (silicon(0, 5)
+              | nickel(200, 5, magnetism=Magnetism(rhoM=1.5, thetaM=270))
+              | air)
+    sample[1].thickness.range(100, 300)
+    sample[1].magnetism.rhoM.range(0, 3)
+    M = model(sample, PolarizedNeutronProbe([probe(), None, None, probe()]))
+    check(M, [sample[1].thickness, sample[1].magnetism.rhoM], batched=False)
+
+def test_repeats():
+    nickel, titanium = Material('Ni'), Material('Ti')
+    sample = silicon(0, 5) | (nickel(50, 3) | titanium(50, 3))*5 | air
+    nickel_layer = sample[1][0]
+    nickel_layer.thickness.range(30, 70)
+    M = model(sample, probe())
+    assert len(M._render_slabs().repeats())
+    check(M, [nickel_layer.thickness], batched=False)
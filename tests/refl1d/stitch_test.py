@@ -0,0 +1,56 @@
+import numpy as np
+
+from refl1d.stitch import stitch, poisson_average
+
+class Data(object):
+    def __init__(self, x, dx, y, dy):
+        self.x, self.dx, self.y, self.dy = x, dx, y, dy
+
+def reference_stitch(data, same_x, same_dx):
+    # Point by point scan used before stitch was vectorized.
+    x, dx, y, dy = [np.hstack([getattr(p, k) for p in data])
+                    for k in ('x', 'dx', 'y', 'dy')]
+    data = np.vstack((x, dx, y, dy, y/dy**2))[:, np.argsort(x)]
+    x = data[0, :]
+    keep = []
+    n, last, next = len(x), 0, 1
+    while next < n:
+        while next < n and abs(x[next]-x[last]) <= same_x:
+            next += 1
+        if next - last == 1:
+            keep.append(last)
+        else:
+            remainder = data[:, last:next]
+            avg = []
+            while remainder.shape[1] > 0:
+                best_dx = min(remainder[1, :])
+                idx = (remainder[1, :]-best_dx <= same_dx)
+                avg.append(poisson_average(remainder[:, idx]))
+                remainder = remainder[:, ~idx]
+            for i, d in enumerate(reversed(avg)):
+                data[:, last+i] = d
+                keep.append(last+i)
+        last = next
+    return data[:4, keep]
+
+def test():
+    rng = np.random.RandomState(3)
+    for same_dx in (0.001, 1e-5):
+        data = []
+        for k in range(8):
+            x = np.geomspace(0.005, 0.015, 200)*1.12**k
+            y = rng.uniform(0.1, 1, len(x))
+            data.append(Data(x, 0.02*x*(1+0.03*k), y, 0.05*y))
+        data.append(Data(np.round(x, 3), np.round(0.02*x, 4), y, 0.05*y))
+        expected = reference_stitch(data, 0.001, same_dx)
+        result, index = stitch(data, 0.001, same_dx, return_map=True)
+        assert result.shape == expected.shape
+        assert np.allclose(result, expected, rtol=1e-12, atol=0)
+
+        # The map reproduces the stitched data and can be applied to theory.
+        assert np.allclose(index.apply([p.y for p in data]), result[2])
+        theory = [np.ones_like(p.x) for p in data]
+        assert np.allclose(index.apply(theory), 1)
+
+if __name__ == "__main__":
+    test()